@@ -7,6 +7,11 @@
 
 import os
 import subprocess
+import sys
+import xarray
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(SCRIPT_DIR, '../boundary'))
 
 
 def run_cmd(cmd):
@@ -18,9 +23,16 @@ def run_cmd(cmd):
 # to pad the end of the second to last year.
 YEARS = range(1993, 2022)
 
-# To reduce file size, only extract and pad this
-# lat/lon subset that encompasses the NWA domain.
-REGION_SLICE = 'latitude,0.0,60.0 -d longitude,260.0,325.0'
+# To reduce file size, only extract and pad the
+# lat/lon subset that encompasses the model domain in this grid,
+# plus this many ERA5 grid points on each side.
+# (A relative path is relative to the directory of this script.)
+GRID_FILE = os.path.join(SCRIPT_DIR, '../../datasets/grid/ocean_hgrid.nc')
+HALO = 2
+
+# Or, set the subset by hand, e.g. for NWA:
+# REGION_SLICE = 'latitude,0.0,60.0 -d longitude,260.0,325.0'
+REGION_SLICE = None
 
 # Location to save temporary data to.
 # Use TMPDIR as set on ppan.
@@ -74,7 +86,21 @@ VARIABLES = {
     'v_10m': 'v10'
 }
 
+def region_slice(era5_file, grid_file, halo=HALO):
+    """Find the ncks hyperslab of an ERA5 file that covers a model grid."""
+    # Imported here so that boundary (and xesmf) is only needed if REGION_SLICE is not set by hand.
+    from boundary import subset_indices
+    with xarray.open_dataset(era5_file) as era5, xarray.open_dataset(grid_file) as grid:
+        subset = subset_indices(era5['longitude'], era5['latitude'], grid, halo=halo)
+        lat = era5['latitude'].isel(latitude=subset['latitude']).values
+        lon = era5['longitude'].isel(longitude=subset['longitude']).values
+    # If the subset crosses the edge of the ERA5 grid, the first longitude is larger 
+    # than the last, which ncks treats as a wrapped hyperslab.
+    return f'latitude,{lat.min()},{lat.max()} -d longitude,{lon[0]},{lon[-1]}'
+
+
 def main():
+    region = REGION_SLICE
     for var in NAMES:
         print(var)
 
@@ -100,9 +126,11 @@ def main():
                 run_cmd(f'gcp --sync {f} {TMP}')
 
             # Subset the file by latitude and longitude.
-            print(f'  slice {tmp_file}')
+            if region is None:
+                region = region_slice(tmp_file, GRID_FILE)
+            print(f'  slice {tmp_file} to {region}')
             sliced_file = tmp_file.replace('.nc', '_sliced.nc').replace(long_name, var_name)
-            cmd = f'ncks {tmp_file} -d {REGION_SLICE} -O {sliced_file}'
+            cmd = f'ncks {tmp_file} -d {region} -O {sliced_file}'
             run_cmd(cmd)
 
             # Make time the unlimited dimension.
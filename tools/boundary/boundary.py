@@ -1,6 +1,18 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from functools import lru_cache
+import dask.array
+import hashlib
+import json
+import netCDF4
 import numpy as np
+import os
 from os import path
-#import warnings
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+import tempfile
+import warnings
 import xarray as xarray
 import xesmf
 
@@ -45,6 +57,11 @@ def rotate_uv(uearth, vearth, angle_earth_to_model_rad):
 def fill_missing(arr, xdim='locations', zdim='z', fill='b'):
     """Fill missing data along the boundaries.
     Extrapolates horizontally first, then vertically. 
+    Points that cannot be filled either way are set to 0 (only if zdim is not None).
+
+    The point that each missing point is filled from is found once for each distinct 
+    mask of missing data (normally the same at all times or constituents), 
+    and all data with that mask are filled with one gather.
    
     Args:
         arr: xarray DataArray or Dataset to be fillled.
@@ -55,50 +72,201 @@ def fill_missing(arr, xdim='locations', zdim='z', fill='b'):
     Returns:
         Filled DataArray or Dataset.
     """
-    if fill == 'f':
-        filled = arr.ffill(dim=xdim, limit=None)
-    elif fill == 'b':
-        filled = arr.bfill(dim=xdim, limit=None)
-    if zdim is not None:
-        filled = filled.ffill(dim=zdim, limit=None).fillna(0)
-    return filled
-
-
-def flood_missing(arr, **kwargs):
-    """Flood missing data (over land) using HCtFlood. 
-    Had some trouble installing HCtFlood on analysis, so it is 
-    imported by adding it to the path. 
-    Import is done inside this function so that 
-    everything else still works if HCtFlood is unavailable.
+    if isinstance(arr, xarray.Dataset):
+        return arr.map(fill_missing, keep_attrs=True, xdim=xdim, zdim=zdim, fill=fill)
+
+    if xdim not in arr.dims:
+        return arr
+    fill_dims = [zdim, xdim] if zdim is not None and zdim in arr.dims else [xdim]
+    other = [d for d in arr.dims if d not in fill_dims]
+    arr_t = arr.transpose(*other, *fill_dims)
+    kwargs = dict(ndim=len(fill_dims), fill=fill, zero=zdim is not None)
+    data = arr_t.data
+    if isinstance(data, dask.array.Array):
+        data = data.rechunk({i: -1 for i in range(len(other), data.ndim)})
+        filled = data.map_blocks(_fill_array, dtype=data.dtype, **kwargs)
+    else:
+        filled = _fill_array(np.asarray(data), **kwargs)
+    return arr_t.copy(data=filled).transpose(*arr.dims)
+
+
+def _fill_array(data, ndim, fill, zero):
+    """Fill missing data in a numpy array along its last ndim axes (z, x) or (x, ); see fill_missing."""
+    plane = data.shape[data.ndim-ndim:]
+    flat = data.reshape((-1, int(np.prod(plane))))
+    if len(flat) == 0:
+        return data
+    # Usually every slice has the same mask (e.g. all times), but stacked variables
+    # such as u and v may not, so find the map once for each distinct mask.
+    valid = ~np.isnan(flat)
+    if (valid == valid[0]).all():
+        masks, group = valid[:1], np.zeros(len(flat), dtype=int)
+    else:
+        masks, group = np.unique(valid, axis=0, return_inverse=True)
+        group = group.ravel()
+    filled = np.empty_like(flat)
+    for g, valid in enumerate(masks):
+        i = np.flatnonzero(group == g) if len(masks) > 1 else slice(None)
+        source, found = _fill_map(valid.tobytes(), plane, fill)
+        filled[i] = np.where(found.ravel(), flat[i][:, source], 0 if zero else np.nan)
+    return filled.reshape(data.shape)
+
+
+@lru_cache(maxsize=64)
+def _fill_map(valid_bytes, shape, fill):
+    """Find the point that each point of a boundary is filled from.
 
     Args:
-        arr (xarray.DataArray): Array to be flooded.
-        **kwargs: Additional keyword arguments passed to flooding function.
+        valid_bytes (bytes): bytes of a boolean array that is True where data are not missing,
+            with dimensions (z, x) or (x, ).
+        shape (tuple): shape of the boolean array.
+        fill (str): b to fill from the nearest valid point in increasing x, or f for decreasing x.
 
     Returns:
-        xarray.DataArray: Flooded array.
+        (flat index into the (z, x) array to fill from, boolean array that is False where no point was found)
     """
-    # https://github.com/raphaeldussin/HCtFlood
-    import sys
-    sys.path.append('/home/Andrew.C.Ross/git/HCtFlood')
-    from HCtFlood import kara as hct
-    flooded = hct.flood_kara(arr, **kwargs)
-
-    # Check for 2D or 3D case. 
-    # Assume that 3D case is a function of time and space, not depth and space,
-    # unless zdim was included in keyword arguments. 
-    # Harder to assume that if zdim was not passed but the flooded 
-    # data has a z dimension longer than 1, so warn.
-    # If it is a function of time and space, drop the 
-    # depth dimension added by flood_kara.
-    if arr.ndim <= 3 and 'zdim' not in kwargs:
-        if 'z' in arr.dims and len(arr.z) > 1:
-            warnings.warn('flood_kara used the default name for the z dimension. Not dropping z dimension.')
-        else:
-            # flood_kara adds an undesired z=0, so drop it for 2D vars
-            flooded = flooded.isel(z=0).drop('z')
+    valid = np.frombuffer(valid_bytes, dtype=bool).reshape(shape)
+    valid = np.atleast_2d(valid)
+    nz, nx = valid.shape
+    x = np.broadcast_to(np.arange(nx), valid.shape)
+    # Horizontal: index of the next (bfill) or previous (ffill) valid point at each level.
+    if fill == 'b':
+        xsrc = np.minimum.accumulate(np.where(valid, x, nx)[:, ::-1], axis=1)[:, ::-1]
+        xfound = xsrc < nx
+    elif fill == 'f':
+        xsrc = np.maximum.accumulate(np.where(valid, x, -1), axis=1)
+        xfound = xsrc >= 0
+    # Vertical: points with no horizontal source take the source of the level above.
+    z = np.broadcast_to(np.arange(nz)[:, np.newaxis], valid.shape)
+    zsrc = np.maximum.accumulate(np.where(xfound, z, -1), axis=0)
+    found = zsrc >= 0
+    zsrc = np.where(found, zsrc, 0)
+    xsrc = np.where(found, xsrc[zsrc, np.arange(nx)], 0)
+    return (zsrc * nx + xsrc).ravel(), found.reshape(shape)
+
+
+def flood_missing(arr, xdim='lon', ydim='lat', zdim='z', nmax=1000):
+    """Flood missing data (over land) using the method of Kara et al. (2007) from HCtFlood
+    (https://github.com/raphaeldussin/HCtFlood): missing points with enough valid neighbours
+    are repeatedly set to the weighted mean of those neighbours until no data are missing.
+    Horizontal planes that have no valid data at all are left missing, as are points that 
+    cannot be reached (e.g. lakes with no valid data) or are not reached within nmax iterations.
+
+    The result is a lazy dask array: each level of zdim is flooded independently when it is computed 
+    (e.g. when it is written to file), so only one level of a lazily opened source is read at a time 
+    and the flooded data are never all held in memory. 
+    The order in which points are flooded and the neighbours they are flooded from 
+    are found once for each distinct mask of missing data (normally the same for all
+    variables and times on a level), and all data with that mask are flooded together.
+
+    Args:
+        arr (xarray.DataArray or xarray.Dataset): Data to be flooded. Variables without 
+            both xdim and ydim are returned unchanged.
+        xdim (str, optional): Name of the horizontal x dimension. Defaults to 'lon'.
+        ydim (str, optional): Name of the horizontal y dimension. Defaults to 'lat'.
+        zdim (str, optional): Name of the vertical dimension. Defaults to 'z'.
+        nmax (int, optional): Maximum number of flooding iterations. Defaults to 1000.
 
-    return flooded
+    Returns:
+        xarray.DataArray or xarray.Dataset: Flooded data (dask-backed), with the same dimensions as arr.
+    """
+    if isinstance(arr, xarray.Dataset):
+        return arr.map(flood_missing, keep_attrs=True, xdim=xdim, ydim=ydim, zdim=zdim, nmax=nmax)
+
+    if xdim not in arr.dims or ydim not in arr.dims:
+        return arr
+    other = [d for d in arr.dims if d not in (ydim, xdim)]
+    arr_t = arr.transpose(*other, ydim, xdim)
+    if arr_t.chunks is None:
+        # Wrap in dask one level at a time, without reading a lazily opened source.
+        arr_t = arr_t.chunk({d: 1 if d == zdim else -1 for d in arr_t.dims})
+    data = arr_t.data.rechunk({arr_t.ndim - 2: -1, arr_t.ndim - 1: -1})
+    flooded = data.map_blocks(_flood_array, dtype=data.dtype, nmax=nmax)
+    return arr_t.copy(data=flooded).transpose(*arr.dims)
+
+
+def _flood_array(data, nmax):
+    """Flood missing data in a numpy array whose last two axes are (y, x); see flood_missing."""
+    shape = data.shape[-2:]
+    flat = data.reshape((-1, shape[0] * shape[1])).astype('float64')
+    if len(flat) == 0:
+        return data
+    # Usually every slice has the same mask (e.g. all variables and times on a level), 
+    # so find the map once for each distinct mask.
+    valid = ~np.isnan(flat)
+    if (valid == valid[0]).all():
+        masks, group = valid[:1], np.zeros(len(flat), dtype=int)
+    else:
+        masks, group = np.unique(valid, axis=0, return_inverse=True)
+        group = group.ravel()
+    flooded = flat.copy()
+    for g, valid in enumerate(masks):
+        if valid.all() or not valid.any():
+            continue
+        i = np.flatnonzero(group == g) if len(masks) > 1 else slice(None)
+        field = np.where(valid, flat[i], 0.0)
+        waves, reached = _flood_map(valid.tobytes(), shape, nmax)
+        for targets, weights, total in waves:
+            # Every point in a wave is flooded from values as they were before the wave.
+            field[:, targets] = (weights @ field.T).T / total
+        field[:, ~reached] = np.nan
+        flooded[i] = field
+    return flooded.reshape(data.shape).astype(data.dtype, copy=False)
+
+
+@lru_cache(maxsize=64)
+def _flood_map(valid_bytes, shape, nmax):
+    """Find the order in which points are flooded and the neighbours they are flooded from.
+    As in HCtFlood, each iteration floods every missing point whose valid neighbours have a 
+    total weight of at least 3, where edge neighbours have weight 2 and corner neighbours weight 1.
+
+    Args:
+        valid_bytes (bytes): bytes of a boolean array that is True where data are not missing,
+            with dimensions (y, x). 
+        shape (tuple): shape of the boolean array.
+        nmax (int): maximum number of iterations.
+
+    Returns:
+        (list of (flat indices of the points flooded in an iteration, 
+            sparse matrix of the weight of each point in the (y, x) array for each flooded point, 
+            total weight for each flooded point), 
+        flat boolean array that is True where points are valid or were flooded)
+    """
+    ny, nx = shape
+    # Pad with a halo of missing points so that every point has eight neighbours.
+    pnx = nx + 2
+    valid = np.pad(np.frombuffer(valid_bytes, dtype=bool).reshape(shape), 1).ravel()
+    interior = np.pad(np.ones(shape, dtype=bool), 1).ravel()
+    index = np.pad(np.arange(ny * nx).reshape(shape), 1).ravel()
+    steps = np.array([-pnx-1, -pnx, -pnx+1, -1, 1, pnx-1, pnx, pnx+1])
+    weight = np.array([1, 2, 1, 2, 2, 1, 2, 1])
+
+    waves = []
+    new = np.flatnonzero(valid)
+    missing = ny * nx - len(new)
+    # Stop when no point has enough valid neighbours (any that are left cannot be reached).
+    while len(new) > 0 and missing > 0 and len(waves) < nmax:
+        # Only points next to ones that were just flooded can have gained valid neighbours.
+        candidates = np.unique((new[:, np.newaxis] + steps).ravel())
+        candidates = candidates[interior[candidates] & ~valid[candidates]]
+        neighbours = candidates[:, np.newaxis] + steps
+        c = weight * valid[neighbours]
+        total = c.sum(axis=1)
+        flood = total >= 3
+        new = candidates[flood]
+        if len(new) == 0:
+            break
+        c, neighbours = c[flood], neighbours[flood]
+        rows = np.broadcast_to(np.arange(len(new))[:, np.newaxis], c.shape)
+        use = c > 0
+        weights = csr_matrix(
+            (c[use].astype('float64'), (rows[use], index[neighbours[use]])), 
+            shape=(len(new), ny * nx)
+        )
+        waves.append((index[new], weights, total[flood].astype('float64')))
+        valid[new] = True
+        missing -= len(new)
+    return waves, valid[interior]
 
 
 def find_datavar(ds):
@@ -252,6 +420,8 @@ def z_to_dz(ds, max_depth=6500.):
 
     Returns: 
         xarray.DataArray: 3D <time, z, locations> array of thicknesses. 
+            Thickness only depends on z, so this is a lazy (dask) broadcast 
+            that is only expanded one time record at a time when written.
     """
     zi = 0.5 * (np.roll(ds['z'], shift=-1) + ds['z'])
     zi[-1] = max_depth
@@ -261,7 +431,7 @@ def z_to_dz(ds, max_depth=6500.):
     nt = len(ds['time'])
     nz = len(ds['z'])
     nx = len(ds['locations']) 
-    dz = np.tile(dz.data[np.newaxis, :, np.newaxis], (nt, 1, nx))
+    dz = dask.array.broadcast_to(np.asarray(dz)[np.newaxis, :, np.newaxis], (nt, nz, nx), chunks=(1, nz, nx))
     da_dz = xarray.DataArray(
         dz,
         coords=[
@@ -275,21 +445,816 @@ def z_to_dz(ds, max_depth=6500.):
     return da_dz
 
 
-def reuse_regrid(*args, **kwargs):
-    filename = kwargs.pop('filename', None)
-    reuse_weights = kwargs.pop('reuse_weights', False)
+def is_zarr(filename):
+    """Whether a path is a Zarr store (by its .zarr extension)."""
+    return str(filename).rstrip('/').endswith('.zarr')
 
-    if reuse_weights:
-        if path.isfile(filename):
-            return xesmf.Regridder(*args, reuse_weights=True, filename=filename, **kwargs)
+
+# Encoding that only applies to NetCDF (dropped when writing Zarr), 
+# or only to Zarr (dropped when exporting to NetCDF).
+_NETCDF_ENCODING = ['zlib', 'complevel', 'shuffle', 'fletcher32', 'contiguous', 'chunksizes', 'source', 'original_shape']
+_ZARR_ENCODING = ['chunks', 'preferred_chunks', 'compressor', 'compressors', 'filters', 'serializer', 'shards', 'fill_value',
+                  'source', 'original_shape']
+
+
+def write_dataset(ds, filename, format='NETCDF3_64BIT', encoding=None, unlimited_dims=None, append_dim=None):
+    """Write a dataset to a NetCDF file or, if format is 'zarr', to a Zarr store.
+
+    Zarr stores are meant for intermediate products. Each dask chunk of ds is written 
+    as a separate Zarr chunk (in parallel by dask), and a store can be appended to along append_dim 
+    without rewriting it. Use export_netcdf to convert stores to NetCDF3 for MOM6.
+
+    Args:
+        ds (xarray.Dataset): Dataset to write.
+        filename (str): NetCDF file or Zarr store (conventionally ending in .zarr) to write.
+        format (str, optional): NetCDF format, or 'zarr'. Defaults to 'NETCDF3_64BIT'.
+        encoding (dict, optional): Encoding for each variable. Options that only apply to NetCDF 
+            are ignored for Zarr.
+        unlimited_dims (optional): Unlimited dimensions (NetCDF only).
+        append_dim (str, optional): If given and the Zarr store exists, append to it along this dimension 
+            (Zarr only; the store's existing encoding is used).
+    """
+    if format == 'zarr':
+        ds = ds.copy()
+        for v in ds.variables:
+            ds[v].encoding = {k: e for k, e in ds[v].encoding.items() if k not in _NETCDF_ENCODING}
+        if append_dim is not None and path.exists(filename):
+            ds.to_zarr(filename, append_dim=append_dim)
         else:
-            regrid = xesmf.Regridder(*args, **kwargs)
-            regrid.to_netcdf(filename)
-            return regrid
+            encoding = {v: {k: e for k, e in enc.items() if k not in _NETCDF_ENCODING} for v, enc in (encoding or {}).items()}
+            ds.to_zarr(filename, mode='w', encoding=encoding)
     else:
-        regrid = xesmf.Regridder(*args, **kwargs)
+        ds.to_netcdf(filename, format=format, engine='netcdf4', encoding=encoding, unlimited_dims=unlimited_dims)
+
+
+def export_netcdf(stores, filename, format='NETCDF3_64BIT', adjust_timestamps=False, max_records=None):
+    """Export one or more Zarr stores, concatenated along time, to a NetCDF file (e.g. NETCDF3 for MOM6).
+    Data are read lazily and written a chunk at a time. Variables without a time dimension 
+    are taken from the first store. Times are converted to the units of the first store if the units differ.
+
+    Args:
+        stores (str or list of str): Zarr stores to export, in order.
+        filename (str): NetCDF file to write. Overwritten if it exists.
+        format (str, optional): NetCDF format of the output. Defaults to 'NETCDF3_64BIT'.
+        adjust_timestamps (bool, optional): Floor the first and ceil the last time 
+            to the start of a day (in the raw time units). Defaults to False.
+        max_records (int, optional): Only export this many time records in total. Defaults to exporting all.
+    """
+    if isinstance(stores, str):
+        stores = [stores]
+    parts = [xarray.open_zarr(s, decode_times=False) for s in stores]
+    units = parts[0]['time'].attrs.get('units')
+    calendar = parts[0]['time'].attrs.get('calendar', 'standard')
+    for i, part in enumerate(parts):
+        src_units = part['time'].attrs.get('units')
+        if src_units != units:
+            times = netCDF4.date2num(netCDF4.num2date(part['time'].values, src_units, calendar), units, calendar)
+            parts[i] = part.assign_coords(time=('time', times, {**part['time'].attrs, 'units': units}))
+    if len(parts) > 1:
+        ds = xarray.concat(parts, dim='time', data_vars='minimal', coords='minimal', compat='override')
+    else:
+        ds = parts[0]
+    if max_records is not None:
+        ds = ds.isel(time=slice(0, max_records))
+    if adjust_timestamps and len(ds['time']) > 1:
+        times = ds['time'].values.copy()
+        times[0] = np.floor(times[0])
+        times[-1] = np.ceil(times[-1])
+        ds = ds.assign_coords(time=('time', times, ds['time'].attrs))
+
+    encoding = {}
+    for v in ds.variables:
+        enc = {k: e for k, e in ds[v].encoding.items() if k not in _ZARR_ENCODING}
+        # Without an explicit _FillValue, xarray would add one that the original did not have
+        enc.setdefault('_FillValue', None)
+        # 64-bit integers are not supported in netCDF3
+        if format.startswith('NETCDF3') and enc.get('dtype', ds[v].dtype) == np.int64:
+            enc['dtype'] = 'int32'
+        encoding[v] = enc
+    ds.to_netcdf(filename, format=format, engine='netcdf4', encoding=encoding, unlimited_dims=['time'])
+
+
+def concatenate_netcdf(infiles, outfile, adjust_timestamps=False, chunk_size=100, format=None, max_records=None):
+    """Concatenate files along the unlimited time dimension, like ncrcat.
+    Records are streamed from each input file to the output in chunks, 
+    so only chunk_size records are held in memory at a time. 
+    Variables without a time dimension are copied from the first file.
+    Times are converted to the units of the first file if the units differ.
+    If the inputs are Zarr stores, they are exported with export_netcdf instead.
+
+    Args:
+        infiles (list of str): Files to concatenate, in order.
+        outfile (str): File to write. Overwritten if it exists.
+        adjust_timestamps (bool, optional): Floor the first and ceil the last time 
+            to the start of a day (in the raw time units). Defaults to False.
+        chunk_size (int, optional): Number of time records to copy at once. Defaults to 100.
+        format (str, optional): NetCDF format of the output. Defaults to the format of the first file.
+        max_records (int, optional): Stop after copying this many time records in total. Defaults to copying all.
+    """
+    if any(is_zarr(f) for f in infiles):
+        export_netcdf(infiles, outfile, format=format or 'NETCDF3_64BIT', adjust_timestamps=adjust_timestamps,
+                      max_records=max_records)
+        return
+    with netCDF4.Dataset(infiles[0]) as first, netCDF4.Dataset(outfile, 'w', format=format or first.data_model) as dst:
+        dst.set_auto_maskandscale(False)
+        dst.setncatts({a: first.getncattr(a) for a in first.ncattrs()})
+        for name, dim in first.dimensions.items():
+            dst.createDimension(name, None if dim.isunlimited() else len(dim))
+        for name, var in first.variables.items():
+            fill_value = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+            dtype = var.datatype
+            # 64-bit integers are not supported in netCDF3
+            if dst.data_model.startswith('NETCDF3') and dtype == np.int64:
+                dtype = np.int32
+            new = dst.createVariable(name, dtype, var.dimensions, fill_value=fill_value)
+            new.setncatts({a: var.getncattr(a) for a in var.ncattrs() if a != '_FillValue'})
+            if 'time' not in var.dimensions:
+                var.set_auto_maskandscale(False)
+                new[:] = var[:]
+        units = getattr(dst['time'], 'units', None)
+        calendar = getattr(dst['time'], 'calendar', 'standard')
+
+        start = 0
+        for f in infiles:
+            with netCDF4.Dataset(f) as src:
+                src.set_auto_maskandscale(False)
+                nt = len(src.dimensions['time'])
+                if max_records is not None:
+                    nt = max(min(nt, max_records - start), 0)
+                src_units = getattr(src['time'], 'units', None)
+                for i in range(0, nt, chunk_size):
+                    j = min(i + chunk_size, nt)
+                    for name, var in src.variables.items():
+                        if 'time' not in var.dimensions:
+                            continue
+                        data = var[i:j]
+                        if name == 'time' and src_units != units:
+                            data = netCDF4.date2num(netCDF4.num2date(data, src_units, calendar), units, calendar)
+                        dst[name][start+i:start+j] = data
+                start += nt
+
+        if adjust_timestamps and start > 1:
+            dst['time'][0] = np.floor(dst['time'][0])
+            dst['time'][start-1] = np.ceil(dst['time'][start-1])
+
+
+def encode_times(time, units, calendar='standard'):
+    """Encode times as numbers in the given units and calendar (e.g. those of a file being appended to).
+
+    Args:
+        time (xarray.DataArray): Times, either decoded (datetime64 or cftime) 
+            or numbers with their own units (and calendar) in attrs or encoding.
+        units (str): Units to encode with, e.g. 'days since 1993-01-01'.
+        calendar (str, optional): Calendar to encode with. Defaults to 'standard'.
+
+    Returns:
+        numpy.ndarray: Encoded times.
+    """
+    data = time.values
+    if np.issubdtype(data.dtype, np.datetime64):
+        dates = [d.astype('datetime64[us]').item() for d in data]
+    elif data.dtype == object:
+        dates = list(data)
+    else:
+        src_units = time.attrs.get('units', time.encoding.get('units'))
+        src_calendar = time.attrs.get('calendar', time.encoding.get('calendar', 'standard'))
+        if src_units is None:
+            raise ValueError(f'Numeric times without units cannot be converted to {units}')
+        if src_units == units and src_calendar == calendar:
+            return data
+        dates = netCDF4.num2date(data, src_units, src_calendar)
+    return netCDF4.date2num(dates, units, calendar)
+
+
+def truncate_netcdf(filename, nrecords):
+    """Keep only the first nrecords time records of a file (NetCDF files can't be shortened in place).
+
+    Args:
+        filename (str): File to truncate.
+        nrecords (int): Number of time records to keep.
+    """
+    fd, tmpfile = tempfile.mkstemp(suffix='.nc', dir=path.dirname(path.abspath(filename)))
+    os.close(fd)
+    concatenate_netcdf([filename], tmpfile, max_records=nrecords)
+    os.replace(tmpfile, filename)
+
+
+def run_tasks(func, tasks, workers=1, callback=None):
+    """Call func(*task) for each task, optionally in parallel over a pool of processes.
+    Tasks must be independent (e.g. write to different files). 
+    Results are returned in the same order as the tasks.
+
+    Args:
+        func: Function to call. Must be defined at the top level of a module so that it can be pickled.
+        tasks (list of tuple): Arguments for each call.
+        workers (int, optional): Number of processes to use. Defaults to 1 (serial, in this process).
+        callback (optional): Function called in this process as callback(index, result) 
+            as soon as each task finishes (e.g. to record progress).
+
+    Returns:
+        list: Result of each call.
+    """
+    results = [None] * len(tasks)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(func, *task): i for i, task in enumerate(tasks)}
+            for f in as_completed(futures):
+                i = futures[f]
+                results[i] = f.result()
+                if callback is not None:
+                    callback(i, results[i])
+    else:
+        for i, task in enumerate(tasks):
+            results[i] = func(*task)
+            if callback is not None:
+                callback(i, results[i])
+    return results
+
+
+def share_dataset(ds, filename, chunks=None):
+    """Write a dataset to file and reopen it lazily,
+    so that it can be passed to worker processes without copying the data.
+    Dask-backed variables are computed and written one chunk at a time.
+
+    Args:
+        ds (xarray.Dataset): Dataset to share.
+        filename (str): File to write.
+        chunks (dict, optional): Chunks to reopen the file with dask. Defaults to None (no dask).
+
+    Returns:
+        xarray.Dataset: File-backed dataset.
+    """
+    ds.to_netcdf(filename)
+    return xarray.open_dataset(filename, chunks=chunks)
+
+
+def _concatenate_job(infiles, outfile, kwargs):
+    print(f'Concatenating {len(infiles)} files into {outfile}')
+    concatenate_netcdf(infiles, outfile, **kwargs)
+
+
+def concatenate_all(jobs, workers=1, **kwargs):
+    """Run concatenate_netcdf for several independent outputs, optionally in parallel.
+
+    Args:
+        jobs (list): (infiles, outfile) pairs, typically one per segment and variable.
+        workers (int, optional): Number of processes to use. Defaults to 1 (serial).
+        **kwargs: additional keyword arguments passed to concatenate_netcdf.
+    """
+    run_tasks(_concatenate_job, [(infiles, outfile, kwargs) for infiles, outfile in jobs], workers=workers)
+
+
+class Manifest():
+    """Record of the work completed in an output directory, so that reruns can skip it.
+
+    Each entry is identified by a key (e.g. segment, variables and period) and stores
+    the size, modification time and (optionally) checksum of the input files, 
+    the size and modification time of the output files, and any settings that affect the output. 
+    Work is complete if the settings are the same, the outputs have not changed, 
+    and each input either has the same size and modification time or the same checksum.
+    The manifest is a JSON file that is rewritten atomically after each entry is recorded,
+    so it should only be written by one process at a time.
+
+    Args:
+        output_dir (str): Directory to keep the manifest in (created if needed).
+        name (str, optional): File name of the manifest. Defaults to 'obc_manifest.json'.
+        checksum (bool, optional): Whether to store sha256 checksums of the inputs. Defaults to True.
+    """
+
+    def __init__(self, output_dir, name='obc_manifest.json', checksum=True):
+        self.filename = path.join(output_dir, name)
+        self.checksum = checksum
+        self._checksums = {}
+        if path.isfile(self.filename):
+            with open(self.filename) as f:
+                self.entries = json.load(f)
+        else:
+            self.entries = {}
+
+    @staticmethod
+    def key(*parts):
+        """Key for a piece of work, e.g. Manifest.key('segment_001', ['thetao', 'so'], 1993)."""
+        return ':'.join('+'.join(map(str, p)) if isinstance(p, (list, tuple)) else str(p) for p in parts)
+
+    @staticmethod
+    def _files(filename):
+        # The files that make up a file or a directory store (e.g. Zarr), in a fixed order
+        if not path.isdir(filename):
+            return [filename]
+        return sorted(path.join(root, f) for root, _, files in os.walk(filename) for f in files)
+
+    @classmethod
+    def _stat(cls, filename):
+        # Total size and latest modification time of a file or directory store
+        stats = [os.stat(f) for f in cls._files(filename)]
+        return sum(st.st_size for st in stats), max((st.st_mtime for st in stats), default=0.0)
+
+    def sha256(self, filename):
+        """Checksum of a file or directory store, computed once per version."""
+        size, mtime = self._stat(filename)
+        version = (path.abspath(filename), mtime, size)
+        if version not in self._checksums:
+            h = hashlib.sha256()
+            for fname in self._files(filename):
+                if fname != filename:
+                    h.update(path.relpath(fname, filename).encode())
+                with open(fname, 'rb') as f:
+                    for block in iter(lambda: f.read(1 << 20), b''):
+                        h.update(block)
+            self._checksums[version] = h.hexdigest()
+        return self._checksums[version]
+
+    def file_info(self, filename, checksum=False):
+        """Size, modification time and (optionally) checksum of a file or directory store (e.g. Zarr), 
+        or None if it does not exist."""
+        if not path.exists(filename):
+            return None
+        size, mtime = self._stat(filename)
+        info = {'size': size, 'mtime': mtime}
+        if checksum and self.checksum:
+            info['sha256'] = self.sha256(filename)
+        return info
+
+    def unchanged(self, info, filename, checksum=False):
+        """Whether a file matches the info recorded for it."""
+        if info is None or not path.exists(filename):
+            return info is None and not path.exists(filename)
+        size, mtime = self._stat(filename)
+        if size != info['size']:
+            return False
+        if mtime == info['mtime']:
+            return True
+        return checksum and 'sha256' in info and self.sha256(filename) == info['sha256']
+
+    @staticmethod
+    def _settings(settings):
+        # Round trip through JSON so that settings compare equal to what was saved.
+        return json.loads(json.dumps(settings, sort_keys=True, default=str))
+
+    def is_complete(self, key, inputs, outputs=(), settings=None):
+        """Whether the work identified by key was completed with the same inputs, outputs and settings.
+
+        Args:
+            key (str): key of the work.
+            inputs (list of str): input files.
+            outputs (list of str, optional): output files, which must still exist unchanged.
+            settings (optional): JSON-serializable settings that affect the output.
+
+        Returns:
+            bool
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry['settings'] != self._settings(settings):
+            return False
+        if sorted(entry['inputs']) != sorted(inputs) or sorted(entry['outputs']) != sorted(outputs):
+            return False
+        return (
+            all(self.unchanged(entry['inputs'][f], f, checksum=True) for f in inputs)
+            and all(self.unchanged(entry['outputs'][f], f) for f in outputs)
+        )
+
+    def record(self, key, inputs, outputs=(), settings=None, **extra):
+        """Record that the work identified by key has been completed (see is_complete).
+        Any extra keyword arguments are stored with the entry."""
+        self.entries[key] = {
+            'inputs': {f: self.file_info(f, checksum=True) for f in inputs},
+            'outputs': {f: self.file_info(f) for f in outputs},
+            'settings': self._settings(settings),
+            'completed': datetime.now().isoformat(timespec='seconds'),
+            **extra
+        }
+        self.save()
+
+    def remove(self, key):
+        """Forget the work identified by key."""
+        if self.entries.pop(key, None) is not None:
+            self.save()
+
+    def save(self):
+        """Write the manifest to file, replacing the old one only once it is completely written."""
+        os.makedirs(path.dirname(path.abspath(self.filename)), exist_ok=True)
+        fd, tmpfile = tempfile.mkstemp(suffix='.json', dir=path.dirname(path.abspath(self.filename)))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmpfile, self.filename)
+
+
+def _lonlat_to_xyz(lon, lat):
+    """Convert longitude and latitude [degrees] to points on the unit sphere."""
+    lon = np.radians(lon)
+    lat = np.radians(lat)
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+def _wrap_lon(lon, lon0):
+    """Longitude relative to lon0, in [-180, 180)."""
+    return (np.asarray(lon) - lon0 + 180.) % 360. - 180.
+
+
+def target_lonlat(target):
+    """Get the longitudes and latitudes of a model grid or set of segments.
+
+    Args:
+        target: xarray Dataset from ocean_hgrid.nc (x, y), ocean_static.nc (geolon, geolat)
+            or with lon and lat; a Segment; or a list of Segments.
+
+    Returns:
+        (1D array of longitudes, 1D array of latitudes)
+    """
+    if isinstance(target, Segment):
+        target = [target]
+    if isinstance(target, (list, tuple)):
+        lon = np.concatenate([seg.coords['lon'].values.ravel() for seg in target])
+        lat = np.concatenate([seg.coords['lat'].values.ravel() for seg in target])
+        return lon, lat
+    for xname, yname in [('x', 'y'), ('geolon', 'geolat'), ('lon', 'lat')]:
+        if xname in target and yname in target:
+            return target[xname].values.ravel(), target[yname].values.ravel()
+    raise ValueError('Could not find longitude and latitude in target.')
+
+
+def _lon_range(lon):
+    """Smallest range of longitude that contains all of lon, as (western edge, width) [degrees]."""
+    lon = np.sort(np.unique(np.asarray(lon) % 360.))
+    gaps = np.diff(np.concatenate([lon, [lon[0] + 360.]]))
+    i = np.argmax(gaps)
+    west = lon[(i + 1) % len(lon)]
+    return west, 360. - gaps[i]
+
+
+def _window(needed, halo, periodic):
+    """Smallest (circular if periodic) run of indices that contains all needed indices, extended by halo."""
+    n = len(needed)
+    idx = np.flatnonzero(needed)
+    if periodic:
+        # Start after the largest gap between needed indices.
+        gaps = np.diff(np.concatenate([idx, [idx[0] + n]]))
+        i = np.argmax(gaps)
+        start = idx[(i + 1) % len(idx)]
+        length = n - gaps[i] + 1
+    else:
+        start = idx[0]
+        length = idx[-1] - idx[0] + 1
+    start -= halo
+    stop = start + length + 2 * halo
+    if periodic and stop - start >= n:
+        return slice(None)
+    if periodic and (start < 0 or stop > n):
+        return np.arange(start, stop) % n
+    return slice(int(max(start, 0)), int(min(stop, n)))
+
+
+def subset_indices(lon, lat, target, halo=1):
+    """Find the smallest window of a source grid that covers a model grid or set of segments.
+
+    Source cells within the range of the target longitude and latitude are kept,
+    plus one more cell on each side so that the target is bracketed, plus halo cells.
+    Source and target longitudes can be in 0-360 or -180-180. 
+    If the window crosses the edge of a global source grid, the longitude indices
+    wrap around and are returned as an integer array instead of a slice.
+
+    Args:
+        lon (xarray.DataArray): 1D or 2D source longitude.
+        lat (xarray.DataArray): 1D or 2D source latitude (with the same dimensions as lon if 2D).
+        target: model grid or segments; anything accepted by target_lonlat.
+        halo (int, optional): number of extra source cells to add on each side. Defaults to 1.
+
+    Returns:
+        dict: indices for each source horizontal dimension, to pass to isel.
+    """
+    tlon, tlat = target_lonlat(target)
+    west, width = _lon_range(tlon)
+    slon = np.asarray(lon.values, dtype='float64')
+    slat = np.asarray(lat.values, dtype='float64')
+    # Longitude relative to the western edge of the target.
+    rel = (slon - west) % 360.
+    inlon = (rel <= width) | np.isclose(rel, 360.)
+    inlat = (slat >= tlat.min()) & (slat <= tlat.max())
+    if slon.ndim == 1:
+        # Always include the cells nearest to the edges of the target.
+        inlon[np.argmin(np.minimum(rel, 360. - rel))] = True
+        inlon[np.argmin(np.abs(_wrap_lon(slon, west + width)))] = True
+        inlat[np.argmin(np.abs(slat - tlat.min()))] = True
+        inlat[np.argmin(np.abs(slat - tlat.max()))] = True
+        return {
+            lat.dims[0]: _window(inlat, halo + 1, periodic=False),
+            lon.dims[0]: _window(inlon, halo + 1, periodic=_spans_globe(slon))
+        }
+
+    inside = inlon & inlat
+    if not inside.any():
+        # The target is inside a single source cell.
+        distance = np.abs(_wrap_lon(slon, west + width / 2)) + np.abs(slat - tlat.mean())
+        inside.flat[np.nanargmin(distance)] = True
+    needed = [inside.any(axis=1), inside.any(axis=0)]
+    # Only the axis along which longitude changes can wrap around.
+    xaxis = int(np.argmax([np.nanmean(np.abs(_wrap_lon(np.diff(slon, axis=a), 0))) for a in (0, 1)]))
+    line = np.take(slon, np.argmax(needed[1 - xaxis]), axis=1 - xaxis)
+    periodic = _spans_globe(line)
+    return {
+        d: _window(needed[a], halo + 1, periodic=(periodic and a == xaxis))
+        for a, d in enumerate(lon.dims)
+    }
+
+
+def _spans_globe(lon):
+    """Whether a line of longitudes goes all the way around the globe."""
+    lon = np.degrees(np.unwrap(np.radians(lon)))
+    spacing = np.abs(np.diff(lon)).max() if len(lon) > 1 else 360.
+    return np.ptp(lon) + 1.5 * spacing >= 360.
+
+
+class LocstreamRegridder():
+    """Regrid from a source grid onto a stream of boundary points without xesmf.
+
+    Only the part of the source grid within a halo around the boundary points is used,
+    so building the weights scales with the size of the segment rather than the source grid,
+    and regridding reads only the source rows and columns near the boundary.
+    Nearest neighbours are found with a KD-tree on the unit sphere (the same 
+    distance that ESMF uses for nearest_s2d). Bilinear interpolation is supported
+    for sources with 1D lon and lat. 
+    The halo grows until every boundary point is matched, so the result 
+    does not depend on its initial size.
+
+    Called like an xesmf Regridder with locstream_out=True: the source horizontal 
+    dimensions are replaced by the dimension of the destination points.
+
+    Args:
+        source: xarray Dataset or DataArray on the source grid, containing 'lon' and 'lat'
+            (and optionally 'mask', with 0 for points to ignore).
+        dest: xarray Dataset with 1D destination 'lon' and 'lat'.
+        method (str, optional): 'nearest_s2d' or 'bilinear'. Defaults to 'nearest_s2d'.
+        periodic (bool, optional): Whether the source grid is periodic in longitude (used for bilinear).
+    """
+
+    methods = ['nearest_s2d', 'bilinear']
+
+    def __init__(self, source, dest, method='nearest_s2d', periodic=False):
+        if not self.supports(source, method):
+            raise ValueError(f'LocstreamRegridder does not support {method} for this source grid.')
+        self.method = method
+        self.periodic = periodic
+        slon = np.asarray(source['lon'].values, dtype='float64')
+        slat = np.asarray(source['lat'].values, dtype='float64')
+        if slon.ndim == 1:
+            self.in_dims = (source['lat'].dims[0], source['lon'].dims[0])
+        else:
+            self.in_dims = source['lon'].dims
+        mask = None
+        if 'mask' in source.coords or (isinstance(source, xarray.Dataset) and 'mask' in source):
+            mask = source['mask'].transpose(*self.in_dims).values != 0
+
+        self.locdim = dest['lon'].dims[0]
+        self.dest_lon = dest['lon'].values
+        self.dest_lat = dest['lat'].values
+        # Center of the segment, for cropping in longitude without worrying about 0-360 vs -180-180.
+        self._lon0 = np.degrees(np.angle(np.exp(1j * np.radians(self.dest_lon)).mean()))
+
+        halo = 2 * self._spacing(slon, slat)
+        while True:
+            ycrop, xcrop = self._crop(slon, slat, halo)
+            if method == 'nearest_s2d':
+                found = self._nearest(slon, slat, mask, ycrop, xcrop, halo)
+            else:
+                found = self._bilinear(slon, slat, ycrop, xcrop)
+            if found or halo >= 180.:
+                break
+            halo *= 2
+        self.ycrop = ycrop
+        self.xcrop = xcrop
+
+    @staticmethod
+    def supports(source, method):
+        """Whether a source grid and method can be regridded by LocstreamRegridder."""
+        if method == 'nearest_s2d':
+            return True
+        has_mask = 'mask' in source.coords or (isinstance(source, xarray.Dataset) and 'mask' in source)
+        return method == 'bilinear' and source['lon'].ndim == 1 and not has_mask
+
+    @staticmethod
+    def _spacing(slon, slat):
+        """Largest spacing between neighbouring source points [degrees]."""
+        spacing = [np.nanmax(np.abs(np.diff(slat, axis=a))) for a in range(slat.ndim) if slat.shape[a] > 1]
+        spacing += [np.nanmax(np.abs(_wrap_lon(np.diff(slon, axis=a), 0))) for a in range(slon.ndim) if slon.shape[a] > 1]
+        return max(spacing + [1e-3])
+
+    def _crop(self, slon, slat, halo):
+        """Find the rows and columns of the source grid within halo degrees of the segment."""
+        dlon = _wrap_lon(self.dest_lon, self._lon0)
+        latmin = self.dest_lat.min() - halo
+        latmax = self.dest_lat.max() + halo
+        # A longitude difference of lonhalo is at least halo degrees apart at any latitude in the band.
+        coslat = np.cos(np.radians(min(90., max(abs(latmin), abs(latmax)))))
+        ratio = np.sin(np.radians(halo) / 2) / coslat if coslat > 0 else np.inf
+        lonhalo = 2 * np.degrees(np.arcsin(ratio)) if ratio < 1 else 360.
+        inlat = (slat >= latmin) & (slat <= latmax)
+        rel = _wrap_lon(slon, self._lon0)
+        inlon = (rel >= dlon.min() - lonhalo) & (rel <= dlon.max() + lonhalo)
+        if slon.ndim == 1:
+            return np.flatnonzero(inlat), np.flatnonzero(inlon)
+        inside = inlat & inlon
+        return np.flatnonzero(inside.any(axis=1)), np.flatnonzero(inside.any(axis=0))
+
+    def _nearest(self, slon, slat, mask, ycrop, xcrop, halo):
+        if slon.ndim == 1:
+            lon, lat = np.meshgrid(slon[xcrop], slat[ycrop])
+        else:
+            lon, lat = slon[np.ix_(ycrop, xcrop)], slat[np.ix_(ycrop, xcrop)]
+        valid = np.isfinite(lon) & np.isfinite(lat)
+        if mask is not None:
+            valid &= mask[np.ix_(ycrop, xcrop)]
+        iy, ix = np.nonzero(valid)
+        if len(iy) == 0:
+            return False
+        tree = cKDTree(_lonlat_to_xyz(lon[iy, ix], lat[iy, ix]))
+        chord, i = tree.query(_lonlat_to_xyz(self.dest_lon, self.dest_lat))
+        distance = np.degrees(2 * np.arcsin(np.minimum(chord / 2, 1)))
+        self.iy = xarray.DataArray(iy[i], dims=self.locdim)
+        self.ix = xarray.DataArray(ix[i], dims=self.locdim)
+        self.weights = None
+        # Points outside the crop are at least halo degrees away, so the match is exact.
+        return bool((distance <= halo).all())
+
+    def _bilinear(self, slon, slat, ycrop, xcrop):
+        corners = []
+        for coord, dest, crop, is_lon in [(slat, self.dest_lat, ycrop, False), (slon, self.dest_lon, xcrop, True)]:
+            c = _wrap_lon(coord[crop], self._lon0) if is_lon else coord[crop]
+            d = _wrap_lon(dest, self._lon0) if is_lon else dest
+            order = np.argsort(c)
+            c = c[order]
+            if len(c) < 2:
+                return False
+            j = np.clip(np.searchsorted(c, d) - 1, 0, len(c) - 2)
+            t = (d - c[j]) / (c[j + 1] - c[j])
+            # Neighbours in the crop must also be neighbours on the source grid.
+            i0, i1 = crop[order][j], crop[order][j + 1]
+            adjacent = np.abs(i1 - i0) == 1
+            if is_lon and self.periodic:
+                adjacent |= np.abs(i1 - i0) == len(coord) - 1
+            inside = (t >= 0) & (t <= 1) & adjacent
+            corners.append((order[j], order[j + 1], t, inside))
+        (y0, y1, ty, iny), (x0, x1, tx, inx) = corners
+        found = iny & inx
+        dims = (self.locdim, 'corner')
+        self.iy = xarray.DataArray(np.stack([y0, y0, y1, y1], axis=-1), dims=dims)
+        self.ix = xarray.DataArray(np.stack([x0, x1, x0, x1], axis=-1), dims=dims)
+        weights = np.stack([(1 - ty) * (1 - tx), (1 - ty) * tx, ty * (1 - tx), ty * tx], axis=-1)
+        # Points outside the source grid are missing, to be filled later.
+        weights[~found] = np.nan
+        self.weights = xarray.DataArray(weights, dims=dims)
+        return bool(found.all())
+
+    def __call__(self, source):
+        if isinstance(source, xarray.Dataset):
+            return xarray.Dataset({
+                k: self(source[k]) for k in source.data_vars 
+                if k not in ['lon', 'lat', 'mask'] and set(self.in_dims) <= set(source[k].dims)
+            })
+        ydim, xdim = self.in_dims
+        # Read only the rows and columns near the segment, then gather the points.
+        cropped = source.isel({ydim: self.ycrop, xdim: self.xcrop})
+        cropped = cropped.drop_vars([c for c in cropped.coords if set(cropped[c].dims) & set(self.in_dims)])
+        dest = cropped.isel({ydim: self.iy, xdim: self.ix})
+        if self.weights is not None:
+            dest = (dest * self.weights).sum('corner', skipna=False)
+        dest = dest.transpose(..., self.locdim)
+        dest.attrs = {'regrid_method': self.method}
+        return dest.assign_coords(
+            lon=(self.locdim, self.dest_lon),
+            lat=(self.locdim, self.dest_lat)
+        )
+
+
+class RegridCache():
+    """Content-addressed cache of Regridders (xesmf, or optionally LocstreamRegridder).
+
+    Regridders are keyed by a hash of the source grid coordinates, the 
+    destination (segment) coordinates, the regridding method, the periodic flag
+    and any other options passed to xesmf.Regridder, so that any call that would produce identical weights can reuse them. 
+    Weights are kept in memory (least recently used are evicted first)
+    and, if a cache directory is given, on disk as xesmf weight files
+    so that they can be reused by later runs.
+
+    With engine='native', regridding onto a locstream with a method supported by 
+    LocstreamRegridder uses it instead of xesmf. These are cheap to build, 
+    so they are only cached in memory and never written to disk, even if persist is True.
+    The results differ from xesmf where a boundary point cannot be mapped: 
+    xesmf returns 0 there, while LocstreamRegridder (bilinear) returns NaN, 
+    which Segment fills like other missing data.
+
+    Attributes:
+        maxsize (int): maximum number of Regridders to keep in memory.
+        persist (bool): whether to read and write xesmf weight files on disk.
+        engine (str): default engine, 'xesmf' (the default) to always use xesmf, 
+            or 'native' to use LocstreamRegridder where possible.
+    """
+
+    def __init__(self, maxsize=32, persist=True, engine='xesmf'):
+        self.maxsize = maxsize
+        self.persist = persist
+        self.engine = engine
+        self._regridders = OrderedDict()
+
+    @staticmethod
+    def key(source, dest, method, periodic, kwargs=None):
+        """Hash the inputs that determine the regridding weights.
+
+        Args:
+            source: xarray Dataset or DataArray on the source grid, containing 'lon' and 'lat'
+                (and optionally 'mask').
+            dest: xarray Dataset with the destination 'lon' and 'lat'.
+            method (str): Method recognized by xesmf.
+            periodic (bool): Whether the source grid is periodic.
+            kwargs (dict, optional): other keyword arguments passed to xesmf.Regridder 
+                (e.g. locstream_out or extrap_method).
+
+        Returns:
+            str: hexadecimal digest identifying the weights.
+
+        Raises:
+            ValueError: if source or dest does not contain 'lon' and 'lat'.
+        """
+        h = hashlib.sha256()
+        for name, ds in [('source', source), ('dest', dest)]:
+            for v in ['lon', 'lat', 'mask']:
+                if v not in ds.coords and not (isinstance(ds, xarray.Dataset) and v in ds):
+                    if v == 'mask':
+                        continue
+                    raise ValueError(f'Regridding {name} has no {v}, so its weights cannot be cached')
+                arr = np.ascontiguousarray(ds[v].values, dtype='float64')
+                h.update(f'{v}{ds[v].dims}{arr.shape}'.encode())
+                h.update(arr.tobytes())
+        h.update(f'{method}:{bool(periodic)}'.encode())
+        h.update(json.dumps(kwargs or {}, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def get(self, source, dest, method='nearest_s2d', periodic=False, cache_dir=None, prefix='regrid', engine=None, **kwargs):
+        """Return a Regridder from source to dest, creating it only if matching weights are not cached.
+
+        Args:
+            source: xarray Dataset or DataArray on the source grid.
+            dest: xarray Dataset with the destination coordinates.
+            method (str, optional): Method recognized by xesmf. Defaults to 'nearest_s2d'.
+            periodic (bool, optional): Whether the source grid is periodic. Defaults to False.
+            cache_dir (str, optional): Directory to store weight files in. If None, weights are only cached in memory.
+            prefix (str, optional): Prefix for the weight file name. Defaults to 'regrid'.
+            engine (str, optional): 'xesmf' or 'native' (see RegridCache). Defaults to the engine of the cache.
+            **kwargs: additional keyword arguments passed to xesmf.Regridder.
+
+        Returns:
+            xesmf.Regridder or LocstreamRegridder
+        """
+        if engine is None:
+            engine = self.engine
+        if engine not in ['xesmf', 'native']:
+            raise ValueError(f'Unknown regridding engine {engine}')
+        native = engine == 'native' and kwargs.get('locstream_out') and LocstreamRegridder.supports(source, method)
+        key = self.key(source, dest, method, periodic, kwargs)
+        memory_key = f'{key}:native' if native else key
+        if memory_key in self._regridders:
+            self._regridders.move_to_end(memory_key)
+            return self._regridders[memory_key]
+
+        regrid = None
+        if native:
+            regrid = LocstreamRegridder(source, dest, method=method, periodic=periodic)
+        elif self.persist and cache_dir is not None:
+            filename = path.join(cache_dir, f'{prefix}_{method}_{key[:16]}.nc')
+            if path.isfile(filename):
+                regrid = xesmf.Regridder(source, dest, method=method, periodic=periodic, 
+                                         reuse_weights=True, filename=filename, **kwargs)
+            else:
+                regrid = xesmf.Regridder(source, dest, method=method, periodic=periodic, **kwargs)
+                # Write to a temporary file first so that concurrent jobs
+                # never read a partially written weight file.
+                fd, tmpfile = tempfile.mkstemp(suffix='.nc', dir=cache_dir)
+                os.close(fd)
+                regrid.to_netcdf(tmpfile)
+                os.replace(tmpfile, filename)
+        else:
+            regrid = xesmf.Regridder(source, dest, method=method, periodic=periodic, **kwargs)
+
+        self._regridders[memory_key] = regrid
+        if len(self._regridders) > self.maxsize:
+            self._regridders.popitem(last=False)
         return regrid
 
+    def clear(self):
+        """Remove all Regridders held in memory."""
+        self._regridders.clear()
+
+    def __getstate__(self):
+        # Regridders are not sent to other processes; they are reloaded from disk there.
+        return {'maxsize': self.maxsize, 'persist': self.persist, 'engine': self.engine}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+# Cache shared by all segments unless a segment is given its own.
+shared_regrid_cache = RegridCache()
+
+
 class Segment():
     """One segment of a MOM6 open boundary.
 
@@ -297,32 +1262,34 @@ class Segment():
     but here it is assumed that the segment spans an 
     entire north, south, east, or west border. 
 
+    Args:
+        hgrid: (xarray.Dataset) dataset from opening ocean_hgrid.nc. Contains 'x', 'y', and 'angle_dx'.
+            Only the row or column along the border is kept.
+        in_degrees: (bool): is angle_dx in hgrid in units of degrees (True) or radians (False)?
+
     Attributes:
         num (int): segment identification number following MOM6 order (1-4).
         border (str): which border of the model grid the segment represents (north, south, east, or west).
-        hgrid: (xarray.Dataset) dataset from opening ocean_hgrid.nc. Contains 'x', 'y', and 'angle_dx'.
-        in_degrees: (bool): is angle_dx in hgrid in units of degrees (True) or radians (False)?
         segstr (str): string identifying the segment, used in variable and file names.
         output_dir (str): location to write data for the segment, and location to store xesmf weight files.
         regrid_dir (str): location to save xesmf Regridders. Defaults to output_dir. 
+        regrid_cache (RegridCache): cache of Regridders shared between calls. Defaults to shared_regrid_cache.
+        regrid_engine (str): 'xesmf' or 'native' to regrid with LocstreamRegridder where it supports 
+            the method (see RegridCache for how the results differ). Defaults to the engine of regrid_cache,
+            which is 'xesmf' unless set otherwise.
         coords (xarray.Dataset): segment coordinates derived from hgrid (lon, lat, angle relative to true north).
         nx (int): Number of data points in the x direction.
         ny (int): Number of data points in the y direction.
     """
 
-    def __init__(self, num, border, hgrid, in_degrees=False, output_dir='.', regrid_dir=None):
+    def __init__(self, num, border, hgrid, in_degrees=False, output_dir='.', regrid_dir=None, regrid_cache=None,
+                 regrid_engine=None):
         self.num = num
         self.border = border
-        # Need to make a copy of hgrid so that the original is not modified multiple times 
-        # when creating multiple segments
-        self.hgrid = hgrid.copy(deep=True)
-        # Check if the angle_dx variable in ocean_hgrid has a 'units' attribute
-        angle_units = hgrid['angle_dx'].attrs.get('units', None)
-        # If the units attribute is degrees, or degrees were manually specified, convert to radians
-        if angle_units == 'degrees' or in_degrees:
-            print('Converting grid angle from degrees to radians')
-            self.hgrid['angle_dx'] = np.radians(self.hgrid['angle_dx'])
-        check_angle_range(self.hgrid['angle_dx'])
+        # Only the row or column of hgrid along the border is needed,
+        # so extract it once instead of keeping a copy of the whole supergrid.
+        self._coords = self.extract_coords(hgrid, in_degrees=in_degrees)
+        check_angle_range(self._coords['angle'])
         self.segstr = f'segment_{self.num:03d}'
         self.output_dir = output_dir
 
@@ -331,32 +1298,81 @@ class Segment():
         else:
             self.regrid_dir = regrid_dir            
 
-    @property
-    def coords(self):
+        if regrid_cache is None:
+            self.regrid_cache = shared_regrid_cache
+        else:
+            self.regrid_cache = regrid_cache
+        self.regrid_engine = regrid_engine
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # In another process, use that process's shared cache instead of a copy.
+        if self.regrid_cache is shared_regrid_cache:
+            state['regrid_cache'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.regrid_cache is None:
+            self.regrid_cache = shared_regrid_cache
+
+    def regridder(self, source, method='nearest_s2d', periodic=False):
+        """Get a Regridder from a source grid onto the segment, reusing cached weights when possible.
+
+        Args:
+            source: xarray Dataset or DataArray on the source grid.
+            method (str, optional): Method recognized by xesmf to use to regrid. Defaults to 'nearest_s2d'.
+            periodic (bool, optional): Whether the source grid is periodic (passed to xesmf). Defaults to False.
+
+        Returns:
+            xesmf.Regridder or LocstreamRegridder
+        """
+        return self.regrid_cache.get(
+            source,
+            self.coords,
+            method=method,
+            periodic=periodic,
+            cache_dir=self.regrid_dir,
+            prefix=f'regrid_{self.segstr}',
+            engine=self.regrid_engine,
+            locstream_out=True
+        )
+
+    def extract_coords(self, hgrid, in_degrees=False):
+        """Extract the segment coordinates from the supergrid.
+
+        Args:
+            hgrid (xarray.Dataset): dataset from opening ocean_hgrid.nc. Contains 'x', 'y', and 'angle_dx'.
+            in_degrees (bool, optional): is angle_dx in hgrid in units of degrees (True) or radians (False)?
+
+        Returns:
+            xarray.Dataset: segment lon, lat and angle (in radians), loaded into memory.
+        """
         if self.border == 'south':
-            return xarray.Dataset({
-                'lon': self.hgrid['x'].isel(nyp=0),
-                'lat': self.hgrid['y'].isel(nyp=0),
-                'angle': self.hgrid['angle_dx'].isel(nyp=0)
-            })
+            index = dict(nyp=0)
         elif self.border == 'north':
-            return xarray.Dataset({
-                'lon': self.hgrid['x'].isel(nyp=-1),
-                'lat': self.hgrid['y'].isel(nyp=-1),
-                'angle': self.hgrid['angle_dx'].isel(nyp=-1)
-            })
+            index = dict(nyp=-1)
         elif self.border == 'west':
-            return xarray.Dataset({
-                'lon': self.hgrid['x'].isel(nxp=0),
-                'lat': self.hgrid['y'].isel(nxp=0),
-                'angle': self.hgrid['angle_dx'].isel(nxp=0)
-            })
+            index = dict(nxp=0)
         elif self.border == 'east':
-            return xarray.Dataset({
-                'lon': self.hgrid['x'].isel(nxp=-1),
-                'lat': self.hgrid['y'].isel(nxp=-1),
-                'angle': self.hgrid['angle_dx'].isel(nxp=-1)
-            })
+            index = dict(nxp=-1)
+        coords = xarray.Dataset({
+            'lon': hgrid['x'].isel(**index),
+            'lat': hgrid['y'].isel(**index),
+            'angle': hgrid['angle_dx'].isel(**index)
+        }).load()
+        # Check if the angle_dx variable in ocean_hgrid has a 'units' attribute
+        angle_units = hgrid['angle_dx'].attrs.get('units', None)
+        # If the units attribute is degrees, or degrees were manually specified, convert to radians
+        if angle_units == 'degrees' or in_degrees:
+            print('Converting grid angle from degrees to radians')
+            coords['angle'] = np.radians(coords['angle'])
+        return coords
+
+    @property
+    def coords(self):
+        """Segment coordinates (lon, lat, angle relative to true north), extracted from hgrid when the segment was created."""
+        return self._coords
 
     @property
     def nx(self):
@@ -374,17 +1390,39 @@ class Segment():
         elif self.border in ['west', 'east']:
             return len(self.coords['lat'])
     
-    def to_netcdf(self, ds, varnames, suffix=None, additional_encoding=None):
+    def filename(self, varnames, suffix=None, format=None):
+        """Name of the file (or Zarr store, if format is 'zarr') that Segment.to_netcdf writes 
+        for the given variable name and suffix."""
+        ext = 'zarr' if format == 'zarr' else 'nc'
+        return f'{varnames}_{self.num:03d}_{suffix}.{ext}' if suffix is not None else f'{varnames}_{self.num:03d}.{ext}'
+
+    def to_netcdf(self, ds, varnames, suffix=None, additional_encoding=None, 
+                  format='NETCDF3_64BIT', complevel=None, time_chunk=None):
         """Write data for the segment to file.
 
         Args:
             ds (xarray.Dataset): Segment dataset.
             varnames (str): Name to give the file (e.g. 'temp', 'salt'). 
             suffix (str, optional): Optional suffix to append to the filename (before .nc). Defaults to None.
+            format (str, optional): NetCDF format of the file. MOM6 inputs should use the default 'NETCDF3_64BIT';
+                'NETCDF4' or 'NETCDF4_CLASSIC' can be used for intermediate files, or 'zarr' to write 
+                an intermediate Zarr store (see write_dataset). Defaults to 'NETCDF3_64BIT'.
+            complevel (int, optional): If given, compress data variables with zlib at this level (1-9).
+                Requires a NETCDF4 format. Zarr stores are always compressed with the Zarr default compressor.
+                Defaults to None (no compression).
+            time_chunk (int, optional): If given, write this many time records at a time, 
+                so that lazy (dask) data is only computed and held in memory one chunk at a time.
+                Defaults to None (write everything at once).
         """
+        if complevel is not None and not (format.startswith('NETCDF4') or format == 'zarr'):
+            raise ValueError(f'Compression requires a NETCDF4 format, but format is {format}.')
+        if time_chunk is not None:
+            ds = ds.chunk({'time': time_chunk})
         for v in ds:
             ds[v].encoding['_FillValue']= 1.0e20
-        fname = f'{varnames}_{self.num:03d}_{suffix}.nc' if suffix is not None else f'{varnames}_{self.num:03d}.nc'
+            if complevel is not None and format != 'zarr':
+                ds[v].encoding.update(zlib=True, complevel=complevel)
+        fname = self.filename(varnames, suffix, format=format)
         # Set format and attributes for coordinates, including time if it does not already have calendar attribute
         # (may change this to detect whether time is a time type or a float).
         # Need to include the fillvalue or it will be back to nan
@@ -405,14 +1443,47 @@ class Segment():
         # if additional_encoding is not None:
         #     encoding.update(additional_encoding)
         
-        ds.to_netcdf(
+        write_dataset(
+            ds,
             path.join(self.output_dir, fname),
-            format='NETCDF3_64BIT',
-            engine='netcdf4',
+            format=format,
             # encoding=encoding,
             unlimited_dims='time'
         )
 
+    def append_netcdf(self, ds, varnames, suffix=None, format='NETCDF3_64BIT'):
+        """Append data for the segment to a file along the time dimension.
+        If the file does not exist yet, it is created with Segment.to_netcdf.
+
+        Args:
+            ds (xarray.Dataset): Segment dataset.
+            varnames (str): Name to give the file (e.g. 'temp', 'salt'). 
+            suffix (str, optional): Optional suffix to append to the filename (before .nc). Defaults to None.
+            format (str, optional): NetCDF format of the file if it is created, or 'zarr' to append to a Zarr store.
+        """
+        fname = path.join(self.output_dir, self.filename(varnames, suffix, format=format))
+        if not path.exists(fname):
+            self.to_netcdf(ds, varnames, suffix=suffix, format=format)
+            return
+        if format == 'zarr':
+            write_dataset(ds, fname, format=format, append_dim='time')
+            return
+
+        with netCDF4.Dataset(fname, 'a') as nc:
+            start = len(nc.dimensions['time'])
+            stop = start + len(ds['time'])
+            for v in nc.variables:
+                if 'time' not in nc[v].dimensions:
+                    continue
+                if v == 'time':
+                    # Encode with the units and calendar already in the file
+                    if 'units' not in nc['time'].ncattrs():
+                        raise ValueError(f'time in {fname} has no units, so times cannot be appended')
+                    data = encode_times(ds['time'], nc['time'].units, getattr(nc['time'], 'calendar', 'standard'))
+                else:
+                    data = ds[v].values
+                nc[v][start:stop] = np.ma.masked_invalid(data)
+
     def expand_dims(self, ds):
         """Add a length-1 dimension to the variables in a boundary dataset or array.
         Named 'ny_segment_{self.segstr}' if the border runs west to east (a south or north boundary),
@@ -521,42 +1592,8 @@ class Segment():
 
         # Horizontally interpolate velocity to MOM boundary.
 
-        uregrid = reuse_regrid(
-            usource,
-            self.coords,
-            method=method,
-            locstream_out=True,
-            periodic=periodic,
-            filename=path.join(self.regrid_dir, f'regrid_{self.segstr}_u.nc'),
-            reuse_weights=False
-        )
-        vregrid = reuse_regrid(
-            vsource,
-            self.coords,
-            method=method,
-            locstream_out=True,
-            periodic=periodic,
-            filename=path.join(self.regrid_dir, f'regrid_{self.segstr}_v.nc'),
-            reuse_weights=False
-        )
-#        uregrid = xesmf.Regridder(
-#            usource,
-#            self.coords,
-#            method=method,
-#            locstream_out=True,
-#            periodic=periodic,
-#            filename=path.join(self.regrid_dir, f'regrid_{self.segstr}_u.nc'),
-#            reuse_weights=False
-#        )
-#        vregrid = xesmf.Regridder(
-#            vsource,
-#            self.coords,
-#            method=method,
-#            locstream_out=True,
-#            periodic=periodic,
-#            filename=path.join(self.regrid_dir, f'regrid_{self.segstr}_v.nc'),
-#            reuse_weights=False
-#        )
+        uregrid = self.regridder(usource, method=method, periodic=periodic)
+        vregrid = self.regridder(vsource, method=method, periodic=periodic)
         udest = uregrid(usource)
         vdest = vregrid(vsource)
 
@@ -623,7 +1660,7 @@ class Segment():
             self, tsource, 
             method='nearest_s2d', periodic=False, write=True, 
             flood=False, fill='b', xdim='lon', ydim='lat', zdim='z',
-            regrid_suffix='t', source_var=None, 
+            regrid_suffix=None, source_var=None, 
             time_attrs=None, time_encoding=None, **kwargs):
         """Regrid a tracer onto segment and (optionally) write to file.
 
@@ -637,14 +1674,18 @@ class Segment():
             xdim (str, optional): Name of the horizontal x dimension, needed if flooding. Defaults to 'lon'.
             ydim (str, optional): Name of the horizontal y dimension, needed if flooding. Defaults to 'lat'.
             zdim (str, optional): Name of the vertical dimension, needed if flooding. Defaults to 'z'.
-            regrid_suffix (str, optional): Suffix to add to xesmf weight file name. Useful when regridding multiple tracers from different datasets. 
-                Defaults to 't'.
+            regrid_suffix (str, optional): Deprecated and ignored. Regridders are now cached by the content 
+                of the source grid (see RegridCache), so tracers from different datasets no longer need 
+                differently named weight files.
             source_var (str, optional): If tsource is a dataset, this is the variable to regrid.
             **kwargs: additional keyword arguments passed to Segment.to_netcdf().
 
         Returns:
             xarray.Dataset: Dataset of regridded boundary data.
         """
+        if regrid_suffix is not None:
+            warnings.warn('regrid_suffix is deprecated and ignored; regridders are cached by source grid content.', 
+                          DeprecationWarning, stacklevel=2)
         if source_var is None:
             name = tsource.name
             if flood:
@@ -654,17 +1695,89 @@ class Segment():
             if flood:
                 tsource[name] = flood_missing(tsource[name], xdim=xdim, ydim=ydim, zdim=zdim).load()
 
-        regrid = reuse_regrid(
-            tsource,
-            self.coords,
-            method=method,
-            locstream_out=True,
-            periodic=periodic,
-            filename=path.join(self.regrid_dir, f'regrid_{self.segstr}_{regrid_suffix}.nc'),
-            reuse_weights=False
-        )
+        regrid = self.regridder(tsource, method=method, periodic=periodic)
         tdest = regrid(tsource)
 
+        tdest = self.format_tracer(tdest, name, 'z' in tsource.coords, fill=fill,
+                                   time_attrs=time_attrs, time_encoding=time_encoding)
+
+        if write:
+            self.to_netcdf(tdest, name, **kwargs)
+        
+        return tdest
+
+    def regrid_tracers(
+            self, tsource, varnames,
+            method='nearest_s2d', periodic=False, write=True, combine=False, combined_name='tracers',
+            flood=False, fill='b', xdim='lon', ydim='lat', zdim='z',
+            time_attrs=None, time_encoding=None, **kwargs):
+        """Regrid several tracers that share one source grid onto the segment and (optionally) write to file.
+        A single regridder is built for all of the tracers, and tracers with the same dimensions
+        are stacked and regridded together in one pass.
+
+        Args:
+            tsource (xarray.Dataset): Dataset containing the tracers on the source grid.
+            varnames (list of str): Names of the tracers in tsource to regrid.
+            method (str, optional): Method recognized by xesmf to use to regrid. Defaults to 'nearest_s2d'.
+            periodic (bool, optional): Whether the source grid is periodic (passed to xesmf). Defaults to False.
+            write (bool, optional): After regridding, write the results to file. Defaults to True.
+            combine (bool, optional): Write all tracers to one file named combined_name instead of 
+                one file per tracer. Defaults to False.
+            combined_name (str, optional): Name to give the combined file. Defaults to 'tracers'.
+            flood (bool, optional): As the first step of regridding, horizontally flood the source data. Defaults to False.
+            fill (str, optional): Method to use for filling data horizontally (b for bfill or f for ffill).
+            xdim (str, optional): Name of the horizontal x dimension, needed if flooding. Defaults to 'lon'.
+            ydim (str, optional): Name of the horizontal y dimension, needed if flooding. Defaults to 'lat'.
+            zdim (str, optional): Name of the vertical dimension, needed if flooding. Defaults to 'z'.
+            **kwargs: additional keyword arguments passed to Segment.to_netcdf().
+
+        Returns:
+            dict: Dataset of regridded boundary data for each tracer, keyed by tracer name.
+        """
+        tsource = tsource[list(varnames)]
+        if flood:
+            # Load once, rather than flooding again for each group and tracer that is written.
+            tsource = flood_missing(tsource, xdim=xdim, ydim=ydim, zdim=zdim).load()
+
+        regrid = self.regridder(tsource, method=method, periodic=periodic)
+
+        # Group tracers by dimensions so that each group can be regridded as one stacked array.
+        groups = {}
+        for name in varnames:
+            groups.setdefault(tsource[name].dims, []).append(name)
+
+        results = {}
+        for dims, names in groups.items():
+            stacked = tsource[names].to_array(dim='variable')
+            dest = regrid(stacked)
+            for name in names:
+                tdest = dest.sel(variable=name, drop=True)
+                results[name] = self.format_tracer(tdest, name, 'z' in dims, fill=fill,
+                                                   time_attrs=time_attrs, time_encoding=time_encoding)
+
+        if write:
+            if combine:
+                self.to_netcdf(xarray.merge([results[name] for name in varnames]), combined_name, **kwargs)
+            else:
+                for name in varnames:
+                    self.to_netcdf(results[name], name, **kwargs)
+
+        return results
+
+    def format_tracer(self, tdest, name, has_z, fill='b', time_attrs=None, time_encoding=None):
+        """Fill, reorder and rename a tracer that has been regridded onto the segment.
+
+        Args:
+            tdest (xarray.DataArray or xarray.Dataset): Output of the regridder.
+            name (str): Name of the tracer.
+            has_z (bool): Whether the tracer has a vertical dimension 'z'.
+            fill (str, optional): Method to use for filling data horizontally (b for bfill or f for ffill).
+            time_attrs (dict, optional): Attributes to restore on time.
+            time_encoding (dict, optional): Encoding to restore on time.
+
+        Returns:
+            xarray.Dataset: Dataset of boundary data ready to be written.
+        """
         if not isinstance(tdest, xarray.Dataset):
             tdest.name = name
             tdest = tdest.to_dataset()
@@ -672,7 +1785,7 @@ class Segment():
         xname = [x for x in tdest.dims][-1]
         tdest = tdest.rename({xname: 'locations'})
 
-        if 'z' in tsource.coords:
+        if has_z:
             tdest = fill_missing(tdest, fill=fill)
             # Need to transpose so that time is first,
             # so that it can be the unlimited dimension
@@ -699,10 +1812,6 @@ class Segment():
             tdest['time'].attrs = time_attrs
         if time_encoding:
             tdest['time'].encoding = time_encoding
-        
-        if write:
-            self.to_netcdf(tdest, name, **kwargs)
-        
         return tdest
 
     def regrid_tidal_elevation(
@@ -733,20 +1842,11 @@ class Segment():
             imname = find_datavar(imsource)
             # Don't want to do this lazily, but there is a weird dimension mismatch error 
             # when using .compute() or .load(), so use .values.
-            # Also, use "constituent" as the time dimension.
-            resource[rename] = (resource[rename].dims, flood_missing(resource[rename], xdim=xdim, ydim=ydim, tdim='constituent').values)
-            imsource[imname] = (imsource[imname].dims, flood_missing(imsource[imname], xdim=xdim, ydim=ydim, tdim='constituent').values)
+            resource[rename] = (resource[rename].dims, flood_missing(resource[rename], xdim=xdim, ydim=ydim).values)
+            imsource[imname] = (imsource[imname].dims, flood_missing(imsource[imname], xdim=xdim, ydim=ydim).values)
 
         # Horizontally interpolate elevation components
-        regrid = reuse_regrid(
-            resource,
-            self.coords,
-            method=method,
-            locstream_out=True,
-            periodic=periodic,
-            filename=path.join(self.regrid_dir, f'regrid_{self.segstr}_tidal_elev.nc'),
-            reuse_weights=False
-        )
+        regrid = self.regridder(resource, method=method, periodic=periodic)
         redest = regrid(resource)
         imdest = regrid(imsource)
 
@@ -823,86 +1923,59 @@ class Segment():
             print('Flooding')
             # Don't want to do this lazily, but there is a weird dimension mismatch error 
             # when using .compute() or .load(), so use .values.
-            # Use "constituent" as the time dimension.
-            uresource[urename] = (uresource[urename].dims, flood_missing(uresource[urename], xdim=xdim, ydim=ydim, tdim='constituent').values)
-            uimsource[uimname] = (uimsource[uimname].dims, flood_missing(uimsource[uimname], xdim=xdim, ydim=ydim, tdim='constituent').values)
+            uresource[urename] = (uresource[urename].dims, flood_missing(uresource[urename], xdim=xdim, ydim=ydim).values)
+            uimsource[uimname] = (uimsource[uimname].dims, flood_missing(uimsource[uimname], xdim=xdim, ydim=ydim).values)
             #TODO: BUG: should be vresource and vimsource 
-            vresource[vrename] = (vresource[vrename].dims, flood_missing(vresource[vrename], xdim=xdim, ydim=ydim, tdim='constituent').values)
-            vimsource[vimname] = (vimsource[vimname].dims, flood_missing(vimsource[vimname], xdim=xdim, ydim=ydim, tdim='constituent').values)
+            vresource[vrename] = (vresource[vrename].dims, flood_missing(vresource[vrename], xdim=xdim, ydim=ydim).values)
+            vimsource[vimname] = (vimsource[vimname].dims, flood_missing(vimsource[vimname], xdim=xdim, ydim=ydim).values)
 
         print('Setting up regridders')
-        regrid_u = reuse_regrid(
-            uresource,
-            self.coords,
-            method=method,
-            locstream_out=True,
-            periodic=periodic,
-            filename=path.join(self.regrid_dir, f'regrid_{self.segstr}_tidal_u.nc'),
-            reuse_weights=False
-        )
-
-        regrid_v = reuse_regrid(
-            vresource,
-            self.coords,
-            method=method,
-            locstream_out=True,
-            periodic=periodic,
-            filename=path.join(
-                self.regrid_dir, f'regrid_{self.segstr}_tidal_v.nc'),
-            reuse_weights=False
-        )
+        regrid_u = self.regridder(uresource, method=method, periodic=periodic)
+        regrid_v = self.regridder(vresource, method=method, periodic=periodic)
 
         print('Regridding')
-        # Interpolate each real and imaginary parts to segment.
-        uredest = regrid_u(uresource)[urename]
-        uimdest = regrid_u(uimsource)[uimname]
-        vredest = regrid_v(vresource)[vrename]
-        vimdest = regrid_v(vimsource)[vimname]
+        # Interpolate the real and imaginary parts stacked as one array,
+        # using a single pass if u and v are on the same grid.
+        parts = ['uRe', 'uIm', 'vRe', 'vIm']
+        usource = xarray.concat([uresource[urename], uimsource[uimname]], dim='part')
+        vsource = xarray.concat([vresource[vrename], vimsource[vimname]], dim='part')
+        if regrid_u is regrid_v:
+            dest = regrid_u(xarray.concat([usource, vsource], dim='part'))
+        else:
+            dest = xarray.concat([regrid_u(usource), regrid_v(vsource)], dim='part')
 
         # todo: consolidate this
-        xname = [x for x in uredest.dims][-1]
-        uredest = uredest.rename({xname: 'locations'})
-        uimdest = uimdest.rename({xname: 'locations'})
-        vredest = vredest.rename({xname: 'locations'})
-        vimdest = vimdest.rename({xname: 'locations'})
+        xname = [x for x in dest.dims][-1]
+        dest = dest.rename({xname: 'locations'}).assign_coords(part=parts)
         
         print('Refilling missing data')
-        # Fill missing data.
+        # Fill missing data in all four parts at once.
         # Need to do this first because complex would get converted to real
-        uredest = fill_missing(uredest, zdim=None)
-        uimdest = fill_missing(uimdest, zdim=None)
-        vredest = fill_missing(vredest, zdim=None)
-        vimdest = fill_missing(vimdest, zdim=None)
+        dest = fill_missing(dest, zdim=None)
 
         # Convert to complex, remaining separate for u and v.
-        ucplex = uredest + 1j * uimdest
-        vcplex = vredest + 1j * vimdest
+        ucplex = dest.sel(part='uRe', drop=True) + 1j * dest.sel(part='uIm', drop=True)
+        vcplex = dest.sel(part='vRe', drop=True) + 1j * dest.sel(part='vIm', drop=True)
 
         print('Rotating')
-        # Convert complex u and v to ellipse,
-        # rotate ellipse from earth-relative to model-relative,
-        # and convert ellipse back to amplitude and phase.
-        # There is probably a complicated trig identity for this? But
-        # this works too. 
+        # Rotating the complex amplitudes from earth-relative to model-relative
+        # is the same as rotating the tidal ellipse by the grid angle.
+        # Requries that angle is in radians.
         if self.border in ['south', 'north']:
             angle = self.coords['angle'].rename({'nxp': 'locations'})
         elif self.border in ['west', 'east']:
             angle = self.coords['angle'].rename({'nyp': 'locations'})
-        SEMA, ECC, INC, PHA = ap2ep(ucplex, vcplex)
-
-        # Rotate to the model grid by adjusting the inclination.
-        # Requries that angle is in radians.
-        # INC is np array but angle is xarray
-        INC -= angle.data[np.newaxis, :]
-        ua, va, up, vp = ep2ap(SEMA, ECC, INC, PHA)
+        ucplex, vcplex = rotate_uv(ucplex, vcplex, angle)
+        ucplex = ucplex.transpose('constituent', 'locations')
+        vcplex = vcplex.transpose('constituent', 'locations')
 
         ds_ap = xarray.Dataset({
-            f'uamp_{self.segstr}': ua,
-            f'vamp_{self.segstr}': va
+            f'uamp_{self.segstr}': np.abs(ucplex),
+            f'vamp_{self.segstr}': np.abs(vcplex)
         })
-        # up, vp aren't dataarrays
-        ds_ap[f'uphase_{self.segstr}'] =  (('constituent', 'locations'), up)  # radians
-        ds_ap[f'vphase_{self.segstr}'] =  (('constituent', 'locations'), vp)  # radians
+        # np.angle doesn't return dataarray
+        ds_ap[f'uphase_{self.segstr}'] =  (('constituent', 'locations'), -1 * np.angle(ucplex.values))  # radians
+        ds_ap[f'vphase_{self.segstr}'] =  (('constituent', 'locations'), -1 * np.angle(vcplex.values))  # radians
 
         ds_ap, _ = xarray.broadcast(ds_ap, time)
 
@@ -910,9 +1983,6 @@ class Segment():
         # so that it can be the unlimited dimension
         ds_ap = ds_ap.transpose('time', 'constituent', 'locations')
 
-        # Some things may have become missing during the transformation
-        ds_ap = fill_missing(ds_ap, zdim=None)
-
         ds_ap = self.expand_dims(ds_ap)
         ds_ap['lon'] = (('locations', ), self.coords['lon'].data)
         ds_ap['lat'] = (('locations', ), self.coords['lat'].data)
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+"""
+Export intermediate Zarr stores (written with format or intermediate_format 'zarr')
+to a NETCDF3_64BIT file for MOM6. Multiple stores are concatenated along time.
+How to use:
+./export_zarr.py store1.zarr [store2.zarr ...] -o output.nc [--adjust_timestamps]
+"""
+import argparse
+from boundary import export_netcdf
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export Zarr stores to NetCDF for MOM6')
+    parser.add_argument('stores', nargs='+', help='Zarr stores to export, in time order')
+    parser.add_argument('-o', '--output', required=True, help='NetCDF file to write')
+    parser.add_argument('--format', default='NETCDF3_64BIT', help='NetCDF format of the output')
+    parser.add_argument('--adjust_timestamps', action='store_true',
+                        help='Floor the first and ceil the last time to the start of a day')
+    args = parser.parse_args()
+
+    export_netcdf(args.stores, args.output, format=args.format, adjust_timestamps=args.adjust_timestamps)
+
+
+if __name__ == '__main__':
+    main()
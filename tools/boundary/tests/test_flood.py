@@ -0,0 +1,109 @@
+"""Flooding of missing data over land (flood_missing), compared with HCtFlood's method."""
+import os
+import sys
+
+import numpy as np
+import pytest
+import xarray
+
+pytest.importorskip('xesmf')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from boundary import flood_missing  # noqa: E402
+
+
+def flood_kara_raw(field, nmax=1000):
+    """Flood one (y, x) plane as HCtFlood's flood_kara_raw does, except that points that cannot be flooded
+    (or are not flooded within nmax iterations) are left missing instead of raising an error."""
+    ny, nx = field.shape
+    z = np.pad(np.where(np.isnan(field), 0.0, field), 1)
+    m = np.pad(~np.isnan(field), 1).astype('float64')
+    # Neighbours in the same order as in HCtFlood, with weight 2 for edges and 1 for corners.
+    neighbours = [(-1, -1, 1), (-1, 0, 2), (-1, 1, 1), (0, -1, 2), (0, 1, 2), (1, -1, 1), (1, 0, 2), (1, 1, 1)]
+    for _ in range(nmax):
+        total = np.zeros((ny, nx))
+        weighted = np.zeros((ny, nx))
+        for dy, dx, w in neighbours:
+            c = w * m[1+dy:ny+1+dy, 1+dx:nx+1+dx]
+            total = total + c
+            weighted = weighted + c * z[1+dy:ny+1+dy, 1+dx:nx+1+dx]
+        flood = (m[1:-1, 1:-1] == 0) & (total >= 3)
+        if not flood.any():
+            break
+        z[1:-1, 1:-1][flood] = weighted[flood] / total[flood]
+        m[1:-1, 1:-1][flood] = 1
+    return np.where(m[1:-1, 1:-1] == 1, z[1:-1, 1:-1], np.nan)
+
+
+def land_mask(ny, nx, seed):
+    """A coastline-like land mask: smoothed noise above a threshold."""
+    from scipy.ndimage import gaussian_filter
+    rng = np.random.default_rng(seed)
+    return gaussian_filter(rng.standard_normal((ny, nx)), 3) > 0
+
+
+def sample_levels(nz=4, ny=30, nx=40):
+    """Data on levels with increasingly large land masks. The deepest level has only a few isolated wet points,
+    which cannot flood the points around them (a point next to one has a total weight of 2, or 1 if it
+    touches it at a corner, short of the 3 needed), so the rest of that level cannot be flooded."""
+    rng = np.random.default_rng(1)
+    data = rng.standard_normal((nz, ny, nx)) + 10
+    land = land_mask(ny, nx, 0)
+    for k in range(nz - 1):
+        data[k, land] = np.nan
+        land = land | np.roll(land, 1, axis=1) | np.roll(land, 1, axis=0)
+    deep = np.full((ny, nx), np.nan)
+    for j, i in [(3, 3), (10, 20), (20, 5), (25, 30)]:
+        deep[j, i] = data[-1, j, i]
+    data[-1] = deep
+    return data
+
+
+def test_flood_matches_hctflood():
+    data = sample_levels()
+    flooded = flood_missing(xarray.DataArray(data, dims=('z', 'lat', 'lon'))).values
+    for k in range(len(data)):
+        np.testing.assert_array_equal(flooded[k], flood_kara_raw(data[k]))
+    # Points that cannot be reached are left missing (instead of raising an error),
+    # and valid data are unchanged.
+    valid = ~np.isnan(data)
+    np.testing.assert_array_equal(np.isnan(flooded[-1]), ~valid[-1])
+    assert not np.isnan(flooded[:-1]).any()
+    np.testing.assert_array_equal(flooded[valid], data[valid])
+
+
+def test_flood_nmax():
+    data = sample_levels()[0]
+    flooded = flood_missing(xarray.DataArray(data, dims=('lat', 'lon')), nmax=3).values
+    np.testing.assert_array_equal(flooded, flood_kara_raw(data, nmax=3))
+    assert np.isnan(flooded).any()
+
+
+def test_flood_dataset_lazy(tmp_path):
+    data = sample_levels()
+    nz, ny, nx = data.shape
+    ds = xarray.Dataset(
+        {
+            'temp': (('time', 'z', 'lat', 'lon'), np.stack([data, data + 1]).astype('float32'), {'units': 'C'}),
+            'salt': (('lon', 'z', 'lat'), data.transpose(2, 0, 1)),
+            'ssh': (('lat', 'lon'), data[0]),
+            'level': (('z', ), np.arange(nz)),
+        },
+        coords={'z': np.arange(nz) * 10.0, 'lat': np.arange(ny), 'lon': np.arange(nx)}
+    )
+    filename = str(tmp_path / 'source.nc')
+    ds.to_netcdf(filename)
+    with xarray.open_dataset(filename) as source:
+        flooded = flood_missing(source)
+        # Nothing is flooded (or read) until the result is computed, one level at a time.
+        assert flooded['temp'].chunks == ((2, ), (1, ) * nz, (ny, ), (nx, ))
+        flooded = flooded.load()
+    assert list(flooded.data_vars) == list(ds.data_vars)
+    assert flooded['temp'].dtype == np.float32 and flooded['temp'].attrs == {'units': 'C'}
+    for v in ['temp', 'salt', 'ssh']:
+        assert flooded[v].dims == ds[v].dims
+    expected = np.stack([flood_kara_raw(level) for level in data])
+    np.testing.assert_array_equal(flooded['salt'].transpose('z', 'lat', 'lon').values, expected)
+    np.testing.assert_array_equal(flooded['ssh'].values, expected[0])
+    temp = ds['temp'].values[1].astype('float64')
+    np.testing.assert_array_equal(flooded['temp'].values[1], np.stack([flood_kara_raw(level) for level in temp]).astype('float32'))
+    np.testing.assert_array_equal(flooded['level'].values, ds['level'].values)
@@ -0,0 +1,83 @@
+"""Round trip of boundary data through Zarr stores: write_dataset, appending, and export to NetCDF3 for MOM6."""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray
+
+pytest.importorskip('zarr')
+pytest.importorskip('xesmf')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from boundary import concatenate_netcdf, write_dataset  # noqa: E402
+import export_zarr  # noqa: E402
+from write_glorys_boundary import ncrcat_years  # noqa: E402
+
+
+def segment_data(start, ntime=3, units='days since 1993-01-01'):
+    time = pd.date_range(start, periods=ntime, freq='D')
+    rng = np.random.default_rng(time[0].dayofyear)
+    ds = xarray.Dataset(
+        {
+            'temp_segment_001': (('time', 'nz_segment_001', 'nx_segment_001'), rng.standard_normal((ntime, 2, 4))),
+            'lon_segment_001': (('nx_segment_001', ), np.linspace(280, 281, 4)),
+        },
+        coords={'time': time}
+    )
+    ds['time'].encoding = {'units': units, 'calendar': 'gregorian'}
+    return ds
+
+
+def test_write_dataset_zarr(tmp_path):
+    ds = segment_data('1993-01-01')
+    store = str(tmp_path / 'temp_001_1993.zarr')
+    # NetCDF-only encoding is dropped for Zarr
+    write_dataset(ds, store, format='zarr', encoding={'temp_segment_001': {'zlib': True, 'complevel': 4}})
+    xarray.testing.assert_identical(xarray.open_zarr(store).load(), ds)
+
+    more = segment_data('1993-01-04')
+    write_dataset(more, store, format='zarr', append_dim='time')
+    expected = xarray.concat([ds, more], dim='time', data_vars='minimal')
+    xarray.testing.assert_identical(xarray.open_zarr(store).load(), expected)
+
+
+def test_export_zarr(tmp_path, monkeypatch):
+    first = segment_data('1993-01-01')
+    second = segment_data('1993-01-04', units='hours since 1990-01-01')
+    stores = [str(tmp_path / 'temp_001_1993.zarr'), str(tmp_path / 'temp_001_1994.zarr')]
+    write_dataset(first, stores[0], format='zarr')
+    write_dataset(second, stores[1], format='zarr')
+
+    output = str(tmp_path / 'temp_001.nc')
+    monkeypatch.setattr(sys, 'argv', ['export_zarr.py', *stores, '-o', output])
+    export_zarr.main()
+
+    expected = xarray.concat([first, second], dim='time', data_vars='minimal')
+    with xarray.open_dataset(output) as exported:
+        xarray.testing.assert_allclose(exported.load(), expected)
+        assert exported.encoding['unlimited_dims'] == {'time'}
+        # Times are converted to the units of the first store
+        assert exported['time'].encoding['units'] == 'days since 1993-01-01'
+    with xarray.open_dataset(output, decode_times=False) as raw:
+        np.testing.assert_array_equal(raw['time'].values, np.arange(6))
+
+    # concatenate_netcdf exports Zarr inputs the same way
+    concatenated = str(tmp_path / 'temp_001_concatenated.nc')
+    concatenate_netcdf(stores, concatenated, max_records=4)
+    with xarray.open_dataset(concatenated) as ds:
+        xarray.testing.assert_allclose(ds.load(), expected.isel(time=slice(0, 4)))
+
+
+@pytest.mark.parametrize('format', ['zarr', 'NETCDF3_64BIT'])
+def test_ncrcat_years_uses_configured_format(tmp_path, format):
+    # Annual files from an earlier run in the other format are left alone.
+    zarr_data, netcdf_data = segment_data('1993-01-01'), segment_data('1994-01-01')
+    write_dataset(zarr_data, str(tmp_path / 'temp_001_1993.zarr'), format='zarr')
+    write_dataset(netcdf_data, str(tmp_path / 'temp_001_1993.nc'), unlimited_dims='time')
+
+    ncrcat_years(1, str(tmp_path), ['temp'], ['temp'], format=format)
+
+    expected = zarr_data if format == 'zarr' else netcdf_data
+    with xarray.open_dataset(tmp_path / 'temp_001.nc') as ds:
+        xarray.testing.assert_allclose(ds.load(), expected)
@@ -3,7 +3,7 @@
 This script generate BGC  OBC 
 Run on analysis, with module load nco/5.0.1
 How to use:
-./write_bgc_boundary.py --config bgc_obc.yaml
+./write_bgc_boundary.py --config bgc_obc.yaml [--workers N]
 """
 import argparse
 import os
@@ -15,22 +15,67 @@ from shutil import copyfile
 from subprocess import run
 import xarray
 import yaml
-from boundary import flood_missing, Segment
+from boundary import flood_missing, run_tasks, share_dataset, Segment
 
 def read_config(config_file):
     with open(config_file, 'r') as stream:
         config = yaml.safe_load(stream)
     return config
 
-def write_bgc(segments, time0, woa_file, esper_file, cobalt_file):
+def write_woa(seg, woa_climo):
+    woa_seg = xarray.merge((seg.regrid_tracer(woa_climo[v], flood=True, periodic=False, write=False) for v in woa_climo))
+    # Make sure no negative values were produced, just in case.
+    for v in woa_seg.data_vars:
+        woa_seg[v] = np.clip(woa_seg[v], 0.0, None)
+    woa_seg = seg.add_coords(woa_seg)
+    woa_seg['time'].attrs['units'] = 'days since 0001-01-01'
+    woa_seg['time'].attrs['calendar'] = 'noleap'
+    woa_seg['time'].attrs['modulo'] = ' '
+    woa_seg['time'].attrs['cartesian_axis'] = 'T'
+    seg.to_netcdf(woa_seg, 'bgc_woa')
+
+
+def write_esper(seg, esper):
+    # Already flooded in write_bgc
+    esper_seg = xarray.merge((seg.regrid_tracer(esper[v], flood=False, periodic=False, write=False) for v in esper))
+    # Make sure no negative values were produced, just in case.
+    for v in esper_seg.data_vars:
+        esper_seg[v] = np.clip(esper_seg[v], 0.0, None)
+    esper_seg = seg.add_coords(esper_seg)
+    seg.to_netcdf(esper_seg, 'bgc_esper')
+
+
+def write_cobalt(seg, cobalt_flooded):
+    # Need to load or else xesmf will fail when trying to recognize coordinates.
+    cobalt_flooded = cobalt_flooded.load()
+    cobalt_seg = xarray.merge(
+        (seg.regrid_tracer(cobalt_flooded[v], flood=False, periodic=True, write=False) for v in cobalt_flooded)
+    )
+    # Make sure no negative values were produced, just in case.
+    for v in cobalt_seg.data_vars:
+        cobalt_seg[v] = np.clip(cobalt_seg[v], 0.0, None)
+    cobalt_seg = seg.add_coords(cobalt_seg)
+    seg.to_netcdf(cobalt_seg, 'bgc_cobalt')
+
+
+def write_source(source, seg, ds):
+    writers = {'woa': write_woa, 'esper': write_esper, 'cobalt': write_cobalt}
+    writers[source](seg, ds)
+
+
+def write_bgc(segments, time0, woa_file, esper_file, cobalt_file, output_dir, workers=1):
     woa_climo = xarray.open_dataset(woa_file)
 
+    # Open lazily with dask (keeping each horizontal field in one chunk), 
+    # so that ESPER is read and flooded one level at a time.
     esper = (
-        xarray.open_dataset(esper_file)
+        xarray.open_dataset(esper_file, chunks={'time': 1, 'st_ocean': 1, 'yt_ocean': -1, 'xt_ocean': -1})
         .rename({'st_ocean': 'z', 'yt_ocean': 'lat', 'xt_ocean': 'lon'})
         .rename({'Alk': 'alk', 'DIC': 'dic'})
         * 1e-6  # micromoles -> moles
     )
+    # Flood once for all segments (lazily; the levels are flooded as they are written to the shared file below).
+    esper = flood_missing(esper, zdim='z')
     
     # Times are defined in the middle of the year.
     # Insert a data point for the initialization time
@@ -90,13 +135,9 @@ def write_bgc(segments, time0, woa_file, esper_file, cobalt_file):
     )
     cobalt['time'] = [time0]
 
-    # Flood cobalt all together here, in part so that the lat and lon coordinates can be re-added.
-    cobalt_flooded = xarray.merge((
-        flood_missing(cobalt[v], xdim='xt_ocean', ydim='yt_ocean', zdim='z') for v in cobalt.data_vars
-    ))
+    # Flood cobalt all together here, so that the land mask of each level is only processed once.
     # Need to load or else xesmf will fail when trying to recognize coordinates.
-    cobalt_flooded = cobalt_flooded.load()    
-    cobalt_flooded = cobalt_flooded.assign_coords(lat=cobalt['lat'], lon=cobalt['lon'])
+    cobalt_flooded = flood_missing(cobalt, xdim='xt_ocean', ydim='yt_ocean', zdim='z').load()
 
     # For 4P, create medium properties from large
     for v in ['si', 'fe', 'n']:
@@ -108,40 +149,25 @@ def write_bgc(segments, time0, woa_file, esper_file, cobalt_file):
     cobalt_flooded['plg'] = cobalt_flooded['nlg'] / 14.0
     cobalt_flooded['pdi'] = cobalt_flooded['ndi'] / 40.0
 
-    common_kws = dict(write=False)
-
-    for seg in segments:
-        # WOA
-        woa_seg = xarray.merge((seg.regrid_tracer(woa_climo[v], regrid_suffix='woa_bgc', flood=True, periodic=False, **common_kws) for v in woa_climo))
-        # Make sure no negative values were produced, just in case.
-        for v in woa_seg.data_vars:
-            woa_seg[v] = np.clip(woa_seg[v], 0.0, None)
-        woa_seg = seg.add_coords(woa_seg)
-        woa_seg['time'].attrs['units'] = 'days since 0001-01-01'
-        woa_seg['time'].attrs['calendar'] = 'noleap'
-        woa_seg['time'].attrs['modulo'] = ' '
-        woa_seg['time'].attrs['cartesian_axis'] = 'T'
-        seg.to_netcdf(woa_seg, 'bgc_woa')
-        
-        # ESPER
-        # No flooding due to size
-        esper_seg = xarray.merge((seg.regrid_tracer(esper[v], regrid_suffix='esper', flood=False, periodic=False, **common_kws) for v in esper))
-        # Make sure no negative values were produced, just in case.
-        for v in esper_seg.data_vars:
-            esper_seg[v] = np.clip(esper_seg[v], 0.0, None)
-        esper_seg = seg.add_coords(esper_seg)
-        seg.to_netcdf(esper_seg, 'bgc_esper')
-        
-        # COBALT
-        cobalt_seg = xarray.merge(
-            (seg.regrid_tracer(cobalt_flooded[v], regrid_suffix='cobalt', flood=False, periodic=True, **common_kws) for v in cobalt_flooded)
-        )
-        # Make sure no negative values were produced, just in case.
-        for v in cobalt_seg.data_vars:
-            cobalt_seg[v] = np.clip(cobalt_seg[v], 0.0, None)
-        cobalt_seg = seg.add_coords(cobalt_seg)
-        seg.to_netcdf(cobalt_seg, 'bgc_cobalt')
-        
+    # Write the flooded ESPER data to a file level by level (so that it is flooded only once and never held in memory), 
+    # and share the flooded data with worker processes through files instead of copying it to each task.
+    shared_files = {'esper': path.join(output_dir, 'esper_flooded.nc'), 'cobalt': path.join(output_dir, 'cobalt_flooded.nc')}
+    try:
+        esper = share_dataset(esper, shared_files['esper'], chunks={'time': 1})
+        if workers > 1:
+            cobalt_flooded = share_dataset(cobalt_flooded, shared_files['cobalt'])
+
+        # Each (segment, source) task writes its own file.
+        sources = {'woa': woa_climo, 'esper': esper, 'cobalt': cobalt_flooded}
+        tasks = [(source, seg, ds) for seg in segments for source, ds in sources.items()]
+        run_tasks(write_source, tasks, workers=workers)
+    finally:
+        # Remove the shared files even if a task failed, since the flooded ESPER data can take several GB.
+        esper.close()
+        cobalt_flooded.close()
+        for f in shared_files.values():
+            if path.exists(f):
+                os.remove(f)
 
 def merge_segment_files(output_dir, source):
     """Merge separate segment files into one file per source of BGC data.
@@ -166,6 +192,7 @@ def merge_segment_files(output_dir, source):
 def main():
     parser = argparse.ArgumentParser(description='Generate BGC tracers obc.')
     parser.add_argument('--config', dest='config_file', default='bgc_obc.yaml', help='Path to the YAML configuration file')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes to use for regridding segments')
     args = parser.parse_args()
 
     config = read_config(args.config_file)
@@ -183,7 +210,8 @@ def main():
     # Load segments
     segments = []
     for seg_config in config.get('segments', []):
-        segment = Segment(seg_config['id'], seg_config['border'], hgrid, output_dir=output_dir)
+        segment = Segment(seg_config['id'], seg_config['border'], hgrid, output_dir=output_dir,
+                          regrid_engine=config.get('regrid_engine'))
         segments.append(segment)
 
     time0 = dt.datetime.strptime(str(config['time0']), '%Y-%m-%d')
@@ -198,7 +226,7 @@ def main():
     # COBALT climatology for remaining variables
     cobalt_file = config['cobalt_file'] 
 
-    write_bgc(segments, time0, woa_file, esper_file, cobalt_file)
+    write_bgc(segments, time0, woa_file, esper_file, cobalt_file, output_dir, workers=args.workers)
 
     for source in ['woa', 'esper', 'cobalt']:
         merge_segment_files(output_dir, source)
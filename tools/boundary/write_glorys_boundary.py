@@ -2,17 +2,19 @@
 """
 This script generated T,S, ssh, u, v OBC from Glorys
 Have to make sure nan values in Glorys have been filled by non-nan values
-Also this script require nco tools (optional) if you want to concatenat
-multiple years results. 
-Run on analysis, with module load nco/5.0.1
+Multiple years of results can optionally be concatenated (ncrcat_years in the config);
+this is done in Python and no longer requires nco tools.
+Completed work is recorded in obc_manifest.json in the output directory,
+so a rerun only regenerates the years whose GLORYS files or settings changed
+(use --force to regenerate everything).
 How to use:
-./write_glorys_boundary.py --config glorys_obc.yaml 
+./write_glorys_boundary.py --config glorys_obc.yaml [--workers N] [--force]
 """
-from subprocess import run
+from glob import glob
 from os import path
 import xarray
 import yaml
-from boundary import Segment
+from boundary import Manifest, Segment, concatenate_all, run_tasks
 import argparse
 import os
 
@@ -25,9 +27,12 @@ def load_config(config_file):
         config = yaml.safe_load(file)
     return config
 
-def write_year(year, glorys_dir, segments, variables, is_first_year=False, is_last_year=False):
+def year_files(year, glorys_dir):
+    return sorted(glob(path.join(glorys_dir, f'GLORYS_REANALYSIS_{year}-*.nc')))
+
+def open_year(year, glorys_dir, is_first_year=False, is_last_year=False):
     glorys = (
-        xarray.open_mfdataset(path.join(glorys_dir, f'GLORYS_REANALYSIS_{year}-*.nc'))
+        xarray.open_mfdataset(year_files(year, glorys_dir))
         .rename({'latitude': 'lat', 'longitude': 'lon', 'depth': 'z'})
     )
 
@@ -39,28 +44,74 @@ def write_year(year, glorys_dir, segments, variables, is_first_year=False, is_la
        tnew = xarray.concat((glorys['time'][0:-1], glorys['time'][-1].dt.ceil('1d')), dim='time')
        glorys['time'] = ('time', tnew.data)
 
+    return glorys
+
+def variable_groups(variables):
+    # All tracers share the GLORYS grid, so they are regridded together with one regridder.
+    tracers = [var for var in variables if var in ['thetao', 'so', 'zos']]
+    groups = [tracers] if tracers else []
+    if 'uv' in variables:
+        groups.append(['uv'])
+    return groups
+
+def write_segment(seg, glorys, variables, suffix, write_kwargs=None):
+    # write_kwargs are passed to Segment.to_netcdf (format, complevel, time_chunk)
+    write_kwargs = write_kwargs or {}
+    print(f'{seg.border} {" ".join(variables)}')
+    if variables == ['uv']:
+        seg.regrid_velocity(glorys['uo'], glorys['vo'], suffix=suffix, flood=False, **write_kwargs)
+    else:
+        seg.regrid_tracers(glorys, variables, suffix=suffix, flood=False, **write_kwargs)
+
+def segment_outputs(seg, variables, suffix, format=None):
+    # Files (or Zarr stores) written by write_segment
+    return [path.join(seg.output_dir, seg.filename(var, suffix=suffix, format=format)) for var in variables]
+
+def pending_tasks(manifest, year, glorys_dir, segments, variables, hgrid_file, is_first_year=False, is_last_year=False,
+                  write_kwargs=None, force=False):
+    # Tasks for the year that are not recorded as complete in the manifest, 
+    # and the manifest entry to record for each when it finishes.
+    inputs = year_files(year, glorys_dir) + [hgrid_file]
+    settings = {'first_year': is_first_year, 'last_year': is_last_year, 'write_kwargs': write_kwargs}
+    pending = []
     for seg in segments:
-        for var in variables:
-            if var == 'uv': 
-                print(f'{seg.border} {var}')
-                seg.regrid_velocity(glorys['uo'], glorys['vo'], suffix=year, flood=False)
-            elif var == 'thetao' or var == 'so': 
-                print(f'{seg.border} {var}')
-                seg.regrid_tracer(glorys[var], suffix=year, flood=False)
-            elif var == 'zos':
-                print(f'{seg.border} {var}')
-                seg.regrid_tracer(glorys['zos'], suffix=year, flood=False)
-
-
-def ncrcat_years(nsegments, output_dir, variables, ncrcat_names):
+        for group in variable_groups(variables):
+            key = Manifest.key(seg.segstr, group, year)
+            entry = (key, inputs, segment_outputs(seg, group, year, format=(write_kwargs or {}).get('format')), settings)
+            if not force and manifest.is_complete(*entry):
+                print(f'Skipping {seg.border} {" ".join(group)} {year}: already complete')
+            else:
+                pending.append((seg, group, entry))
+    if not pending:
+        return [], []
+    glorys = open_year(year, glorys_dir, is_first_year=is_first_year, is_last_year=is_last_year)
+    return [(seg, glorys, group, year, write_kwargs) for seg, group, _ in pending], [entry for _, _, entry in pending]
+
+def ncrcat_years(nsegments, output_dir, variables, ncrcat_names, workers=1, manifest=None, force=False, format=None):
+    # Only concatenate annual files in the format they are written in now,
+    # not ones left over from a run with a different intermediate_format.
+    ext = 'zarr' if format == 'zarr' else 'nc'
     if not ncrcat_names:
         ncrcat_names = variables[:]
 
+    jobs = []
+    entries = []
     for var,var_name in zip(variables,ncrcat_names):
         for seg in range(1, nsegments+1):
-            run([f'ncrcat -O {var}_{seg:03d}_* {var_name}_{seg:03d}.nc'], cwd=output_dir, shell=True)
-
-def main(config_file):
+            infiles = sorted(glob(path.join(output_dir, f'{var}_{seg:03d}_*.{ext}')))
+            outfile = path.join(output_dir, f'{var_name}_{seg:03d}.nc')
+            entry = (f'concatenate:{var_name}_{seg:03d}', infiles, [outfile])
+            if manifest is not None and not force and manifest.is_complete(*entry):
+                print(f'Skipping {outfile}: already complete')
+                continue
+            jobs.append((infiles, outfile))
+            entries.append(entry)
+    concatenate_all(jobs, workers=workers, format='NETCDF3_64BIT')
+    if manifest is not None:
+        for entry in entries:
+            manifest.record(*entry)
+
+def main(config_file, workers=1, force=False):
     # Load configuration from YAML file
     config = load_config(config_file)
 
@@ -73,6 +124,14 @@ def main(config_file):
     ncrcat_years_flag = config.get('ncrcat_years', False)
     ncrcat_names = config.get('ncrcat_names', [])
 
+    # Annual files are written time_chunk records at a time (optional) to bound memory.
+    # If they are only intermediate files for ncrcat_years, they can also be written
+    # as (compressed) NetCDF4 or as Zarr stores; the concatenated files are always NETCDF3_64BIT for MOM6.
+    write_kwargs = {'time_chunk': config.get('time_chunk', None)}
+    if ncrcat_years_flag:
+        write_kwargs['format'] = config.get('intermediate_format', 'NETCDF3_64BIT')
+        write_kwargs['complevel'] = config.get('intermediate_complevel', None)
+
     # Create output directory if it doesn't exist
     if not path.exists(output_dir):
         os.makedirs(output_dir)
@@ -86,12 +145,27 @@ def main(config_file):
     # Load segments
     segments = []
     for seg_config in config.get('segments', []):
-        segment = Segment(seg_config['id'], seg_config['border'], hgrid, output_dir=output_dir)
+        segment = Segment(seg_config['id'], seg_config['border'], hgrid, output_dir=output_dir,
+                          regrid_engine=config.get('regrid_engine'))
         segments.append(segment)
 
+    # Work that was completed by an earlier run with the same inputs and settings is skipped.
+    manifest = Manifest(output_dir)
+
+    # Each (segment, variables, year) task writes its own file, 
+    # so all of them can run in parallel. GLORYS is opened lazily with dask,
+    # so workers read the data they need from the source files.
+    tasks = []
+    entries = []
     for y in range(first_year, last_year+1):
-        print(y)
-        write_year(y, glorys_dir, segments, variables, is_first_year=y == first_year, is_last_year=y == last_year)
+        year_pending, year_entries = pending_tasks(
+            manifest, y, glorys_dir, segments, variables, hgrid_file, is_first_year=y == first_year, 
+            is_last_year=y == last_year, write_kwargs=write_kwargs, force=force
+        )
+        tasks.extend(year_pending)
+        entries.extend(year_entries)
+    # Record each task as soon as it finishes, so that an interrupted run can be resumed.
+    run_tasks(write_segment, tasks, workers=workers, callback=lambda i, _: manifest.record(*entries[i]))
 
     # Optional step: ncrcat_years
     if ncrcat_years_flag:
@@ -99,7 +173,8 @@ def main(config_file):
                                                      "number of file output names did not match the number "
                                                      "of variables provided. Please concatenate the files manually.")
 
-        ncrcat_years(len(segments), output_dir, variables, ncrcat_names)
+        ncrcat_years(len(segments), output_dir, variables, ncrcat_names, workers=workers, manifest=manifest, force=force,
+                     format=write_kwargs['format'])
 
 if __name__ == '__main__':
     # Set default config file name
@@ -109,7 +184,11 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generate obc from Glorys')
     parser.add_argument('--config', type=str, default='glorys_obc.yaml',
                         help='Specify the YAML configuration file name')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes to use for regridding segments and concatenating annual files')
+    parser.add_argument('--force', action='store_true',
+                        help='Regenerate all outputs, even if the manifest records them as complete')
     args = parser.parse_args()
 
     # Run the main function with the specified or default config file
-    main(args.config)
+    main(args.config, workers=args.workers, force=args.force)
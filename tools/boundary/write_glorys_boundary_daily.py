@@ -4,36 +4,43 @@ This script processes daily GLORYS data to generate ocean boundary conditions (O
 It supports regridding of velocity (u, v) and tracer fields (e.g., temperature, salinity, sea surface height) for a single day or concatenating multiple days of outputs. 
 
 Key Features:
-1. Processes single-day outputs: Generates regridded NetCDF files for each specified segment and variable.
-2. Supports concatenation of results across multiple days or years using NCO tools (ncrcat).
-3. Adjusts timestamps in concatenated files (optional).
+1. Processes single-day outputs: Generates regridded NetCDF files (or Zarr stores, with intermediate_format: zarr) 
+   for each specified segment and variable.
+2. Processes a range of days in one job, appending each day to a single output file per segment and variable.
+3. Supports concatenation of results across multiple days or years (replacing NCO ncrcat), in parallel over segments and variables.
+4. Adjusts timestamps in concatenated files (optional).
+5. Skips work that an earlier run completed with the same inputs and settings, as recorded in manifests 
+   in the output directory (use --force to redo everything). A date range that is extended 
+   (e.g. by a month) only appends the new days.
 
 Dependencies:
 - GLORYS data files (NetCDF format) with specific variable names.
-- NCO tools for file concatenation (optional, but required for multi-year concatenation).
-- Python libraries: xarray, yaml, argparse.
+- Python libraries: xarray, netCDF4, yaml, argparse.
 
 Usage:
 1. Process single-day output:
-   ./write_glorys_boundary_day.py --config config.yaml --year <YEAR> --month <MONTH> --day <DAY>
+   ./write_glorys_boundary_day.py --config config.yaml --year <YEAR> --month <MONTH> --day <DAY> [--workers N] [--force]
 
-2. Concatenate multiple days of results with optional timestamp adjustment:
-   ./write_glorys_boundary_day.py --config config.yaml --ncrcat_years [--adjust_timestamps]
+2. Process a range of days into one file per segment and variable (no concatenation needed),
+   with optional timestamp adjustment:
+   ./write_glorys_boundary_day.py --config config.yaml --start <YYYY-MM-DD> --end <YYYY-MM-DD> [--adjust_timestamps] [--workers N] [--force]
+
+3. Concatenate multiple days of results with optional timestamp adjustment:
+   ./write_glorys_boundary_day.py --config config.yaml --ncrcat_years [--adjust_timestamps] [--workers N] [--force]
 
 Ensure that NaN values in GLORYS data are pre-filled with valid values.
-Run on a system with NCO tools installed, e.g., `module load nco/5.0.1` on HPC systems.
 """
 
 import argparse
 import os
 from datetime import datetime, timedelta
-from subprocess import run
 from os import path
 
+import netCDF4
 import xarray
 import numpy as np
 import yaml
-from boundary import Segment
+from boundary import Manifest, Segment, concatenate_all, run_tasks, truncate_netcdf
 
 # Suppress xarray warnings
 import warnings
@@ -44,101 +51,207 @@ def load_config(config_file):
     with open(config_file, 'r') as file:
         return yaml.safe_load(file)
 
-def write_day(date, glorys_dir, segments, variables, output_prefix):
-    """Process and regrid data for a specific day."""
-    filename = f"{output_prefix}_{date.year}-{date.month:02d}-{date.day:02d}.nc"
-    file_path = path.join(glorys_dir, filename)
+def day_file(date, glorys_dir, output_prefix):
+    """Path to the GLORYS file for a specific day."""
+    return path.join(glorys_dir, f"{output_prefix}_{date.year}-{date.month:02d}-{date.day:02d}.nc")
+
+def manifest_dir(output_dir):
+    """Directory for the manifests of daily and date range processing, one per process writing them."""
+    return path.join(output_dir, 'obc_manifest')
+
+def open_day(date, glorys_dir, output_prefix, is_first_day=False, is_last_day=False):
+    """
+    Open the GLORYS file for a specific day.
+    is_first_day and is_last_day floor the first or ceil the last timestamp to midnight.
+    Returns None if the file does not exist.
+    """
+    file_path = day_file(date, glorys_dir, output_prefix)
 
     if not path.exists(file_path):
         print(f"File does not exist: {file_path}. Skipping.")
-        return
+        return None
 
     glorys = (
         xarray.open_dataset(file_path, decode_times=False)
         .rename({'latitude': 'lat', 'longitude': 'lon', 'depth': 'z'})
     )
 
+    # Adjust the first and last timestamps in raw numerical format
+    if is_first_day:
+        glorys['time'] = ('time', np.floor(glorys['time'].values), glorys['time'].attrs)
+    if is_last_day:
+        glorys['time'] = ('time', np.ceil(glorys['time'].values), glorys['time'].attrs)
+
+    return glorys
+
+def variable_groups(variables):
+    """Group variables that are regridded together: all tracers share the GLORYS grid and one regridder."""
+    tracers = [variable for variable in variables if variable in ['thetao', 'so', 'zos']]
+    groups = [tracers] if tracers else []
+    if 'uv' in variables:
+        groups.append(['uv'])
+    return groups
+
+def write_segment_day(segment, glorys, variables, date, output_names=None, write_kwargs=None):
+    """
+    Regrid one group of variables for one day onto one segment.
+    If output_names is given, the day is appended to the file for each variable named by 
+    output_names (a dict mapping variable to output name) instead of being written to its own file.
+    write_kwargs are passed to Segment.to_netcdf when writing daily files (e.g. format and complevel).
+    """
+    write_kwargs = write_kwargs or {}
     # Capture time attributes and encoding
     time_attrs = glorys['time'].attrs if 'time' in glorys.coords else None
     time_encoding = glorys['time'].encoding if 'time' in glorys.coords else None
+    append = output_names is not None
+
+    print(f"Processing {segment.border} {' '.join(variables)}")
+    if variables == ['uv']:
+        ds_uv = segment.regrid_velocity(glorys['uo'], glorys['vo'], suffix=f"{date:%Y%m%d}", flood=False, write=not append,
+                                        time_attrs=time_attrs, time_encoding=time_encoding, **write_kwargs)
+        if append:
+            segment.append_netcdf(ds_uv, output_names['uv'])
+    else:
+        results = segment.regrid_tracers(glorys, variables, suffix=f"{date:%Y%m%d}", flood=False, write=not append,
+                                         time_attrs=time_attrs, time_encoding=time_encoding, **write_kwargs)
+        if append:
+            for variable in variables:
+                segment.append_netcdf(results[variable], output_names[variable])
+
+def write_day(date, glorys_dir, segments, variables, output_prefix, workers=1, write_kwargs=None, hgrid_file=None, 
+              force=False):
+    """
+    Process and regrid data for a specific day, in parallel over segments and variables.
+    Segments and variables that were already completed for the day with the same inputs and settings are skipped.
+    """
+    glorys = open_day(date, glorys_dir, output_prefix)
+    if glorys is None:
+        return
+    write_kwargs = write_kwargs or {}
 
+    # Daily jobs can run at the same time, so each day has its own manifest.
+    manifest = Manifest(manifest_dir(segments[0].output_dir), name=f"{date:%Y%m%d}.json")
+    inputs = [day_file(date, glorys_dir, output_prefix)] + ([hgrid_file] if hgrid_file else [])
+    tasks = []
+    entries = []
     for segment in segments:
-        for variable in variables:
-            if variable == 'uv':
-                print(f"Processing {segment.border} {variable}")
-                segment.regrid_velocity(glorys['uo'], glorys['vo'], suffix=f"{date:%Y%m%d}", flood=False,
-                                        time_attrs=time_attrs, time_encoding=time_encoding )
-            elif variable in ['thetao', 'so', 'zos']:
-                print(f"Processing {segment.border} {variable}")
-                segment.regrid_tracer(glorys[variable], suffix=f"{date:%Y%m%d}", flood=False,
-                                      time_attrs=time_attrs, time_encoding=time_encoding)
-
-def concatenate_files(nsegments, output_dir, variables, ncrcat_names, first_date, last_date, adjust_timestamps=False):
-    """Concatenate annual files using ncrcat."""
+        for group in variable_groups(variables):
+            outputs = [
+                path.join(segment.output_dir, segment.filename(v, suffix=f"{date:%Y%m%d}", format=write_kwargs.get('format')))
+                for v in group
+            ]
+            entry = (Manifest.key(segment.segstr, group), inputs, outputs, {'write_kwargs': write_kwargs})
+            if not force and manifest.is_complete(*entry):
+                print(f"Skipping {segment.border} {' '.join(group)}: already complete")
+                continue
+            tasks.append((segment, glorys, group, date, None, write_kwargs))
+            entries.append(entry)
+    run_tasks(write_segment_day, tasks, workers=workers, callback=lambda i, _: manifest.record(*entries[i]))
+
+def time_records(filename):
+    """Number of time records in a file (0 if it does not exist)."""
+    if not path.exists(filename):
+        return 0
+    with netCDF4.Dataset(filename) as ds:
+        return len(ds.dimensions['time'])
+
+def write_segment_days(segment, variables, dates, glorys_dir, output_prefix, output_names, adjust_timestamps=False,
+                       hgrid_file=None, force=False):
+    """
+    Regrid one group of variables onto one segment for consecutive days, appending each day to the output.
+    Each day is recorded in a manifest for the segment and variables once it has been appended. 
+    A rerun keeps the days at the start of the range that are unchanged
+    (same inputs and settings) and appends the rest, so extending the range only processes the new days.
+    """
+    manifest = Manifest(manifest_dir(segment.output_dir), name=f"{segment.segstr}_{'_'.join(variables)}.json")
+    outputs = [path.join(segment.output_dir, segment.filename(output_names[v])) for v in variables]
+    entries = []
+    for i, date in enumerate(dates):
+        inputs = [day_file(date, glorys_dir, output_prefix)] + ([hgrid_file] if hgrid_file else [])
+        settings = {
+            'start': dates[0], 'outputs': outputs,
+            'first_day': adjust_timestamps and i == 0, 'last_day': adjust_timestamps and i == len(dates) - 1
+        }
+        entries.append((f"{date:%Y%m%d}", inputs, (), settings))
+
+    # Keep the unchanged days at the start of the range that are in the outputs.
+    done = 0
+    while not force and done < len(dates) and manifest.is_complete(*entries[done]):
+        done += 1
+    nrecords = sum(manifest.entries[entries[i][0]]['records'] for i in range(done))
+    if done > 0 and all(time_records(f) >= nrecords for f in outputs):
+        print(f"Keeping {done} completed days for {segment.border} {' '.join(variables)}")
+        for f in outputs:
+            if time_records(f) > nrecords:
+                truncate_netcdf(f, nrecords)
+    else:
+        done = 0
+        # Start from empty outputs so that days are not appended to the results of an earlier run.
+        for f in outputs:
+            if path.exists(f):
+                print(f"Removing existing file: {f}")
+                os.remove(f)
+
+    for i in range(done, len(dates)):
+        glorys = open_day(dates[i], glorys_dir, output_prefix,
+                          is_first_day=adjust_timestamps and i == 0,
+                          is_last_day=adjust_timestamps and i == len(dates) - 1)
+        if glorys is not None:
+            write_segment_day(segment, glorys, variables, dates[i], output_names=output_names)
+        manifest.record(*entries[i], records=0 if glorys is None else len(glorys['time']))
+
+def concatenate_files(nsegments, output_dir, variables, ncrcat_names, first_date, last_date, adjust_timestamps=False,
+                      workers=1, force=False, intermediate_format=None):
+    """
+    Concatenate daily files into one file per segment and variable, adjusting timestamps during the write (optional).
+    If intermediate_format is 'zarr', the daily outputs are Zarr stores, which are exported to NETCDF3_64BIT.
+    Outputs that were already concatenated from the same daily files are skipped.
+    """
     if not ncrcat_names:
         ncrcat_names = variables[:]
 
     date_list = [(first_date + timedelta(days=i)).strftime("%Y%m%d")
                  for i in range((last_date - first_date).days + 1)]
 
+    ext = 'zarr' if intermediate_format == 'zarr' else 'nc'
+    manifest = Manifest(output_dir)
+    jobs = []
+    entries = []
     for variable, var_name in zip(variables, ncrcat_names):
         for seg_id in range(1, nsegments + 1):
             input_files = [
-                path.join(output_dir, f"{variable}_{seg_id:03d}_{date}.nc")
+                path.join(output_dir, f"{variable}_{seg_id:03d}_{date}.{ext}")
                 for date in date_list
             ]
             output_file = path.join(output_dir, f"{var_name}_{seg_id:03d}.nc")
 
+            entry = (f"concatenate:{var_name}_{seg_id:03d}", input_files, [output_file], 
+                     {'adjust_timestamps': adjust_timestamps})
+            if not force and manifest.is_complete(*entry):
+                print(f"Skipping {output_file}: already complete")
+                continue
+
             if path.exists(output_file):
                 print(f"Removing existing file: {output_file}")
                 os.remove(output_file)
 
-            print(f"Concatenating files for {variable}, segment {seg_id} into {output_file}...")
-            run(["ncrcat", "-O", *input_files, output_file], check=True)
+            jobs.append((input_files, output_file))
+            entries.append(entry)
 
-            if adjust_timestamps:
-                adjust_file_timestamps(output_file)
+    concatenate_all(jobs, workers=workers, adjust_timestamps=adjust_timestamps, format='NETCDF3_64BIT')
+    for entry in entries:
+        manifest.record(*entry)
 
-def adjust_file_timestamps(file_path):
-    """
-    Adjust timestamps for the first and last records in a file while preserving attributes and raw numerical format.
-    """
-    with xarray.open_dataset(file_path, decode_times=False) as ds:
-        # Explicitly load the dataset into memory if it's lazy-loaded
-        ds.load()
-
-        if 'time' in ds:
-            # Extract the time variable, attributes, and encoding
-            time = ds['time']
-            time_attrs = time.attrs  # Save the original attributes
-            time_encoding = time.encoding  # Save the original encoding
-            time_values = time.values.copy()
-
-            # Ensure the 'time' variable has more than one entry
-            if len(time_values) > 1:
-                # Adjust the first and last timestamps in raw numerical format
-                time_values[0] = np.floor(time_values[0])  # Floor to the start of the day
-                time_values[-1] = np.ceil(time_values[-1])  # Ceil to the end of the day
-
-            # Create a new DataArray for time while preserving attributes
-            new_time = xarray.DataArray(
-                time_values,
-                dims=time.dims,
-                attrs=time_attrs,
-                name='time'
-            )
-
-            # Assign the new time variable back to the dataset
-            ds = ds.assign_coords(time=new_time)
-
-            # Reapply the original encoding to ensure consistency 
-            ds['time'].encoding = time_encoding
-
-            # Save the updated dataset
-            ds.to_netcdf(file_path)
-            print(f"Timestamps adjusted for {file_path}")
-
-def process_single_day(config, year, month, day):
+def load_segments(config):
+    """Create the segments listed in the configuration."""
+    hgrid = xarray.open_dataset(config['hgrid'])
+    return [
+        Segment(seg_config['id'], seg_config['border'], hgrid, output_dir=config['output_dir'],
+                regrid_engine=config.get('regrid_engine'))
+        for seg_config in config['segments']
+    ]
+
+def process_single_day(config, year, month, day, workers=1, force=False):
     """Process data for a single day."""
     specific_date = datetime(year, month, day)
     print(f"Processing data for {specific_date}...")
@@ -147,15 +260,46 @@ def process_single_day(config, year, month, day):
     output_prefix = config.get('_OUTPUT_PREFIX', 'GLORYS')
     variables = config['variables']
 
-    hgrid = xarray.open_dataset(config['hgrid'])
-    segments = [
-        Segment(seg_config['id'], seg_config['border'], hgrid, output_dir=config['output_dir'])
-        for seg_config in config['segments']
-    ]
+    segments = load_segments(config)
+
+    # Daily files are only intermediate files for concatenation,
+    # so they can optionally be written as (compressed) NetCDF4 or Zarr stores.
+    write_kwargs = {
+        'format': config.get('intermediate_format', 'NETCDF3_64BIT'),
+        'complevel': config.get('intermediate_complevel', None)
+    }
 
-    write_day(specific_date, glorys_dir, segments, variables, output_prefix)
+    write_day(specific_date, glorys_dir, segments, variables, output_prefix, workers=workers, write_kwargs=write_kwargs,
+              hgrid_file=config['hgrid'], force=force)
+
+def process_date_range(config, start_date, end_date, adjust_timestamps=False, workers=1, force=False):
+    """
+    Process every day from start_date to end_date in one job.
+    Segments and regridding weights are created once and kept in memory,
+    and each day is appended to one output file per variable and segment
+    (named by ncrcat_names), so no concatenation step is needed afterwards.
+    Days completed by an earlier run of the same range (or the start of a longer range) are kept.
+    """
+    print(f"Processing data from {start_date} to {end_date}...")
+
+    glorys_dir = config['glorys_dir']
+    output_prefix = config.get('_OUTPUT_PREFIX', 'GLORYS')
+    variables = config['variables']
+    ncrcat_names = config.get('ncrcat_names', []) or variables[:]
+    output_names = dict(zip(variables, ncrcat_names))
+
+    segments = load_segments(config)
+
+    # Each (segment, variables) task streams through all of the days in order,
+    # so the tasks can run in parallel while every output file is still appended in time order.
+    dates = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    tasks = [
+        (segment, group, dates, glorys_dir, output_prefix, output_names, adjust_timestamps, config['hgrid'], force)
+        for segment in segments for group in variable_groups(variables)
+    ]
+    run_tasks(write_segment_days, tasks, workers=workers)
 
-def concatenate_annual_files(config, adjust_timestamps):
+def concatenate_annual_files(config, adjust_timestamps, workers=1, force=False):
     """Concatenate files for the entire date range."""
     first_date = datetime.strptime(config['first_date'], '%Y-%m-%d')
     last_date = datetime.strptime(config['last_date'], '%Y-%m-%d')
@@ -169,7 +313,10 @@ def concatenate_annual_files(config, adjust_timestamps):
         config.get('ncrcat_names', []),
         first_date,
         last_date,
-        adjust_timestamps
+        adjust_timestamps,
+        workers,
+        force,
+        config.get('intermediate_format')
     )
 
 def main():
@@ -178,18 +325,25 @@ def main():
     parser.add_argument('--year', type=int, help="Year for single-day processing")
     parser.add_argument('--month', type=int, help="Month for single-day processing")
     parser.add_argument('--day', type=int, help="Day for single-day processing")
+    parser.add_argument('--start', type=str, help="First date (YYYY-MM-DD) for date range processing")
+    parser.add_argument('--end', type=str, help="Last date (YYYY-MM-DD) for date range processing")
     parser.add_argument('--ncrcat_years', action='store_true', help="Enable annual concatenation mode")
-    parser.add_argument('--adjust_timestamps', action='store_true', help="Adjust timestamps during concatenation")
+    parser.add_argument('--adjust_timestamps', action='store_true', help="Adjust timestamps during concatenation or date range processing")
+    parser.add_argument('--workers', type=int, default=1, help="Number of processes to use for regridding and concatenation")
+    parser.add_argument('--force', action='store_true', help="Redo all work, even if it is recorded as complete")
     args = parser.parse_args()
 
     config = load_config(args.config)
 
     if args.ncrcat_years:
-        concatenate_annual_files(config, args.adjust_timestamps)
+        concatenate_annual_files(config, args.adjust_timestamps, args.workers, args.force)
+    elif args.start and args.end:
+        process_date_range(config, datetime.strptime(args.start, '%Y-%m-%d'),
+                           datetime.strptime(args.end, '%Y-%m-%d'), args.adjust_timestamps, args.workers, args.force)
     elif args.year and args.month and args.day:
-        process_single_day(config, args.year, args.month, args.day)
+        process_single_day(config, args.year, args.month, args.day, args.workers, args.force)
     else:
-        print("Error: Specify either --ncrcat_years or a specific date (--year, --month, --day).")
+        print("Error: Specify either --ncrcat_years, a date range (--start, --end), or a specific date (--year, --month, --day).")
 
 if __name__ == '__main__':
     main()
@@ -2,7 +2,7 @@
 """
 This script generated tide OBC from tpxo9
 How to use:
-./write_tpxo_boundary.py --config tpxo_obc.yaml
+./write_tpxo_boundary.py --config tpxo_obc.yaml [--workers N]
 """
 import argparse
 import numpy as np
@@ -11,9 +11,33 @@ import pandas as pd
 import xarray
 import yaml
 import os
-from boundary import Segment
+from boundary import run_tasks, share_dataset, subset_indices, Segment
+
+def write_tidal_elevation(seg, tpxo_h, times):
+    seg.regrid_tidal_elevation(
+        tpxo_h[['lon', 'lat', 'hRe']],
+        tpxo_h[['lon', 'lat', 'hIm']],
+        times,
+        flood=True
+    )
+
+def write_tidal_velocity(seg, tpxo_u, tpxo_v, times):
+    seg.regrid_tidal_velocity(
+        tpxo_u[['lon', 'lat', 'uRe']],
+        tpxo_u[['lon', 'lat', 'uIm']],
+        tpxo_v[['lon', 'lat', 'vRe']],
+        tpxo_v[['lon', 'lat', 'vIm']],
+        times,
+        flood=True
+    )
 
-def write_tpxo(constituents, tpxo_dir, horizontal_subset):
+def write_tide(kind, seg, tpxo, times):
+    if kind == 'elevation':
+        write_tidal_elevation(seg, tpxo['h'], times)
+    elif kind == 'velocity':
+        write_tidal_velocity(seg, tpxo['u'], tpxo['v'], times)
+
+def write_tpxo(constituents, tpxo_dir, horizontal_subset, segments, output_dir, workers=1):
     tpxo_h = (
         xarray.open_dataset(path.join(tpxo_dir, 'h_tpxo9.v1.nc'))
         .rename({'lon_z': 'lon', 'lat_z': 'lat', 'nc': 'constituent'})
@@ -60,22 +84,20 @@ def write_tpxo(constituents, tpxo_dir, horizontal_subset):
         dims=['time']
     )
 
-    for seg in segments:
-        seg.regrid_tidal_elevation(
-            tpxo_h[['lon', 'lat', 'hRe']],
-            tpxo_h[['lon', 'lat', 'hIm']],
-            times,
-            flood=True
-        )
-
-        seg.regrid_tidal_velocity(
-            tpxo_u[['lon', 'lat', 'uRe']],
-            tpxo_u[['lon', 'lat', 'uIm']],
-            tpxo_v[['lon', 'lat', 'vRe']],
-            tpxo_v[['lon', 'lat', 'vIm']],
-            times,
-            flood=True
-        )
+    tpxo = {'h': tpxo_h, 'u': tpxo_u, 'v': tpxo_v}
+    # Share the subset with worker processes through files instead of copying it to each task.
+    if workers > 1:
+        tpxo = {k: share_dataset(ds[['lon', 'lat', f'{k}Re', f'{k}Im']], path.join(output_dir, f'tpxo_{k}_subset.nc')) 
+                for k, ds in tpxo.items()}
+
+    # Each (segment, elevation or velocity) task writes its own file.
+    tasks = [(kind, seg, tpxo, times) for seg in segments for kind in ['elevation', 'velocity']]
+    run_tasks(write_tide, tasks, workers=workers)
+
+    if workers > 1:
+        for k, ds in tpxo.items():
+            ds.close()
+            os.remove(path.join(output_dir, f'tpxo_{k}_subset.nc'))
 
 if __name__ == '__main__':
     """
@@ -99,6 +121,7 @@ if __name__ == '__main__':
     """
     parser = argparse.ArgumentParser(description='Script to write TPXO data to OBC segments.')
     parser.add_argument('--config', type=str, help='Path to YAML configuration file', default='tpxo_obc.yaml')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes to use for regridding segments')
     args = parser.parse_args()
 
     # Default configuration
@@ -107,6 +130,7 @@ if __name__ == '__main__':
         'tpxo_dir': '/work/acr/tpxo9/',
         'grid_file': '../../datasets/grid/ocean_hgrid.nc',
         'output_dir': './',
+        'halo': 10,
     }
 
     # Load user-specified configuration from YAML file
@@ -122,28 +146,32 @@ if __name__ == '__main__':
     grid_file = config['grid_file']
     output_dir = config['output_dir']
 
-    # Extract indices from the configuration
-    ny_start = config['indices']['ny_start']
-    ny_end = config['indices']['ny_end']
-    nx_start = config['indices']['nx_start']
-    nx_end = config['indices']['nx_end']
-
     # Check if the output folder exists, create it if not
     if not path.exists(output_dir):
         os.makedirs(output_dir)
 
-    # Subset TPXO9 to a region roughly around the NWA domain
-    # for computational efficiency.
-    print(ny_start,ny_end,nx_start,nx_end)
-    horizontal_subset = dict(ny=slice(ny_start, ny_end), nx=slice(nx_start, nx_end))
-
     # Setup NWA boundaries
     hgrid = xarray.open_dataset(grid_file)
 
     # Load segments
     segments = []
     for seg_config in config.get('segments', []):
-        segment = Segment(seg_config['id'], seg_config['border'], hgrid, output_dir=output_dir)
+        segment = Segment(seg_config['id'], seg_config['border'], hgrid, output_dir=output_dir,
+                          regrid_engine=config.get('regrid_engine'))
         segments.append(segment)
 
-    write_tpxo(constituents, tpxo_dir, horizontal_subset)
+    # Subset TPXO9 to a region around the segments
+    # for computational efficiency.
+    if 'indices' in config:
+        # Indices given by hand in the configuration
+        ny_start = config['indices']['ny_start']
+        ny_end = config['indices']['ny_end']
+        nx_start = config['indices']['nx_start']
+        nx_end = config['indices']['nx_end']
+        horizontal_subset = dict(ny=slice(ny_start, ny_end), nx=slice(nx_start, nx_end))
+    else:
+        with xarray.open_dataset(path.join(tpxo_dir, 'h_tpxo9.v1.nc')) as tpxo_grid:
+            horizontal_subset = subset_indices(tpxo_grid['lon_z'], tpxo_grid['lat_z'], segments, halo=config['halo'])
+    print(horizontal_subset)
+
+    write_tpxo(constituents, tpxo_dir, horizontal_subset, segments, output_dir, workers=args.workers)
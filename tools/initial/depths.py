@@ -1,4 +1,7 @@
+import functools
+
 import numpy as np
+import scipy.sparse
 import xarray
 
 def vgrid_to_interfaces(vgrid, max_depth=6500.0):
@@ -16,3 +19,147 @@ def vgrid_to_layers(vgrid, max_depth=6500.0):
     z = (ints + np.roll(ints, shift=1)) / 2
     layers = z[1:]
     return layers
+
+
+def levels_to_interfaces(z):
+    """Interfaces of the cells around levels z (increasing, positive down): halfway between levels,
+    with the top at the surface (or at the first level if it is above the surface)
+    and the bottom as far below the last level as the midpoint above it."""
+    z = np.asarray(z, dtype='float64')
+    mid = (z[1:] + z[:-1]) / 2
+    top = min(max(z[0] - (mid[0] - z[0]), 0.0), z[0])
+    bottom = z[-1] + (z[-1] - mid[-1])
+    return np.concatenate([[top], mid, [bottom]])
+
+
+class VerticalRemapper():
+    """Remap data from source levels to target layers, one column at a time.
+    The weights are computed once, as a banded sparse matrix of shape (target layers, source levels),
+    and applied to all columns of a variable (or of a dask chunk of it) in a single product.
+
+    Args:
+        source_z: depths of the source levels (increasing, positive down).
+        target_z: depths of the target layers (increasing, positive down).
+        method (str, optional): 'linear' interpolation between the levels (like xarray's interp), or
+            'conservative' averaging of the source cells over the part of each target layer that they cover.
+            Defaults to 'linear'.
+        extrapolate (bool, optional): For linear remapping, linearly extrapolate above the first and below the last
+            source level rather than returning nan. Defaults to False.
+        source_interfaces (optional): interfaces of the source cells for conservative remapping.
+            Defaults to levels_to_interfaces(source_z).
+        target_interfaces (optional): interfaces of the target layers for conservative remapping.
+            Defaults to levels_to_interfaces(target_z).
+    """
+
+    def __init__(self, source_z, target_z, method='linear', extrapolate=False, source_interfaces=None, target_interfaces=None):
+        self.source_z = np.asarray(source_z, dtype='float64')
+        self.target_z = np.asarray(target_z, dtype='float64')
+        self.method = method
+        if method == 'linear':
+            self.matrix, self.outside = self._linear_weights(extrapolate)
+        elif method == 'conservative':
+            zs = levels_to_interfaces(self.source_z) if source_interfaces is None else np.asarray(source_interfaces, dtype='float64')
+            zt = levels_to_interfaces(self.target_z) if target_interfaces is None else np.asarray(target_interfaces, dtype='float64')
+            # Thickness of the overlap of each target layer with each source cell
+            overlap = np.maximum(
+                np.minimum.outer(zt[1:], zs[1:]) - np.maximum.outer(zt[:-1], zs[:-1]),
+                0.0
+            )
+            self.matrix = scipy.sparse.csr_matrix(overlap)
+            self.outside = np.zeros(len(self.target_z), dtype='bool')
+        else:
+            raise ValueError(f'Unknown vertical remapping method {method}')
+
+    def _linear_weights(self, extrapolate):
+        # Same stencil as scipy's interp1d: the segment [lo, hi] containing each target depth,
+        # or the first or last segment outside the source levels
+        zs = self.source_z
+        hi = np.clip(np.searchsorted(zs, self.target_z), 1, len(zs) - 1)
+        lo = hi - 1
+        w = (self.target_z - zs[lo]) / (zs[hi] - zs[lo])
+        rows = np.repeat(np.arange(len(self.target_z)), 2)
+        # Both weights are kept even when one is zero, so that nan in either level gives nan, as in interp1d
+        matrix = scipy.sparse.coo_matrix(
+            (np.column_stack((1 - w, w)).ravel(), (rows, np.column_stack((lo, hi)).ravel())),
+            shape=(len(self.target_z), len(zs))
+        ).tocsr()
+        if extrapolate:
+            outside = np.zeros(len(self.target_z), dtype='bool')
+        else:
+            outside = (self.target_z < zs[0]) | (self.target_z > zs[-1])
+        return matrix, outside
+
+    @staticmethod
+    def _remapped_dtype(dtype):
+        """Data type of the remapped values: the source type if it is floating point, otherwise float64."""
+        dtype = np.dtype(dtype)
+        return dtype if dtype.kind == 'f' else np.dtype('float64')
+
+    def remap_values(self, values):
+        """Remap a numpy array whose last axis is the source levels. Returns an array with the target layers as the last axis,
+        in the same floating point type as values (float64 for other types)."""
+        values = np.asarray(values)
+        dtype = self._remapped_dtype(values.dtype)
+        columns = values.reshape(-1, values.shape[-1]).T
+        if self.method == 'conservative':
+            # Missing source cells (e.g. below the bottom) don't count towards the average
+            valid = ~np.isnan(columns)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                remapped = (self.matrix @ np.where(valid, columns, 0.0)) / (self.matrix @ valid.astype('float64'))
+        else:
+            remapped = self.matrix @ columns
+        remapped[self.outside] = np.nan
+        return remapped.T.reshape(values.shape[:-1] + (len(self.target_z), )).astype(dtype, copy=False)
+
+    def __call__(self, ds, dim, target_dim='zl'):
+        """Remap the variables of a Dataset (or a DataArray) that have the dimension dim onto the target layers,
+        in the dimension target_dim. As with xarray's interp, dim becomes a coordinate along target_dim and
+        variables without dim are unchanged. Variables backed by dask arrays are remapped lazily, chunk by chunk
+        (with dim in a single chunk); others are remapped immediately.
+
+        Args:
+            ds: xarray Dataset or DataArray with the source levels along dim.
+            dim (str): name of the source vertical dimension.
+            target_dim (str, optional): name of the target vertical dimension. Defaults to 'zl'.
+
+        Returns:
+            xarray Dataset or DataArray.
+        """
+        if isinstance(ds, xarray.DataArray):
+            name = ds.name if ds.name is not None else '__remapped__'
+            remapped = self(ds.to_dataset(name=name), dim, target_dim)[name]
+            remapped.name = ds.name
+            return remapped
+        remap_vars = [v for v in ds.data_vars if dim in ds[v].dims]
+        coords = {target_dim: self.target_z, dim: (target_dim, self.target_z)}
+        out = ds.drop_vars(remap_vars + [c for c in ds.coords if dim in ds[c].dims]).assign_coords(coords)
+        for v in remap_vars:
+            da = ds[v].reset_coords(drop=True)
+            if da.chunks is not None:
+                da = da.chunk({dim: -1})
+            remapped = xarray.apply_ufunc(
+                self.remap_values, da,
+                input_core_dims=[[dim]],
+                output_core_dims=[[target_dim]],
+                exclude_dims={dim},
+                dask='parallelized',
+                output_dtypes=[self._remapped_dtype(da.dtype)],
+                dask_gufunc_kwargs={'output_sizes': {target_dim: len(self.target_z)}},
+                keep_attrs=True
+            )
+            new_dims = tuple(target_dim if d == dim else d for d in da.dims)
+            out[v] = remapped.transpose(*new_dims).variable
+        return out[list(ds.data_vars)]
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_remapper(source_z, target_z, method, extrapolate, target_interfaces):
+    return VerticalRemapper(source_z, target_z, method=method, extrapolate=extrapolate, target_interfaces=target_interfaces)
+
+
+def vertical_remapper(source_z, target_z, method='linear', extrapolate=False, target_interfaces=None):
+    """VerticalRemapper for a pair of source and target grids, reused if it has already been created
+    for the same grids and settings (e.g. for sources on the same levels)."""
+    def as_tuple(z):
+        return None if z is None else tuple(np.asarray(z, dtype='float64').tolist())
+    return _cached_remapper(as_tuple(source_z), as_tuple(target_z), method, extrapolate, as_tuple(target_interfaces))
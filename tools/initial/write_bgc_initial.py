@@ -15,20 +15,23 @@ import numpy as np
 import xarray
 import xesmf
 
-from HCtFlood import kara as flood
-from depths import vgrid_to_layers 
-
-
-def interpolate_flood(target_grid, ztarget, ds, xdim=None, ydim=None, periodic=True):
-    revert = ds.interp(z=ztarget).ffill('zl', limit=None).bfill('zl', limit=None)
-    if xdim is None and ydim is None:
-        flooded = xarray.merge((
-            flood.flood_kara(revert[v], zdim='zl') for v in revert.data_vars
-        )).squeeze().drop('time')
-    else:
-        flooded = xarray.merge((
-            flood.flood_kara(revert[v], xdim=xdim, ydim=ydim, zdim='zl') for v in revert.data_vars
-        )).squeeze().drop('time')
+from depths import vertical_remapper, vgrid_to_interfaces, vgrid_to_layers
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(script_dir, '../boundary'))
+from boundary import flood_missing, subset_indices
+
+
+def interpolate_flood(target_grid, ztarget, ds, xdim='lon', ydim='lat', periodic=True, method='linear', target_interfaces=None):
+    # Remapping weights are computed once for each set of source levels
+    remapper = vertical_remapper(ds['z'].values, ztarget.values, method=method, target_interfaces=target_interfaces)
+    revert = remapper(ds, 'z').ffill('zl', limit=None).bfill('zl', limit=None)
+    # Flood one level at a time (lazily, as the data are regridded), keeping only the dimension coordinates.
+    flooded = (
+        flood_missing(revert, xdim=xdim, ydim=ydim, zdim='zl')
+        .squeeze()
+        .reset_coords(drop=True)
+    )
     ds_to_mom = xesmf.Regridder(
         ds, 
         target_grid, 
@@ -42,10 +45,16 @@ def interpolate_flood(target_grid, ztarget, ds, xdim=None, ydim=None, periodic=T
     return interped
 
 
-def write_bgc(woa_file, esper_file, cobalt_file, time0, interpolator, output_file):
+def write_bgc(woa_file, esper_file, cobalt_file, time0, interpolator, output_file, halo=5):
+    target_grid = interpolator.args[0]
+
     print('WOA')
     woa = xarray.open_dataset(woa_file).isel(time=0)
-    woa_interped = interpolator(woa)
+    # subset around the domain (no longer periodic unless the domain is global):
+    woa_subset = subset_indices(woa['lon'], woa['lat'], target_grid, halo=halo)
+    woa = woa.isel(woa_subset)
+    periodic = isinstance(woa_subset['lon'], slice) and woa_subset['lon'] == slice(None)
+    woa_interped = interpolator(woa, periodic=periodic)
 
     print('ESPER')
     esper = (
@@ -54,6 +63,10 @@ def write_bgc(woa_file, esper_file, cobalt_file, time0, interpolator, output_fil
         .rename({'Alk': 'alk', 'DIC': 'dic'})
         .transpose('time', 'z', 'lat', 'lon')
         .sel(time=f'{time0.year}')
+    )
+    esper = (
+        esper
+        .isel(subset_indices(esper['lon'], esper['lat'], target_grid, halo=halo))
         * 1e-6  # micromoles -> moles
     )
     esper_interped = interpolator(esper, periodic=False)
@@ -92,8 +105,11 @@ def write_bgc(woa_file, esper_file, cobalt_file, time0, interpolator, output_fil
         xarray.open_dataset(cobalt_file)
         .rename({'st_ocean': 'z', 'geolat_t': 'lat', 'geolon_t': 'lon'})
         [cobalt_vars]
-        # subset around NWA domain:
-        .isel(xt_ocean=slice(170, 250), yt_ocean=slice(100, 170))
+    )
+    cobalt = (
+        cobalt
+        # subset around the domain:
+        .isel(subset_indices(cobalt['lon'], cobalt['lat'], target_grid, halo=halo))
         .squeeze()
     )
 
@@ -114,7 +130,7 @@ def write_bgc(woa_file, esper_file, cobalt_file, time0, interpolator, output_fil
 
     # Copy xh and yh from the target grid
     for v in ['xh', 'yh']:
-        interped[v] = interpolator.args[0][v]
+        interped[v] = target_grid[v]
         
     interped['Time'] = ('Time', [time0])
 
@@ -245,12 +261,18 @@ def main():
     # Partial function to flood and horizontally and vertically interpolate
     # data onto the target horizontal and vertical grids:
     global interpolator 
-    interpolator = partial(interpolate_flood, target_grid, ztarget)
+    interpolator = partial(
+        interpolate_flood, target_grid, ztarget,
+        method=config.get('vertical_remapping', 'linear'), target_interfaces=vgrid_to_interfaces(vgrid)
+    )
 
     # Time of the model initialization:
     time0 = dt.datetime.strptime(str(config['time0']), '%Y-%m-%d')
 
-    write_bgc(config['woa_file'], config['esper_file'], config['cobalt_file'], time0, interpolator, config['output_file'])
+    write_bgc(
+        config['woa_file'], config['esper_file'], config['cobalt_file'], time0, interpolator, config['output_file'], 
+        halo=config.get('halo', 5)
+    )
 
 
 if __name__ == '__main__':
@@ -13,18 +13,16 @@ import numpy as np
 import xarray
 import xesmf
 
-from HCtFlood import kara as flood
-
 # Get the directory of the current script
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
 #
 #sys.path.append(os.path.join(script_dir, './depths'))
-from depths import vgrid_to_interfaces, vgrid_to_layers
+from depths import VerticalRemapper, vgrid_to_interfaces, vgrid_to_layers
 
 #
 sys.path.append(os.path.join(script_dir, '../boundary'))
-from boundary import rotate_uv
+from boundary import flood_missing, rotate_uv, write_dataset
 
 
 def write_initial(config):
@@ -32,7 +30,9 @@ def write_initial(config):
     vgrid_file = config['vgrid_file']
     grid_file = config['grid_file']
     output_file = config['output_file']
+    output_format = config.get('output_format', 'NETCDF3_64BIT')
     reuse_weights = config.get('reuse_weights', False)
+    vertical_remapping = config.get('vertical_remapping', 'linear')
 
     variable_names = config.get('variable_names', {})
     temp_var = variable_names.get('temperature', 'thetao')
@@ -57,17 +57,19 @@ def write_initial(config):
     # Round time down to midnight
     glorys['time'] = (('time', ), glorys['time'].dt.floor('1d').data)
    
-    # Interpolate GLORYS vertically onto target grid.
+    # Interpolate (or conservatively remap) GLORYS vertically onto target grid.
     # Depths below bottom of GLORYS are filled by extrapolating the deepest available value.
-    revert = glorys.interp(depth=ztarget, kwargs={'fill_value': 'extrapolate'}).ffill('zl', limit=None)
-
-    # Flood temperature and salinity over land. 
-    flooded = xarray.merge((
-        flood.flood_kara(revert[v], zdim='zl') for v in [temp_var, sal_var, u_var, v_var]
-    ))
+    remapper = VerticalRemapper(
+        glorys['depth'].values, z, method=vertical_remapping, extrapolate=True,
+        target_interfaces=vgrid_to_interfaces(vgrid)
+    )
+    revert = remapper(glorys, 'depth').ffill('zl', limit=None)
 
-    # flood zos separately to avoid the extra z=0 added by flood_kara.
-    flooded[ssh_var] = flood.flood_kara(revert[ssh_var]).isel(z=0).drop('z')
+    # Flood over land, one level at a time (lazily, as the output is written).
+    flooded = (
+        flood_missing(revert[[temp_var, sal_var, ssh_var, u_var, v_var]], zdim='zl')
+        .reset_coords(drop=True)
+    )
 
     # Horizontally interpolate the vertically interpolated and flooded data onto the MOM grid. 
     target_grid = xarray.open_dataset(grid_file)
@@ -132,10 +134,10 @@ def write_initial(config):
         os.makedirs(output_folder)   
 
     # output results
-    interped.to_netcdf(
+    write_dataset(
+        interped,
         output_file,
-        format='NETCDF3_64BIT',
-        engine='netcdf4',
+        format=output_format,
         encoding=encodings,
         unlimited_dims='time'
     )
@@ -1,33 +1,19 @@
 import numpy as np
+import os
 import pandas as pd 
+import scipy.sparse
 import xesmf
 import xarray
 import sys
 import copy
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(script_dir, '../..'))
+from pour_points import find_pour_points
+from runoff_operator import RunoffOperator, index_matrix, input_signature, load_or_build, operator_key
 import warnings
 warnings.filterwarnings("ignore")
 
-def update_stencil_sum(ocean_mask):
-    
-    # Make 3x3 stensil 
-    sten_nlat = 3
-    sten_nlon = 3
-
-    glofas_stensil_sum = np.zeros(ocean_mask.shape)
-    for nlat in range(sten_nlat):
-        ilat_last = -(2-nlat)
-        if ilat_last == 0:
-            ilat_last = None
-        
-        for nlon in range(sten_nlon):
-            ilon_last = -(2-nlon)
-            if ilon_last == 0:
-                ilon_last = None
-       
-            glofas_stensil_sum[1:-1,1:-1] += ocean_mask[nlat:ilat_last,nlon:ilon_last]
-        
-    return glofas_stensil_sum 
-
 def get_glofas_pour_points():
     ldd_modified = copy.deepcopy(ldd)
     # GloFAS VERSION 3: editing pour points along map seam in Russia at date line. 
@@ -48,24 +34,8 @@ def get_glofas_pour_points():
     lon_idx = np.where(np.round(glofas_lon,3) == 236.475)[0][0]
     ldd_modified[lat_idx,lon_idx]=5 # change to 5 to advance halo point   
     
-    glofas_ocean_mask = np.isnan(ldd)
-
-    # initialize the while loop
-    n_updates = 1
-
-    # continue 
-    while n_updates>0:
-        n_updates = 0
-        ocean_stencil_sum = update_stencil_sum(glofas_ocean_mask)    
-        for jj in range(len(glofas_lat)):
-            for ii in range(len(glofas_lon)):
-            
-                if (ldd_modified[jj,ii]==5) and (glofas_ocean_mask[jj,ii]==0) and (ocean_stencil_sum[jj,ii]>0):
-                    # update ocean mask so counted in next calculation of the stencil sum
-                    glofas_ocean_mask[jj,ii] = 1
-                    n_updates+=1
-                
-    pour_points = (ldd_modified==5)*(ocean_stencil_sum>0)
+    # Pour points are outlets (ldd==5) in a 3x3 stencil with the ocean or with other pour points
+    pour_points = find_pour_points(ldd_modified, ocean=np.isnan(ldd))
     
     return pour_points
 
@@ -85,23 +55,9 @@ def get_mom_mask_for_glofas():
     return mom_mask_for_glofas.astype(bool)
 
 
-def write_runoff(glofas, hgrid, coast_mask, out_file):
-    # From Alistair
-    area = (hgrid.area[::2, ::2] + hgrid.area[1::2, 1::2]) + (hgrid.area[1::2, ::2] + hgrid.area[::2, 1::2])
-
-    pour_points = get_glofas_pour_points()
-    glofas_mom_pour_points = pour_points*get_mom_mask_for_glofas()
-
-    # Identify nearest coastal land point to GloFAS pour points
-    # Source pour points indices
-    flat_pour_point_mask = glofas_mom_pour_points.ravel().astype('bool')
-    pour_lon = glo_lons.ravel()[flat_pour_point_mask]
-    pour_lat = glo_lats.ravel()[flat_pour_point_mask]
-    #linear index of glofas_elements
-    glo_id = np.arange(np.prod(glofas_mom_pour_points.shape))
-    pour_id = glo_id[flat_pour_point_mask]
-
-    # Coastal destination indices
+def get_nearest_coast(coast_mask, dest_lat, dest_lon):
+    # Flat index of the nearest coastal cell in the MOM domain for every destination point
+    # Coastal source indices
     # Flatten mask and coordinates to 1D
     flat_coast_mask = coast_mask.ravel().astype('bool')
     coast_lon = lon.ravel()[flat_coast_mask]
@@ -110,48 +66,86 @@ def write_runoff(glofas, hgrid, coast_mask, out_file):
     mom_id = np.arange(np.prod(coast_mask.shape))
     coast_id = mom_id[flat_coast_mask]
     # Use xesmf to find the index of the nearest coastal cell
-    # for every grid cell in the MOM domain
-    glo_coast_to_mom = xesmf.Regridder(
+    coast_to_dest = xesmf.Regridder(
        {'lat': coast_lat, 'lon': coast_lon},
-       {'lat': pour_lat, 'lon': pour_lon},
+       {'lat': dest_lat, 'lon': dest_lon},
        method='nearest_s2d',
        locstream_in=True,
        locstream_out=True,
        reuse_weights=False)
+    return coast_to_dest(coast_id).ravel()
 
-    nearest_glo_coast = glo_coast_to_mom(coast_id).ravel()
-    
-    tmp_glo_values = glofas.values
+def get_glofas_operator(coast_mask, area, glofas_mom_pour_points, use_hill=False):
+    # Operator that maps GloFAS discharge (m3 s-1) to runoff (kg m-2 s-1) in MOM coastal cells
+    # from the GloFAS pour points in the MOM domain
+    # Identify nearest coastal land point to GloFAS pour points
+    # Source pour points indices
+    flat_pour_point_mask = glofas_mom_pour_points.ravel().astype('bool')
+    pour_lon = glo_lons.ravel()[flat_pour_point_mask]
+    pour_lat = glo_lats.ravel()[flat_pour_point_mask]
+    #linear index of glofas_elements
+    glo_id = np.arange(np.prod(glofas_mom_pour_points.shape))
+    pour_id = glo_id[flat_pour_point_mask]
+    nearest_glo_coast = get_nearest_coast(coast_mask, pour_lat, pour_lon)
+
+    # Add each GloFAS pour point to the nearest coastal cell
+    npoints = np.prod(coast_mask.shape)
+    glofas_to_coast = index_matrix(nearest_glo_coast, pour_id, (npoints, len(glo_id)))
+
+    if use_hill:
+        # Coastal cells that get Hill et al. discharge do not get GloFAS discharge
+        keep = np.ones(npoints)
+        keep[np.unique(get_nearest_coast(coast_mask, hill_lat, hill_lon))] = 0
+        glofas_to_coast = scipy.sparse.diags(keep) @ glofas_to_coast
+
+    # Convert to kg m-2 s-1: multiply by 1000 kg m-3 and divide by grid cell area in m2
+    to_kg = scipy.sparse.diags(1000/area.values.ravel())
+    return RunoffOperator(to_kg @ glofas_to_coast, coast_mask.shape)
+
+def get_hill_operator(coast_mask, area):
+    # Operator that maps Hill et al. discharge (m3 d-1) to runoff (kg m-2 s-1) in MOM coastal cells
+    nearest_hill_coast = get_nearest_coast(coast_mask, hill_lat, hill_lon)
+    # Add each Hill et al. point to the nearest coastal cell
+    hill_to_coast = index_matrix(nearest_hill_coast, np.arange(len(nearest_hill_coast)),
+                                 (np.prod(coast_mask.shape), len(nearest_hill_coast)))
+    # m3 d-1 -> m3 s-1 -> kg m-2 s-1
+    to_kg = scipy.sparse.diags(1000/(24*60*60)/area.values.ravel())
+    return RunoffOperator(to_kg @ hill_to_coast, coast_mask.shape)
+
+def hill_time(year, month, day):
+    """Times of the Hill discharge records from their year, month and day."""
+    return pd.to_datetime({'year': np.asarray(year), 'month': np.asarray(month), 'day': np.asarray(day)}).values
 
-    # discharge on GloFAS grid, reshaped to 2D (time, grid_id)
-    raw = tmp_glo_values.reshape([glofas.shape[0],-1])
+def write_runoff(glofas, hgrid, coast_mask, out_file):
+    # From Alistair
+    area = (hgrid.area[::2, ::2] + hgrid.area[1::2, 1::2]) + (hgrid.area[1::2, ::2] + hgrid.area[::2, 1::2])
 
-    # Zero array that will be filled with runoff at coastal cells
-    mom_glo_filled = np.zeros((raw.shape[0],np.prod(ocn_mask.shape)))
+    # Hill et al product only extends to mid 2021 so only including through 2020
+    use_hill = yr < 2021
+
+    # The mappings from GloFAS and Hill et al. to the NEP coast are built by the first job
+    # and saved in the output directory, so the jobs for other years only load them.
+    # They are keyed by the grid, mask and ldd files, the GloFAS pour points in the MOM domain 
+    # (including the edits in get_glofas_pour_points) and the GloFAS and Hill et al. coordinates,
+    # so that changing any of them builds new mappings.
+    glofas_mom_pour_points = get_glofas_pour_points()*get_mom_mask_for_glofas()
+    grid_inputs = [input_signature(f) for f in [ocean_static_file, hgrid_file, ldd_file]]
+    if use_hill:
+        glofas_key = operator_key(grid_inputs, glofas_mom_pour_points, glofas_lat, glofas_lon, hill_lat, hill_lon)
+        operator_file = outdir + f'glofas_hill_to_nep_operator_{glofas_key}.npz'
+    else:
+        glofas_key = operator_key(grid_inputs, glofas_mom_pour_points, glofas_lat, glofas_lon)
+        operator_file = outdir + f'glofas_to_nep_operator_{glofas_key}.npz'
+    glofas_operator = load_or_build(operator_file, get_glofas_operator, coast_mask, area, glofas_mom_pour_points, use_hill=use_hill)
 
-    # Loop over each GloFAS pour point and add it to the nearest coastal cell
-    for mom_i, glo_i in zip(nearest_glo_coast,pour_id):
-        mom_glo_filled[:, mom_i] += raw[:, glo_i] 
+    # discharge on GloFAS grid mapped to runoff at coastal cells in kg m-2 s-1
+    filled_reshape = glofas_operator(glofas)
 
-    # Hill et al product only extends to mid 2021 so only including through 2020
-    if yr < 2021:
-       hill_coast_to_mom = xesmf.Regridder({'lat': coast_lat, 'lon': coast_lon},
-                                 {'lat': hill_lat, 'lon': hill_lon},
-                                 method='nearest_s2d',
-                                 locstream_in=True,
-                                 locstream_out=True,
-                                 reuse_weights=False) 
-       nearest_hill_coast = hill_coast_to_mom(coast_id).ravel()
-       # Loop over each GloFAS pour point and add it to the nearest coastal cell
-       mom_hill_filled = np.zeros(([raw.shape[0],np.prod(ocn_mask.shape)]))
-       for mom_i, hill_i in zip(nearest_hill_coast, range(len(nearest_hill_coast))):
-           mom_hill_filled[:, mom_i] += hdis.values[:, hill_i]/(24*60*60) # m3 d-1 -> m3 s-1
-
-       # replace glofas_filled indicies with hill values
-       mom_glo_filled[:,np.unique(nearest_hill_coast)] = mom_hill_filled[:,np.unique(nearest_hill_coast)]
-
-    # Reshape back to 3D and convert to kg m-2 s-1: multiply by 1000 kg m-3 and divide by grid cell area in m2
-    filled_reshape = 1000*mom_glo_filled.reshape((glofas.shape[0],ocn_mask.shape[0],ocn_mask.shape[1]))/area.values
+    if use_hill:
+       # replace GloFAS runoff with Hill et al. runoff where the Hill et al. points are
+       hill_key = operator_key(grid_inputs, hill_lat, hill_lon)
+       hill_operator = load_or_build(outdir + f'hill_to_nep_operator_{hill_key}.npz', get_hill_operator, coast_mask, area)
+       filled_reshape += hill_operator(hdis)
 
     # Convert to xarray
     ds = xarray.Dataset({
@@ -195,7 +189,8 @@ def write_runoff(glofas, hgrid, coast_mask, out_file):
 
 if __name__ == '__main__':
     # Determine coastal points in NEP domain
-    ocn_mask = xarray.open_dataset('/work/Liz.Drenkard/mom6/NEP_ocean_static_nomask.nc').wet.values.astype(bool)
+    ocean_static_file = '/work/Liz.Drenkard/mom6/NEP_ocean_static_nomask.nc'
+    ocn_mask = xarray.open_dataset(ocean_static_file).wet.values.astype(bool)
     
     stencil_sum = 0 * ocn_mask
     
@@ -224,14 +219,16 @@ if __name__ == '__main__':
     coast = (ocn_mask)*(stencil_sum)
 
     # Load regional ocean hgrid
-    hgrid = xarray.open_dataset( '/work/Liz.Drenkard/mom6/nep_10km/setup/grid/ocean_hgrid.nc')
+    hgrid_file = '/work/Liz.Drenkard/mom6/nep_10km/setup/grid/ocean_hgrid.nc'
+    hgrid = xarray.open_dataset(hgrid_file)
     lon = hgrid.x[1::2, 1::2].values
     lonb = hgrid.x[::2, ::2].values
     lat = hgrid.y[1::2, 1::2].values
     latb = hgrid.y[::2, ::2].values 
      
     # Load GloFAS local drain direction map
-    ldd = xarray.open_dataset('/work/Liz.Drenkard/mom6/nep_10km/setup/runoff/ncks_glofas/ldd_v4.0_NEP_subset.nc').ldd.values
+    ldd_file = '/work/Liz.Drenkard/mom6/nep_10km/setup/runoff/ncks_glofas/ldd_v4.0_NEP_subset.nc'
+    ldd = xarray.open_dataset(ldd_file).ldd.values
     
     # GloFAS Version 3.1: Mackenzie river patch
     #ldd[132,743:746]=5
@@ -262,7 +259,7 @@ if __name__ == '__main__':
     if yr < 2021: 
         hill_files = [f'/work/Liz.Drenkard/external_data/goa_freshwater_discharge/goa_dischargex_0901{y}_0831{y+1}.nc' for y in [yr-1, yr]]
         hill = xarray.open_mfdataset(hill_files,combine='nested',concat_dim='time')
-        hill['time'] = pd.to_datetime([(str(hill.year.values[nt])+'-'+str(hill.month.values[nt]).zfill(2)+'-'+str(hill.day.values[nt]).zfill(2)) for nt in range(len(hill.day))])
+        hill['time'] = hill_time(hill.year.values, hill.month.values, hill.day.values)
 
     # using climatological hill data with 2021 half year
     elif yr == 2021:
@@ -272,37 +269,19 @@ if __name__ == '__main__':
         years = hill.year.values
         years[years==1992] = 2021
         years[years==1993] = 2022
-        hill['time'] = pd.to_datetime([(str(years[nt])+'-'+str(hill.month.values[nt]).zfill(2)+'-'+str(hill.day.values[nt]).zfill(2)) for nt in range(len(hill.day))])
+        hill['time'] = hill_time(years, hill.month.values, hill.day.values)
 
     # using only hill climatological data
     else:
         hill_files = ['/work/Liz.Drenkard/external_data/goa_freshwater_discharge/goa_dischargex_09011991_08312021_clim.nc',
                      '/work/Liz.Drenkard/external_data/goa_freshwater_discharge/goa_dischargex_09011991_08312021_clim.nc']
         hill = xarray.open_mfdataset(hill_files,combine='nested',concat_dim='time')
-        years = hill.year.values
-        months = hill.month.values
-        days = hill.day.values
-
-        # updating the years and days for respective years
-        middle_year_start = np.argmax(years)
-        years[:middle_year_start] = yr-1
-        middle_year_seam_start = np.argmin(years) + int(yr%4==0) # leap year condition on the end 
-
-        # leap year condition for updating days, months
-        if yr%4 == 0:
-            # find location of 28th day of february
-            leap_day_28 = np.where(days==28)[0][5]
-            # add "29" day after Feb 28 (shifts days by 1 day); drop last day in file
-            days = np.append(np.append(days[:leap_day_28+1],29),days[leap_day_28+1:-1])
-            # add "2" day after Feb 28 (shifts months by 1 day); drop last day in file
-            months = np.append(np.append(months[:leap_day_28+1],2),months[leap_day_28+1:-1])
-            
-        years[middle_year_start:middle_year_seam_start] = yr
-        middle_year_end = np.argmax(years==1993) + int(yr%4==0) # leap year condition on the end
-        years[middle_year_seam_start:middle_year_end] = yr
-        years[middle_year_end:] = yr+1
-
-        hill['time'] = pd.to_datetime([(str(years[nt])+'-'+str(months[nt]).zfill(2)+'-'+str(days[nt]).zfill(2)) for nt in range(len(hill.day))])
+        # Two climatological years (each from September 1 to August 31) used as consecutive days from
+        # September 1 of the previous year. In a leap year, the days after February 28 are shifted by a day
+        # to make room for February 29, and the last day is dropped (as it is after the end of the year).
+        # Unlike earlier versions of this script, a February 29 in the year after yr is also labelled, so
+        # the times after it are a day later than before; these are all outside the selected window.
+        hill['time'] = pd.date_range(f'{yr-1}-09-01', periods=hill.sizes['time'], freq='D')
 
     hdis = hill.sel(time=slice(f'{yr-1}-12-31 12:00:00', f'{yr+1}-01-01 12:00:00')).q   
     hill_lat = hill.lat.values
@@ -1,40 +1,103 @@
 #!/usr/bin/env python3
 """
-This script generates climatological monthly runoff 
+This script generates climatological monthly runoff
 from the runoff files created by write_runoff_glofas.py
+(the average over years of the monthly mean runoff in each year).
+Years are read one at a time and added to running sums,
+so memory use does not depend on the number of years.
 How to use:
-./write_glofas_ave.py
+./write_glofas_ave.py [--files PATTERN] [--first_year 1993] [--last_year 2019] [--output glofas_runoff_mean]
 """
+import argparse
+
+import numpy as np
 from scipy.io import savemat
 import xarray
 
 
-averages = []
+class MonthlyClimatology():
+    """Running average over years of monthly means.
+    Only the sums and number of years for each month and grid point are kept.
+    Missing values are skipped, as in xarray's mean.
+    """
 
-for y in range(1993, 2020):
-    print(y)
-    ds = xarray.open_dataset(
-        f'/work/acr/mom6/nwa12/glofas/glofas_runoff_{y}.nc',
-        chunks=dict(time=100)
-    )
+    def __init__(self):
+        self.sums = None
+        self.counts = None
+
+    def add(self, monthly):
+        """Add the monthly means (month, y, x) of one year, with month numbered 1 to 12."""
+        if self.sums is None:
+            shape = (12, ) + monthly.shape[1:]
+            self.sums = np.zeros(shape)
+            self.counts = np.zeros(shape, dtype='int64')
+        index = monthly['month'].values - 1
+        values = monthly.values
+        valid = ~np.isnan(values)
+        self.sums[index] += np.where(valid, values, 0.0)
+        self.counts[index] += valid
+
+    def mean(self):
+        """Climatological mean for each month (nan where there is no data)."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.counts > 0, self.sums / self.counts, np.nan)
 
+
+def monthly_mean(filename, year, time_chunk=100):
+    """Monthly mean runoff in one year of a runoff file, read time_chunk records at a time.
+    Also returns the dataset for the grid variables."""
+    ds = xarray.open_dataset(filename, chunks=dict(time=time_chunk))
     ave = (
         ds
         ['runoff']
-        .sel(time=slice(f'{y}-01-01', f'{y}-12-31'))
+        .sel(time=slice(f'{year}-01-01', f'{year}-12-31'))
         .groupby('time.month')
         .mean('time')
         .compute()
     )
-    averages.append(ave)
-
-all_average = xarray.concat(averages, dim='year').mean('year')
-savemat(
-    './glofas_runoff_mean.mat',
-    {
-        'lat_mod': ds.lat.values, 
-        'lon_mod': ds.lon.values, 
-        'area_mod': ds.area.values,
-        'runoff': all_average.values
-    }
-)
+    return ave, ds
+
+
+def write_climatology(files, first_year, last_year, output):
+    climatology = MonthlyClimatology()
+    for y in range(first_year, last_year + 1):
+        print(y)
+        ave, ds = monthly_mean(files.format(year=y), y)
+        climatology.add(ave)
+        grid = ds[['lat', 'lon', 'area']].load()
+        ds.close()
+
+    runoff = climatology.mean()
+    savemat(
+        f'{output}.mat',
+        {
+            'lat_mod': grid.lat.values,
+            'lon_mod': grid.lon.values,
+            'area_mod': grid.area.values,
+            'runoff': runoff
+        }
+    )
+    out = grid.assign(
+        runoff=(('month', ) + grid.lat.dims, runoff, {'units': 'kg m-2 s-1', 'long_name': f'Mean runoff {first_year}-{last_year}'})
+    )
+    out = out.assign_coords(month=np.arange(1, 13))
+    # The runoff files have an unlimited time dimension, which the climatology does not
+    out.encoding.pop('unlimited_dims', None)
+    out.to_netcdf(f'{output}.nc')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate climatological monthly runoff from yearly runoff files.')
+    parser.add_argument('--files', default='/work/acr/mom6/nwa12/glofas/glofas_runoff_{year}.nc',
+                        help='Runoff files, with {year} in place of the year')
+    parser.add_argument('--first_year', type=int, default=1993, help='First year of the climatology')
+    parser.add_argument('--last_year', type=int, default=2019, help='Last year of the climatology')
+    parser.add_argument('--output', default='./glofas_runoff_mean',
+                        help='Output file name without extension; .mat and .nc files are written')
+    args = parser.parse_args()
+
+    write_climatology(args.files, args.first_year, args.last_year, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Finding GloFAS pour points (river outlets that drain into the ocean) from the local drainage direction (ldd) map.
+Shared by the NWA (write_runoff_glofas.py) and NEP (bgc/NEP/write_runoff_glofas_hill_dis_batch_v4.py) runoff scripts.
+"""
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import ndimage
+
+
+def expand_mask_true(mask, window):
+    """Given a 2D bool mask, expand the true values of the
+    mask so that at a given point, the mask becomes true
+    if any point within a window x window box
+    is true.
+    Note, points near the edges of the mask, where the
+    box would expand beyond the mask, are always set to false.
+
+    Args:
+        mask: 2D boolean numpy array
+        window: width of the square box used to expand the mask
+
+    """
+    wind = sliding_window_view(mask, (window, window))
+    wind_mask = wind.any(axis=(2, 3))
+    final_mask = np.zeros_like(mask)
+    i = int((window - 1) / 2) # width of edges that can't fit a full box
+    final_mask[i:-i, i:-i] = wind_mask
+    return final_mask.astype('bool')
+
+
+def find_pour_points(ldd, ocean=None, window=3):
+    """Find the pour points: points where ldd == 5 (river outlets) that are next to the ocean,
+    or next to another pour point, where next to means within a window x window box.
+    Like expand_mask_true, points near the edges of the grid are never pour points.
+
+    This is the result of repeatedly adding outlets next to the ocean or to the pour points found so far
+    until nothing changes, but all of the passes are done at once by a binary dilation
+    restricted to the outlets.
+
+    Args:
+        ldd: 2D local drainage direction (5 at outlets, nan over the ocean).
+        ocean: 2D boolean mask of the ocean. Defaults to where ldd is nan.
+        window: width of the square box used to find neighbors. Defaults to 3.
+
+    Returns:
+        numpy.ndarray: 2D boolean mask of the pour points.
+    """
+    ldd = np.asarray(ldd)
+    ocean = np.isnan(ldd) if ocean is None else np.asarray(ocean, dtype='bool')
+    outlets = ldd == 5
+    # Outlets that can be reached from the ocean; edges can't fit a full box
+    reachable = np.zeros_like(outlets)
+    i = int((window - 1) / 2)
+    reachable[i:-i, i:-i] = outlets[i:-i, i:-i]
+    connected = ndimage.binary_dilation(
+        reachable & expand_mask_true(ocean, window),
+        structure=np.ones((window, window), dtype='bool'),
+        iterations=0,  # repeat until nothing changes
+        mask=reachable
+    )
+    return outlets & expand_mask_true(ocean | connected, window)
@@ -0,0 +1,254 @@
+"""
+Sparse operators that map river discharge from a source grid (e.g. GloFAS) to runoff on a MOM6 grid.
+Every step of the mapping (unit conversion, regridding, region edits, moving runoff to the
+nearest coastal cell) is linear, apart from constant terms in flow corrections, so the whole chain
+can be composed once into a single sparse matrix and offset, saved to disk,
+and applied to every timestep of every year.
+
+Domain-specific edits to the runoff on the MOM grid are given as a list of rules
+(e.g. runoff_rules in the YAML configuration) that are compiled into the operator:
+
+    # Remove runoff in a region, given as an index box (y and x as [start, stop] slice bounds, 
+    # either of which can be null), a lon/lat box, or a lon/lat polygon
+    - zero: {y: [0, 190], x: [0, 10]}
+    - zero: {lon: [-95, -75], lat: [50, 65]}
+    - zero: {polygon: [[-92, 14], [-88, 13], [-88, 16]]}
+    # Correct the total flow (m3 s-1) in a region to slope * total + intercept, 
+    # and move it to the given [y, x] points, split evenly
+    - correct: {from: {y: [317, 320], x: [106, 108]}, to: [[314, 108], [317, 112]], slope: 0.5, intercept: 3000}
+    # Send runoff in a region to the coastal cell nearest to the given [y, x] point 
+    # instead of the coastal cell nearest to each point in the region
+    - relocate: {from: {y: [460, 480], x: [265, 278]}, to: [455, 271]}
+
+zero and correct rules are applied in order; relocate rules change where runoff is moved to the coast.
+"""
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+import scipy.sparse
+import xarray
+
+
+class RunoffOperator():
+    """Affine map from source data to runoff on a destination grid:
+    runoff = matrix @ source + offset for each timestep.
+
+    Args:
+        matrix: sparse matrix of shape (destination points, source points).
+        shape (tuple): shape of the destination grid.
+        offset (array, optional): constant added to each destination point. Defaults to zero.
+    """
+
+    def __init__(self, matrix, shape, offset=None):
+        self.matrix = scipy.sparse.csr_matrix(matrix)
+        self.matrix.eliminate_zeros()
+        self.shape = tuple(shape)
+        self.offset = np.zeros(self.matrix.shape[0]) if offset is None else np.asarray(offset, dtype='float64').ravel()
+
+    def __call__(self, source, time_chunk=100):
+        """Apply the operator to every timestep of the source data.
+
+        Args:
+            source: array-like (numpy, dask or xarray) with time as the first dimension
+                and the source points (flattened in C order) as the remaining dimensions.
+                Missing values are treated as zero.
+            time_chunk (int, optional): Number of timesteps read and mapped at once. Defaults to 100.
+
+        Returns:
+            numpy.ndarray of shape (time, *shape).
+        """
+        ntime = source.shape[0]
+        # Only the source points that contribute to the output are used
+        columns = np.unique(self.matrix.indices)
+        matrix = self.matrix[:, columns]
+        result = np.empty((ntime, matrix.shape[0]))
+        for start in range(0, ntime, time_chunk):
+            block = np.asarray(source[start:start + time_chunk])
+            block = np.nan_to_num(block.reshape(len(block), -1)[:, columns])
+            result[start:start + len(block)] = (matrix @ block.T).T + self.offset
+        return result.reshape((ntime, ) + self.shape)
+
+    def save(self, filename):
+        """Save the operator to a .npz file, replacing any existing file only once it is completely written."""
+        fd, tmpfile = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(os.path.abspath(filename)))
+        os.close(fd)
+        np.savez(
+            tmpfile, data=self.matrix.data, indices=self.matrix.indices, indptr=self.matrix.indptr,
+            matrix_shape=self.matrix.shape, shape=self.shape, offset=self.offset
+        )
+        os.replace(tmpfile, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Load an operator saved with RunoffOperator.save."""
+        with np.load(filename) as f:
+            matrix = scipy.sparse.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['matrix_shape']))
+            return cls(matrix, tuple(f['shape']), f['offset'])
+
+
+def load_or_build(filename, build, *args, **kwargs):
+    """Load an operator from filename if it exists, otherwise create it with build(*args, **kwargs) and save it.
+    Include operator_key of everything the operator is built from in filename, 
+    so that changing the grids or settings builds a new operator instead of reusing a stale one.
+    """
+    if os.path.isfile(filename):
+        print(f'Reusing runoff operator {filename}')
+        return RunoffOperator.load(filename)
+    operator = build(*args, **kwargs)
+    operator.save(filename)
+    return operator
+
+
+def regrid_matrix(regridder):
+    """Weights of an xesmf.Regridder as a scipy CSR matrix of shape (destination points, source points)."""
+    weights = regridder.weights
+    if isinstance(weights, xarray.DataArray):
+        weights = weights.data
+    if hasattr(weights, 'to_scipy_sparse'):
+        # sparse.COO, used by newer versions of xesmf
+        weights = weights.to_scipy_sparse()
+    return scipy.sparse.csr_matrix(weights)
+
+
+def _in_polygon(x, y, vertices):
+    # Even-odd rule: a point is inside if a ray from it crosses the edges an odd number of times
+    inside = np.zeros(x.shape, dtype='bool')
+    for (x0, y0), (x1, y1) in zip(vertices, np.roll(vertices, -1, axis=0)):
+        crosses = (y0 > y) != (y1 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xcross = x0 + (y - y0) * (x1 - x0) / (y1 - y0)
+        inside ^= crosses & (x < xcross)
+    return inside
+
+
+def region_mask(region, lon, lat):
+    """Boolean mask of the grid points in a region of a runoff rule.
+
+    Args:
+        region (dict): {'y': [start, stop], 'x': [start, stop]} for an index box (like Python slices;
+            omitted or null bounds extend to the edge of the grid), {'lon': [west, east], 'lat': [south, north]}
+            for a lon/lat box, or {'polygon': [[lon, lat], ...]} for a polygon.
+        lon: 2D longitude of the grid points.
+        lat: 2D latitude of the grid points.
+
+    Returns:
+        numpy.ndarray: mask with the shape of the grid.
+    """
+    lon = np.asarray(lon)
+    lat = np.asarray(lat)
+    if 'polygon' in region:
+        vertices = np.asarray(region['polygon'], dtype='float64')
+        # Put longitudes in the same range as the polygon
+        west = vertices[:, 0].min()
+        return _in_polygon((lon - west) % 360 + west, lat, vertices)
+    elif 'lon' in region or 'lat' in region:
+        mask = np.ones(lon.shape, dtype='bool')
+        if 'lon' in region:
+            west, east = region['lon']
+            mask &= (lon - west) % 360 <= (east - west) % 360
+        if 'lat' in region:
+            south, north = region['lat']
+            mask &= (lat >= south) & (lat <= north)
+        return mask
+    elif 'y' in region or 'x' in region:
+        mask = np.zeros(lon.shape, dtype='bool')
+        mask[slice(*region.get('y', [None, None])), slice(*region.get('x', [None, None]))] = True
+        return mask
+    else:
+        raise ValueError(f'Region must have y/x, lon/lat or polygon: {region}')
+
+
+def compile_rules(rules, lon, lat, area):
+    """Compile runoff rules (see the module docstring) for runoff in kg m-2 s-1 on a grid.
+
+    Args:
+        rules (list of dict): Rules, each with one key (zero, correct or relocate).
+        lon: 2D longitude of the grid points.
+        lat: 2D latitude of the grid points.
+        area: 2D area of the grid cells (m2).
+
+    Returns:
+        tuple: sparse matrix and offset of the zero and correct rules (edited = matrix @ runoff + offset),
+            and a list of (flat indices of the region, flat index of the point) for each relocate rule.
+    """
+    flat_area = np.asarray(area).ravel()
+    npoints = len(flat_area)
+    matrix = scipy.sparse.identity(npoints, format='csr')
+    offset = np.zeros(npoints)
+    relocations = []
+    for rule in rules or []:
+        if len(rule) != 1:
+            raise ValueError(f'Each runoff rule must have exactly one of zero, correct or relocate: {rule}')
+        kind, spec = next(iter(rule.items()))
+        if kind == 'zero':
+            keep = ~region_mask(spec, lon, lat).ravel()
+            step = scipy.sparse.diags(keep.astype('float64'))
+            step_offset = np.zeros(npoints)
+        elif kind == 'correct':
+            source = np.flatnonzero(region_mask(spec['from'], lon, lat))
+            dest = np.ravel_multi_index(tuple(np.atleast_2d(spec['to']).T), np.shape(area))
+            keep = np.ones(npoints)
+            keep[source] = 0.0
+            keep[dest] = 0.0
+            # Total flow in m3 s-1 is sum(runoff * area) / 1000, 
+            # and each destination point gets its share of the corrected total back in kg m-2 s-1
+            rows = np.repeat(dest, len(source))
+            cols = np.tile(source, len(dest))
+            move = scipy.sparse.csr_matrix(
+                (spec.get('slope', 1.0) / len(dest) * flat_area[cols] / flat_area[rows], (rows, cols)),
+                shape=(npoints, npoints)
+            )
+            step = scipy.sparse.diags(keep) + move
+            step_offset = np.zeros(npoints)
+            step_offset[dest] = spec.get('intercept', 0.0) / len(dest) * 1000.0 / flat_area[dest]
+        elif kind == 'relocate':
+            source = np.flatnonzero(region_mask(spec['from'], lon, lat))
+            relocations.append((source, np.ravel_multi_index(tuple(spec['to']), np.shape(area))))
+            continue
+        else:
+            raise ValueError(f'Unknown runoff rule {kind}')
+        matrix = step @ matrix
+        offset = step @ offset + step_offset
+    return matrix, offset, relocations
+
+
+def input_signature(path):
+    """Path, size and modification time of an input file (only the path if it can't be found),
+    so that operators are rebuilt when an input file changes."""
+    if os.path.exists(path):
+        stat = os.stat(path)
+        return [path, stat.st_size, stat.st_mtime_ns]
+    return [path]
+
+
+def operator_key(*inputs):
+    """Short hash of everything an operator is built from, so that operators built from different inputs 
+    are saved to different files. Inputs can be rules and other settings, input_signature of files, 
+    or numpy arrays such as source grid coordinates (hashed by content)."""
+    h = hashlib.sha256()
+    for x in inputs:
+        if isinstance(x, np.ndarray):
+            h.update(f'{x.dtype}{x.shape}'.encode())
+            h.update(np.ascontiguousarray(x).tobytes())
+        else:
+            h.update(json.dumps(x, sort_keys=True).encode())
+    return h.hexdigest()[:12]
+
+
+def index_matrix(dest_index, source_index, shape):
+    """Sparse matrix that adds each source point source_index[k] to the destination point dest_index[k].
+
+    Args:
+        dest_index: flat indices of the destination points.
+        source_index: flat indices of the source points.
+        shape (tuple): (number of destination points, number of source points).
+
+    Returns:
+        scipy.sparse.csr_matrix
+    """
+    dest_index = np.asarray(dest_index).ravel().astype('int64')
+    source_index = np.asarray(source_index).ravel().astype('int64')
+    return scipy.sparse.csr_matrix((np.ones(len(dest_index)), (dest_index, source_index)), shape=shape)
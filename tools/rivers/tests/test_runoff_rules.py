@@ -0,0 +1,89 @@
+"""The NWA12 runoff rules in runoff_glofas.yaml, compiled by runoff_operator.compile_rules, compared with
+the edits that were previously hard-coded in write_runoff_glofas.py."""
+import os
+import sys
+
+import numpy as np
+import yaml
+
+rivers_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, rivers_dir)
+from runoff_operator import compile_rules, region_mask  # noqa: E402
+
+# Big enough for all of the NWA12 index boxes
+SHAPE = (760, 300)
+
+
+def nwa12_rules():
+    with open(os.path.join(rivers_dir, 'runoff_glofas.yaml')) as f:
+        return yaml.safe_load(f)['runoff_rules']
+
+
+def synthetic_grid():
+    rng = np.random.default_rng(0)
+    lat, lon = np.meshgrid(np.linspace(5, 60, SHAPE[0]), np.linspace(-100, -30, SHAPE[1]), indexing='ij')
+    area = rng.uniform(5e7, 1e8, SHAPE)
+    return lon, lat, area
+
+
+def hard_coded_edits(runoff, area):
+    """Edits to runoff (time, y, x) in kg m-2 s-1 as they were in write_runoff_glofas.py."""
+    runoff = runoff.copy()
+    runoff[:, 0:190, 0:10] = 0.0
+    runoff[:, 0:150, 0:100] = 0.0
+    runoff[:, 0:125, 100:170] = 0.0
+    runoff[:, 0:60, 170:182] = 0.0
+    runoff[:, 0:45, 180:200] = 0.0
+    runoff[:, 0:40, 200:220] = 0.0
+    runoff[:, 0:45, 220:251] = 0.0
+    runoff[:, 0:50, 227:247] = 0.0
+    runoff[:, 0:35, 250:270] = 0.0
+    runoff[:, 0:1, :] = 0.0
+    runoff[:, 700:, 150:300] = 0.0
+    ms_total_kg = runoff[:, 317:320, 106:108]
+    ms_total_cms = (ms_total_kg * np.broadcast_to(area[317:320, 106:108], ms_total_kg.shape)).sum(axis=(1, 2)) / 1000.0
+    ms_corrected = 0.5192110112243014 * ms_total_cms + 3084.5571334312735
+    runoff[:, 317:320, 106:108] = 0.0
+    new_ms_coords = [(314, 108), (315, 107), (317, 112)]
+    for y, x in new_ms_coords:
+        runoff[:, y, x] = (1 / len(new_ms_coords)) * ms_corrected * 1000.0 / float(area[y, x])
+    return runoff
+
+
+def test_zero_and_correct_rules():
+    lon, lat, area = synthetic_grid()
+    runoff = np.random.default_rng(1).uniform(0, 1e-3, (3, ) + SHAPE)
+    matrix, offset, _ = compile_rules(nwa12_rules(), lon, lat, area)
+    edited = (matrix @ runoff.reshape(len(runoff), -1).T).T + offset
+    expected = hard_coded_edits(runoff, area)
+    np.testing.assert_allclose(edited.reshape(runoff.shape), expected, rtol=1e-12, atol=0)
+    # The Mississippi is moved to the three target cells only
+    for y, x in [(314, 108), (315, 107), (317, 112)]:
+        assert (expected[:, y, x] > 0).all()
+    assert (expected[:, 317:320, 106:108] == 0).all()
+
+
+def test_relocate_rule():
+    lon, lat, area = synthetic_grid()
+    _, _, relocations = compile_rules(nwa12_rules(), lon, lat, area)
+    assert len(relocations) == 1
+    # Nearest coastal cell of every grid cell, as found by coast_sum_operator in write_runoff_glofas.py
+    nearest_coast = np.random.default_rng(2).integers(0, np.prod(SHAPE), SHAPE)
+    relocated = nearest_coast.ravel().copy()
+    for region, point in relocations:
+        relocated[region] = relocated[point]
+    # The Susquehanna region goes to the coastal cell of the lower Chesapeake Bay, as before
+    expected = nearest_coast.copy()
+    expected[460:480, 265:278] = nearest_coast[455, 271]
+    np.testing.assert_array_equal(relocated.reshape(SHAPE), expected)
+
+
+def test_region_mask():
+    lon, lat, _ = synthetic_grid()
+    box = region_mask({'y': [700, None], 'x': [150, 300]}, lon, lat)
+    assert box[700:, 150:].all() and box.sum() == 60 * 150
+    lonlat = region_mask({'lon': [-95, -75], 'lat': [50, 65]}, lon, lat)
+    np.testing.assert_array_equal(lonlat, (lon >= -95) & (lon <= -75) & (lat >= 50))
+    # A polygon can be given in 0-360 longitudes (its edges are between grid points here)
+    polygon = region_mask({'polygon': [[265.1, 50.01], [284.9, 50.01], [284.9, 59.99], [265.1, 59.99]]}, lon, lat)
+    np.testing.assert_array_equal(polygon, (lon > -94.9) & (lon < -75.1) & (lat > 50.01) & (lat < 59.99))
@@ -2,16 +2,25 @@
 """
 This script generated runoff from GloFAS data 
 How to use:
-./write_runoff_glofas.py --config runoff_glofas.yaml 
+./write_runoff_glofas.py --config runoff_glofas.yaml [--workers N]
 """
 import numpy as np
-from numpy.lib.stride_tricks import sliding_window_view
 import os
+import sys
 import yaml
 import argparse
+import scipy.sparse
 import xarray
 import xesmf
 
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(script_dir, '../boundary'))
+from boundary import run_tasks, write_dataset
+from pour_points import find_pour_points
+from runoff_operator import (
+    RunoffOperator, compile_rules, index_matrix, input_signature, load_or_build, operator_key, regrid_matrix
+)
+
 def read_config(config_file):
     with open(config_file, 'r') as stream:
         config = yaml.safe_load(stream)
@@ -20,6 +29,7 @@ def read_config(config_file):
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Generate runoff file from GloFAS data.')
     parser.add_argument('--config', '-c', default='runoff_glofas.yaml', help='YAML configuration file')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes to use for writing years in parallel')
     return parser.parse_args()
 
 def get_coast_mask(mask):
@@ -57,28 +67,63 @@ def reuse_regrid(*args, **kwargs):
         return regrid
 
 
-def expand_mask_true(mask, window):
-    """Given a 2D bool mask, expand the true values of the
-    mask so that at a given point, the mask becomes true
-    if any point within a window x window box
-    is true.
-    Note, points near the edges of the mask, where the 
-    box would expand beyond the mask, are always set to false.
+def coast_sum_operator(coast_mask, lon, lat, relocations=()):
+    """Sparse matrix that moves the runoff in every grid cell to its nearest coastal cell.
+    Multiplying it by runoff with shape (grid cells, time) sums, for each coastal cell,
+    the runoff of every grid cell that has it as its closest coastal cell (other rows are zero).
 
     Args:
-        mask: 2D boolean numpy array
-        window: width of the square box used to expand the mask
-
+        coast_mask: 2D array that is 1 at coastal cells.
+        lon: 2D longitude of the MOM grid cell centers.
+        lat: 2D latitude of the MOM grid cell centers.
+        relocations (optional): (flat indices of a region, flat index of a point) for each relocate rule:
+            runoff in the region goes to the coastal cell nearest to the point.
+
+    Returns:
+        scipy.sparse.csr_matrix of shape (grid cells, grid cells).
     """
-    wind = sliding_window_view(mask, (window, window))
-    wind_mask = wind.any(axis=(2, 3))
-    final_mask = np.zeros_like(mask)
-    i = int((window - 1) / 2) # width of edges that can't fit a full box
-    final_mask[i:-i, i:-i] = wind_mask
-    return final_mask.astype('bool')
+    # Flatten mask and coordinates to 1D
+    flat_mask = coast_mask.ravel().astype('bool')
+    coast_lon = lon.values.ravel()[flat_mask]
+    coast_lat = lat.values.ravel()[flat_mask]
+    mom_id = np.arange(np.prod(coast_mask.shape))
 
+    # Use xesmf to find the index of the nearest coastal cell
+    # for every grid cell in the MOM domain
+    coast_to_mom = reuse_regrid(
+        {'lat': coast_lat, 'lon': coast_lon},
+        {'lat': lat, 'lon': lon},
+        method='nearest_s2d',
+        locstream_in=True,
+        reuse_weights=True,
+        filename=os.path.join(os.environ['TMPDIR'], 'coast_to_mom.nc')
+    )
+    coast_id = mom_id[flat_mask]
+    nearest_coast = np.asarray(coast_to_mom(coast_id)).ravel()
+    
+    for region, point in relocations:
+        nearest_coast[region] = nearest_coast[point]
+
+    # One entry per grid cell, in the row of its nearest coastal cell
+    return index_matrix(nearest_coast, mom_id, (len(mom_id), len(mom_id)))
+
+
+def runoff_operator(glofas, glofas_mask, hgrid, coast_mask, rules=None):
+    """Compose every step that maps GloFAS discharge (m3 s-1) to MOM runoff (kg m-2 s-1)
+    into one RunoffOperator: conversion to kg m-2 s-1 at the GloFAS pour points, 
+    conservative regridding to the MOM grid, the region edits given by rules, 
+    and moving runoff to the nearest coastal cell.
 
-def write_runoff(glofas, glofas_mask, hgrid, coast_mask, out_file):
+    Args:
+        glofas: GloFAS discharge (only its lat and lon are used).
+        glofas_mask: 2D mask of the GloFAS pour points.
+        hgrid: MOM supergrid.
+        coast_mask: 2D array that is 1 at MOM coastal cells.
+        rules (list of dict, optional): Region edits (runoff_rules in the config; see runoff_operator.py).
+
+    Returns:
+        RunoffOperator
+    """
     glofas_latb = np.arange(glofas['lat'][0]+.05, glofas['lat'][-1]-.051, -.1)
     glofas_lonb = np.arange(glofas['lon'][0]-.05, glofas['lon'][-1]+.051, .1)
     
@@ -95,8 +140,9 @@ def write_runoff(glofas, glofas_mask, hgrid, coast_mask, out_file):
     dlon = dlat = 0.1  # GloFAS grid spacing
     dx = dlon * np.cos(np.deg2rad(glofas.lat)) * distance_1deg_equator
     dy = ((glofas.lon * 0) + 1) * dlat * distance_1deg_equator
-    glofas_area = dx * dy
-    glofas_kg = glofas * 1000.0 / glofas_area
+    glofas_area = (dx * dy).transpose('lat', 'lon')
+    # Interpolate only from GloFAS points that are river end points.
+    to_kg = scipy.sparse.diags((1000.0 / glofas_area.values * (glofas_mask > 0)).ravel())
     
     # Conservatively interpolate runoff onto MOM grid
     glofas_to_mom_con = reuse_regrid(
@@ -107,85 +153,50 @@ def write_runoff(glofas, glofas_mask, hgrid, coast_mask, out_file):
         reuse_weights=True,
         filename=os.path.join(os.environ['TMPDIR'], 'glofas_to_mom.nc')
     )
-    # Interpolate only from GloFAS points that are river end points.
-    glofas_regridded = glofas_to_mom_con(glofas_kg.where(glofas_mask > 0).fillna(0.0))
-    
-    glofas_regridded = glofas_regridded.rename({'nyp': 'ny', 'nxp': 'nx'}).values
-
-    # For NWA12 only: remove runoff from west coast of Guatemala 
-    # and El Salvador that actually drains into the Pacific.
-    glofas_regridded[:, 0:190, 0:10] = 0.0
-    glofas_regridded[:, 0:150, 0:100] = 0.0
-    glofas_regridded[:, 0:125, 100:170] = 0.0
-    glofas_regridded[:, 0:60, 170:182] = 0.0
-    glofas_regridded[:, 0:45, 180:200] = 0.0
-    glofas_regridded[:, 0:40, 200:220] = 0.0
-    glofas_regridded[:, 0:45, 220:251] = 0.0
-    glofas_regridded[:, 0:50, 227:247] = 0.0
-    glofas_regridded[:, 0:35, 250:270] = 0.0
-
-    # Remove runoff along the southern boundary to avoid double counting
-    glofas_regridded[:, 0:1, :] = 0.0
-
-    # For NWA12 only: remove runoff from Hudson Bay
-    glofas_regridded[:, 700:, 150:300] = 0.0
-    
-    # For NWA12 only: Mississippi River adjustment.
-    # Adjust to be approximately the same as the USGS station at Belle Chasse, LA
-    # and relocate closer to the end of the delta.
-    ms_total_kg = glofas_regridded[:, 317:320, 106:108] 
-    # Convert to m3/s
-    ms_total_cms = (ms_total_kg * np.broadcast_to(area[317:320, 106:108], ms_total_kg.shape)).sum(axis=(1, 2)) / 1000.0 
-    ms_corrected = 0.5192110112243014 * ms_total_cms + 3084.5571334312735
-    glofas_regridded[:, 317:320, 106:108] = 0.0
-    new_ms_coords = [(314, 108), (315, 107), (317, 112)]
-    for c in new_ms_coords:
-        y, x = c
-        glofas_regridded[:, y, x] = (1 / len(new_ms_coords)) * ms_corrected * 1000.0 / float(area[y, x])
+    regrid = regrid_matrix(glofas_to_mom_con)
 
-    # Flatten mask and coordinates to 1D
-    flat_mask = coast_mask.ravel().astype('bool')
-    coast_lon = lon.values.ravel()[flat_mask]
-    coast_lat = lat.values.ravel()[flat_mask]
-    mom_id = np.arange(np.prod(coast_mask.shape))
+    # Domain-specific edits (e.g. removing runoff that drains elsewhere)
+    edits, edit_offset, relocations = compile_rules(rules, lon.values, lat.values, area.values)
 
-    # Use xesmf to find the index of the nearest coastal cell
-    # for every grid cell in the MOM domain
-    coast_to_mom = reuse_regrid(
-        {'lat': coast_lat, 'lon': coast_lon},
-        {'lat': lat, 'lon': lon},
-        method='nearest_s2d',
-        locstream_in=True,
-        reuse_weights=True,
-        filename=os.path.join(os.environ['TMPDIR'], 'coast_to_mom.nc')
+    # Sum runoff for every grid cell into its closest coastal cell
+    coast_sum = coast_sum_operator(coast_mask, lon, lat, relocations=relocations)
+
+    matrix = coast_sum @ (edits @ (regrid @ to_kg))
+    return RunoffOperator(matrix, area.shape, offset=coast_sum @ edit_offset)
+
+
+def open_glofas(config, y, glofas_subset):
+    # GloFAS 3.1 data copied to vftmp from:
+    # /archive/e1n/datasets/GloFAS/
+    # in latest version, should only need to pad at the end of the year
+    # (times are refd to midnight)
+    glofas_files = [config['glofas_files_pattern'].format(year=y)]
+    glofas = (
+        xarray.open_mfdataset(glofas_files, combine='by_coords')
+        .rename({'latitude': 'lat', 'longitude': 'lon'})
+        .sel(time=slice(f'{y-1}-12-31 12:00:00', f'{y+1}-01-01 12:00:00'), **glofas_subset)
+        .dis24
     )
-    coast_id = mom_id[flat_mask]
-    nearest_coast = coast_to_mom(coast_id)
-    
-    # For NWA12 only: the Susquehanna gets mapped to the Delaware
-    # because NWA12 only has the lower half of the Chesapeake.
-    # Move the nearest grid point for the Susquehanna Region
-    # to the one for the lower bay.
-    # see notebooks/check_glofas_susq.ipynb
-    target = nearest_coast[455, 271]
-    nearest_coast[460:480, 265:278] = target
-    
-    nearest_coast = nearest_coast.ravel()
+    return glofas
 
-    # Raw runoff on MOM grid, reshaped to 2D (time, grid_id)
-    raw = glofas_regridded.reshape([glofas_regridded.shape[0], -1])
 
-    # Zero array that will be filled with runoff at coastal cells
-    filled = np.zeros_like(raw)
+def write_year(config, y, glofas_subset, operator, hgrid):
+    print(y)
+    glofas = open_glofas(config, y, glofas_subset)
+    output_format = config.get('output_format', 'NETCDF3_64BIT')
+    ext = 'zarr' if output_format == 'zarr' else 'nc'
+    out_file = os.path.join(config['output_dir'], f'glofas_runoff_{y}.{ext}')
+    write_runoff(glofas, operator, hgrid, out_file, format=output_format)
 
-    # Loop over each coastal cell and fill the result array
-    # with the sum of runoff for every grid cell that
-    # has this coastal cell as its closest coastal cell
-    for i in coast_id:
-        filled[:, i] = raw[:, nearest_coast == i].sum(axis=1)
 
-    # Reshape back to 3D
-    filled_reshape = filled.reshape(glofas_regridded.shape)
+def write_runoff(glofas, operator, hgrid, out_file, format='NETCDF3_64BIT'):
+    lon = hgrid.x[1::2, 1::2]
+    lat = hgrid.y[1::2, 1::2]
+    # From Alistair
+    area = (hgrid.area[::2, ::2] + hgrid.area[1::2, 1::2]) + (hgrid.area[1::2, ::2] + hgrid.area[::2, 1::2])
+
+    # Runoff at coastal cells, mapped from GloFAS with one sparse product per timestep
+    filled_reshape = operator(glofas)
 
     # Convert to xarray
     ds = xarray.Dataset({
@@ -216,13 +227,13 @@ def write_runoff(glofas, glofas_mask, hgrid, coast_mask, out_file):
     ds['lon'].attrs = {'units': 'degrees_east'}
     ds['runoff'].attrs = {'units': 'kg m-2 s-1'}
 
-    # Write out
-    ds.to_netcdf(
+    # Write out (as NETCDF3_64BIT for MOM6, or optionally a Zarr store to export later)
+    write_dataset(
+        ds,
         out_file,
         unlimited_dims=['time'],
-        format='NETCDF3_64BIT',
-        encoding=encodings,
-        engine='netcdf4'
+        format=format,
+        encoding=encodings
     )
     ds.close()
 
@@ -246,45 +257,31 @@ if __name__ == '__main__':
 
     ldd = xarray.open_dataarray(config['ldd_file']).sel(**glofas_subset)
 
-    # Start pour point mask to include points where ldd==5
-    # and any surrounding point is ocean (nan in ldd)
-    adjacent = np.logical_and(ldd==5.0, expand_mask_true(np.isnan(ldd), 3))
-    imax = 20 # max number of iterations
-    for i in range(imax):
-        # Number of points previously:
-        npoints = int(adjacent.sum())
-        # Update pour point mask to include points where ldd==5
-        # and any surrounding point was previously identified as a pour point
-        adjacent = np.logical_and(ldd==5.0, expand_mask_true(adjacent, 3))
-        # Number of points in updated mask:
-        npoints_new = int(adjacent.sum())
-        # If the number of points hasn't changed, it has converged.
-        if npoints_new == npoints:
-            print(f'Converged after {i+1} iterations')
-            break
-    else:
-        raise Exception('Did not converge')
-
+    # Pour points are points where ldd==5 that are next to the ocean (nan in ldd),
+    # or next to another pour point.
     # Note; converting from dataarray to numpy, because the 
     # glofas ldd coordinates are float32 and the 
     # glofas runoff coordinates are float64 
-    glofas_coast_mask = adjacent.values
+    glofas_coast_mask = find_pour_points(ldd.values)
 
     if not os.path.exists(config['output_dir']):
         os.makedirs(config['output_dir'])
 
-    for y in range(config['start_year'], config['end_year'] + 1):
-        print(y)
-        # GloFAS 3.1 data copied to vftmp from:
-        # /archive/e1n/datasets/GloFAS/
-        # in latest version, should only need to pad at the end of the year
-        # (times are refd to midnight)
-        glofas_files = [config['glofas_files_pattern'].format(year=y)]
-        glofas = (
-            xarray.open_mfdataset(glofas_files, combine='by_coords')
-            .rename({'latitude': 'lat', 'longitude': 'lon'})
-            .sel(time=slice(f'{y-1}-12-31 12:00:00', f'{y+1}-01-01 12:00:00'), **glofas_subset)
-            .dis24
-        )
-        out_file = os.path.join(config['output_dir'], f'glofas_runoff_{y}.nc')
-        write_runoff(glofas, glofas_coast_mask, hgrid, mom_coast_mask, out_file)
+    # The mapping from GloFAS to MOM runoff is built once here (or loaded from an earlier run)
+    # from the grid of the first year, and shared by every year.
+    # Operators built from different rules, grids or masks are saved to different files.
+    rules = config.get('runoff_rules', [])
+    glofas = open_glofas(config, config['start_year'], glofas_subset)
+    key = operator_key(
+        rules,
+        [input_signature(config[f]) for f in ['hgrid_file', 'grid_mask_file', 'ldd_file']],
+        glofas['lat'].values, glofas['lon'].values
+    )
+    operator = load_or_build(
+        os.path.join(os.environ['TMPDIR'], f'glofas_runoff_operator_{key}.npz'),
+        runoff_operator, glofas, glofas_coast_mask, hgrid, mom_coast_mask, rules=rules
+    )
+
+    # Each year is written to its own file, so years can be processed in parallel
+    tasks = [(config, y, glofas_subset, operator, hgrid) for y in range(config['start_year'], config['end_year'] + 1)]
+    run_tasks(write_year, tasks, workers=args.workers)
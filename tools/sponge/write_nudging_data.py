@@ -7,9 +7,14 @@ How to use
 import numpy as np
 import os
 import pandas as pd
+import sys
 import xarray
 import xesmf
 
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(script_dir, '../boundary'))
+from boundary import write_dataset
+
 
 VARIABLES = ['thetao', 'so']
 
@@ -63,6 +68,9 @@ if __name__ == '__main__':
     regridder = None
     model_input = Path(config['filesystem']['model_input_data']) / 'nudging'
     model_input.mkdir(exist_ok=True)
+    # Optionally write Zarr stores, to be exported to NETCDF3 for MOM6 later
+    output_format = config['filesystem'].get('output_format', 'NETCDF3_64BIT')
+    ext = 'zarr' if output_format == 'zarr' else 'nc'
     for year in range(config['forecasts']['first_year'], config['forecasts']['last_year']+1):
         print(f'{year}')
         glorys = (
@@ -104,10 +112,10 @@ if __name__ == '__main__':
         bounded['xh'].attrs = {'cartesian_axis': 'X'}
         bounded['yh'].attrs = {'cartesian_axis': 'Y'}
         print('  Writing')
-        bounded.to_netcdf(
-            model_input / f'nudging_monthly_{year}.nc',
-            format='NETCDF3_64BIT',
-            engine='netcdf4',
+        write_dataset(
+            bounded,
+            model_input / f'nudging_monthly_{year}.{ext}',
+            format=output_format,
             encoding=encodings,
             unlimited_dims='time'
         )